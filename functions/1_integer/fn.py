@@ -6,9 +6,7 @@ import kv
 KEY = "counter"
 
 
-def fn(i: typing.Optional[str]) -> typing.Optional[str]:
-    """ignore the input, add 1 to the list"""
-
+def _key(i: typing.Optional[str]) -> str:
     key = KEY
 
     if i is not None:
@@ -16,6 +14,10 @@ def fn(i: typing.Optional[str]) -> typing.Optional[str]:
         if len(s) > 0:
             key = key + s[0]
 
+    return key
+
+
+def _read(key: str) -> int:
     try:
         c = kv.read(key)
     except:
@@ -34,8 +36,42 @@ def fn(i: typing.Optional[str]) -> typing.Optional[str]:
         c = 0
         print("counter is not an integer, reset to 0")
 
+    return c
+
+
+def fn(i: typing.Optional[str]) -> typing.Optional[str]:
+    """ignore the input, add 1 to the list"""
+
+    key = _key(i)
+
+    c = _read(key)
+
     c = c + 1
 
     kv.update(key, str(c))
 
     return str(c)
+
+
+def fn_batch(inputs: typing.List[typing.Optional[str]]) -> typing.List[typing.Any]:
+    """like fn, but reads and writes every counter only once per batch"""
+
+    keys = [_key(i) for i in inputs]
+
+    counters = {key: _read(key) for key in set(keys)}
+
+    res: typing.List[typing.Any] = []
+    for key in keys:
+        counters[key] += 1
+        res.append(str(counters[key]))
+
+    errs = dict(
+        zip(counters, kv.update_many({k: str(c) for k, c in counters.items()}))
+    )
+
+    for n, key in enumerate(keys):
+        if errs[key] is not None:
+            print("failed to write")
+            res[n] = Exception("writing failed: " + str(errs[key]))
+
+    return res
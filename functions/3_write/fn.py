@@ -7,9 +7,7 @@ import uuid
 LEN_BYTES = 1024
 
 
-def fn(i: typing.Optional[str]) -> typing.Optional[str]:
-    """write LEN_BYTES to db"""
-
+def _len_bytes(i: typing.Optional[str]) -> int:
     len_bytes = LEN_BYTES
 
     if i is not None:
@@ -18,9 +16,20 @@ def fn(i: typing.Optional[str]) -> typing.Optional[str]:
         if len(s) > 1:
             len_bytes = int(s[1])
 
+    return len_bytes
+
+
+def _random_key() -> str:
     random_key = str(uuid.uuid4())
     # remove the dashes
-    random_key = random_key.replace("-", "")
+    return random_key.replace("-", "")
+
+
+def fn(i: typing.Optional[str]) -> typing.Optional[str]:
+    """write LEN_BYTES to db"""
+
+    len_bytes = _len_bytes(i)
+    random_key = _random_key()
 
     try:
         kv.update(random_key, "a" * len_bytes)
@@ -30,3 +39,22 @@ def fn(i: typing.Optional[str]) -> typing.Optional[str]:
         raise Exception("writing failed: " + str(e))
 
     return random_key
+
+
+def fn_batch(inputs: typing.List[typing.Optional[str]]) -> typing.List[typing.Any]:
+    """write LEN_BYTES to db for every input, all at once"""
+
+    items = {_random_key(): "a" * _len_bytes(i) for i in inputs}
+
+    errs = kv.update_many(items)
+
+    res: typing.List[typing.Any] = []
+    for random_key, e in zip(items, errs):
+        if e is not None:
+            print("failed to write")
+            res.append(Exception("writing failed: " + str(e)))
+            continue
+
+        res.append(random_key)
+
+    return res
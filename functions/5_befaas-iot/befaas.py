@@ -1,60 +1,656 @@
 import kv
 
+import atexit
+import collections
+import concurrent.futures
 import datetime
+import hashlib
+import http.client
 import os
 import json
+import queue
+import sys
 import time
 import threading
 import typing
-import urllib.request
+import urllib.parse
 import uuid
-
-# cache holds a cached parsed ctx object
-cache: typing.Dict[str, typing.Any] = {}
-
-log_lock = threading.Lock()
+import zlib
+
+# cache holds parsed ctx objects by their JSON string, at most
+# BEFAAS_CACHE_ENTRIES of them and BEFAAS_CACHE_BYTES of JSON in total, the
+# least recently used ones are evicted first
+# a ctx is also dropped once its request ends
+# hit rate and evictions are written as a CACHE line with the trace records
+# every BEFAAS_CACHE_REPORT seconds (0 for never), also with BEFAAS_DEBUG=false
+cache_entries = int(os.getenv("BEFAAS_CACHE_ENTRIES", "256"))
+cache_bytes = int(os.getenv("BEFAAS_CACHE_BYTES", str(16 * 1024 * 1024)))
+cache_report = float(os.getenv("BEFAAS_CACHE_REPORT", "10"))
+
+cache: typing.OrderedDict[str, typing.Any] = collections.OrderedDict()
+cache_lock = threading.Lock()
+cache_size = 0
+cache_hits = 0
+cache_misses = 0
+cache_evictions = 0
+cache_released = 0
 
 function = os.getenv("FUNCTION_NAME", "unknown")
 
+# trace records are kept in a ring buffer per thread and written out in
+# batches by a background thread every BEFAAS_TRACE_FLUSH seconds, to stdout
+# or to the file in BEFAAS_TRACE_OUTPUT, as the usual BEFAAS and DEBUG lines
+# each buffer holds BEFAAS_TRACE_BUFFER records, the oldest ones are dropped
+# when the writer cannot keep up
+# only a BEFAAS_TRACE_SAMPLE fraction of requests is traced, chosen by
+# xcontext so that all functions keep or drop the same requests
+# debug records are left out completely with BEFAAS_DEBUG=false and cut to
+# BEFAAS_DEBUG_MAX characters otherwise (0 for no limit)
+trace_output = os.getenv("BEFAAS_TRACE_OUTPUT", "stdout")
+trace_flush = float(os.getenv("BEFAAS_TRACE_FLUSH", "0.1"))
+trace_buffer = int(os.getenv("BEFAAS_TRACE_BUFFER", "4096"))
+trace_sample = float(os.getenv("BEFAAS_TRACE_SAMPLE", "1"))
+debug = os.getenv("BEFAAS_DEBUG", "true") == "true"
+debug_max = int(os.getenv("BEFAAS_DEBUG_MAX", "0"))
+
+# with BEFAAS_OTLP_OUTPUT set, the writer also turns the trace records into
+# spans and exports them as OTLP/JSON, either appended to that file one
+# request per line or posted to that URL of a collector, e.g.
+# http://localhost:4318/v1/traces
+# the trace id is xcontext, calls and db operations are client spans with
+# xpair as span id and xexecution as parent, functions are server spans that
+# are children of the call that invoked them
+# spans are exported by their own thread, at most BEFAAS_OTLP_QUEUE batches
+# wait for it and a collector gets BEFAAS_OTLP_TIMEOUT seconds to answer,
+# spans that do not fit or fail to export are dropped so that a slow
+# collector never holds up the trace lines
+otlp_output = os.getenv("BEFAAS_OTLP_OUTPUT", "")
+otlp_queue_size = int(os.getenv("BEFAAS_OTLP_QUEUE", "64"))
+otlp_timeout = float(os.getenv("BEFAAS_OTLP_TIMEOUT", "1"))
+
+# buffers of all threads that have recorded something, with their thread
+buffers: typing.List[
+    typing.Tuple[threading.Thread, typing.Deque[typing.Tuple[typing.Any, ...]]]
+] = []
+buffers_lock = threading.Lock()
+local = threading.local()
+
+writer: typing.Optional[threading.Thread] = None
+write_lock = threading.Lock()
+trace_file: typing.Optional[typing.TextIO] = None
+
+# records lost to full buffers, only roughly counted
+dropped = 0
+
+# start times of spans that have not ended yet, only used by the writer
+open_spans: typing.Dict[typing.Tuple[str, str, str], float] = {}
+
+# batches of spans waiting for the exporter, which alone uses the file or
+# connection, None tells it to stop
+otlp_queue: (
+    "queue.Queue[typing.Optional[typing.List[typing.Dict[str, typing.Any]]]]"
+) = queue.Queue(maxsize=otlp_queue_size)
+exporter: typing.Optional[threading.Thread] = None
+otlp_file: typing.Optional[typing.TextIO] = None
+otlp_conn: typing.Optional[http.client.HTTPConnection] = None
+
+# spans lost to a full queue or a failed export, with the last error
+spans_dropped = 0
+spans_error = ""
+
+# set by shutdown(), the writer and exporter finish their work and stop
+stopping = threading.Event()
+
+# call keeps connections to other functions open for reuse, at most
+# BEFAAS_POOL_SIZE idle ones per endpoint, each closed after BEFAAS_POOL_IDLE
+# seconds without use
+# calls time out after BEFAAS_CALL_TIMEOUT seconds
+pool_size = int(os.getenv("BEFAAS_POOL_SIZE", "8"))
+pool_idle = float(os.getenv("BEFAAS_POOL_IDLE", "30"))
+call_timeout = float(os.getenv("BEFAAS_CALL_TIMEOUT", "30"))
+
+# idle connections by (scheme, host, port), least recently used first
+pool: typing.Dict[
+    typing.Tuple[str, str, int],
+    typing.List[typing.Tuple[http.client.HTTPConnection, float]],
+] = {}
+
+pool_lock = threading.Lock()
+
+# call_many makes up to BEFAAS_CALL_WORKERS calls at the same time
+call_workers = int(os.getenv("BEFAAS_CALL_WORKERS", "8"))
+executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+executor_lock = threading.Lock()
+
 
 def _dictcopy(d: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
     return {k: v for k, v in d.items()}
 
 
-def _getcurrtime() -> str:
-    return datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+def _buffer() -> typing.Deque[typing.Tuple[typing.Any, ...]]:
+    try:
+        return local.buffer  # type: ignore
+    except AttributeError:
+        pass
 
+    global writer
 
-def _logperf(xpair: str, xexecution: str, xcontext: str, event: str) -> None:
-    # not a fan of this but it is what it is
-    with log_lock:
-        print(
-            f"BEFAAS;{_getcurrtime()};{function};{xpair};{xexecution};{xcontext};{event}"
+    b: typing.Deque[typing.Tuple[typing.Any, ...]] = collections.deque(
+        maxlen=trace_buffer
+    )
+
+    with buffers_lock:
+        buffers.append((threading.current_thread(), b))
+
+        if writer is None:
+            writer = threading.Thread(target=_write, daemon=True)
+            writer.start()
+
+    local.buffer = b
+    return b
+
+
+def _record(r: typing.Tuple[typing.Any, ...]) -> None:
+    global dropped
+
+    # appending to a deque is atomic, so only the owning thread and the
+    # writer touch a buffer and neither needs a lock
+    b = _buffer()
+
+    if len(b) == trace_buffer:
+        dropped += 1
+
+    b.append(r)
+
+
+def _sampled(xcontext: str) -> bool:
+    if trace_sample >= 1:
+        return True
+
+    return zlib.crc32(xcontext.encode("utf-8")) < trace_sample * 2**32
+
+
+def _hexid(s: str) -> str:
+    # xpair and xcontext are uuids, anything else is hashed to the same length
+    h = s.replace("-", "").lower()
+
+    if len(h) == 32 and all(c in "0123456789abcdef" for c in h):
+        return h
+
+    return hashlib.md5(s.encode("utf-8")).hexdigest()
+
+
+def _traceparent(xcontext: str, xpair: str) -> str:
+    flags = "01" if _sampled(xcontext) else "00"
+    return f"00-{_hexid(xcontext)}-{_hexid(xpair)[:16]}-{flags}"
+
+
+def _attr(key: str, value: str) -> typing.Dict[str, typing.Any]:
+    return {"key": key, "value": {"stringValue": value}}
+
+
+def _span(
+    start: float, end: float, xpair: str, xexecution: str, xcontext: str, name: str
+) -> typing.Dict[str, typing.Any]:
+    attributes = [
+        _attr("befaas.xpair", xpair),
+        _attr("befaas.xexecution", xexecution),
+        _attr("befaas.xcontext", xcontext),
+    ]
+
+    # the two halves of an xpair identify both ends of a call: the first one
+    # the client span of the caller, the second one the server span of the
+    # function that was called
+    if name == "":
+        kind = 2
+        name = function
+        span_id = _hexid(xpair)[16:]
+        parent_id = _hexid(xexecution)[:16]
+        attributes.append(_attr("faas.name", function))
+    else:
+        kind = 3
+        span_id = _hexid(xpair)[:16]
+        parent_id = _hexid(xexecution)[16:]
+
+        if name.startswith("call-"):
+            attributes.append(_attr("peer.service", name[len("call-") :]))
+        elif name.startswith("db-"):
+            attributes.append(_attr("db.operation", name[len("db-") :]))
+
+    return {
+        "traceId": _hexid(xcontext),
+        "spanId": span_id,
+        "parentSpanId": parent_id,
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int(end * 1e9)),
+        "attributes": attributes,
+    }
+
+
+def _spans(
+    records: typing.List[typing.Tuple[typing.Any, ...]]
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    spans = []
+
+    for r in records:
+        if len(r) != 5:
+            continue
+
+        t, xpair, xexecution, xcontext, event = r
+
+        # events are start or end, followed by what started or ended
+        phase, _, name = event.partition("-")
+        key = (xpair, xexecution, name)
+
+        if phase == "start":
+            open_spans[key] = t
+            continue
+
+        start = open_spans.pop(key, None)
+
+        if start is None:
+            continue
+
+        spans.append(_span(start, t, xpair, xexecution, xcontext, name))
+
+    # spans that never end, e.g. because the function failed, are forgotten
+    # once there are more than BEFAAS_TRACE_BUFFER of them
+    while len(open_spans) > trace_buffer:
+        del open_spans[next(iter(open_spans))]
+
+    return spans
+
+
+def _export_http(data: bytes) -> None:
+    global otlp_conn
+
+    u = urllib.parse.urlsplit(otlp_output)
+
+    if otlp_conn is None:
+        if u.scheme == "https":
+            otlp_conn = http.client.HTTPSConnection(
+                u.hostname or "", u.port, timeout=otlp_timeout
+            )
+        else:
+            otlp_conn = http.client.HTTPConnection(
+                u.hostname or "", u.port, timeout=otlp_timeout
+            )
+
+    try:
+        otlp_conn.request(
+            "POST",
+            u.path or "/",
+            body=data,
+            headers={"Content-Type": "application/json"},
         )
+        response = otlp_conn.getresponse()
+        response.read()
+    except Exception:
+        # start over with a new connection next time
+        otlp_conn.close()
+        otlp_conn = None
+        raise
 
+    if response.will_close:
+        otlp_conn.close()
+        otlp_conn = None
 
-def _logdebug(event: str) -> None:
-    with log_lock:
-        print(f"DEBUG;{_getcurrtime()};{function};{repr(event)}")
+    if response.status >= 400:
+        raise Exception(f"HTTP Error {response.status}: {response.reason}")
 
 
-def _parse(ctx_s: str) -> typing.Dict[str, typing.Any]:
-    if ctx_s not in cache:
+def _export(spans: typing.List[typing.Dict[str, typing.Any]]) -> None:
+    global otlp_file
+
+    out = json.dumps(
+        {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [_attr("service.name", function)]},
+                    "scopeSpans": [{"scope": {"name": "befaas"}, "spans": spans}],
+                }
+            ]
+        }
+    )
+
+    if otlp_output.startswith("http://") or otlp_output.startswith("https://"):
+        _export_http(out.encode("utf-8"))
+        return
+
+    if otlp_file is None:
+        otlp_file = open(otlp_output, "a")
+
+    otlp_file.write(out + "\n")
+    otlp_file.flush()
+
+
+def _exporter() -> None:
+    global spans_dropped, spans_error
+
+    while True:
+        spans = otlp_queue.get()
+        if spans is None:
+            return
+
         try:
-            cache[ctx_s] = json.loads(ctx_s)
+            _export(spans)
         except Exception as e:
-            raise Exception(f"error parsing ctx {ctx_s}: {e}")
+            spans_dropped += len(spans)
+            spans_error = str(e)
+
+
+def _enqueue(spans: typing.List[typing.Dict[str, typing.Any]]) -> None:
+    global exporter, spans_dropped
+
+    if len(spans) == 0:
+        return
+
+    if exporter is None:
+        exporter = threading.Thread(target=_exporter, daemon=True)
+        exporter.start()
+
+    try:
+        otlp_queue.put_nowait(spans)
+    except queue.Full:
+        spans_dropped += len(spans)
+
+
+def _format(r: typing.Tuple[typing.Any, ...]) -> str:
+    t = datetime.datetime.fromtimestamp(r[0], tz=datetime.timezone.utc).isoformat()
+
+    if len(r) == 2:
+        return f"DEBUG;{t};{function};{repr(r[1])}"
+
+    if len(r) == 3:
+        return f"{r[1]};{t};{function};{r[2]}"
+
+    return f"BEFAAS;{t};{function};{r[1]};{r[2]};{r[3]};{r[4]}"
+
+
+def flush() -> None:
+    """write out all buffered trace records"""
+
+    global dropped, trace_file, spans_dropped
+
+    with write_lock:
+        with buffers_lock:
+            current = list(buffers)
+
+        records: typing.List[typing.Tuple[typing.Any, ...]] = []
+
+        for _, b in current:
+            while True:
+                try:
+                    records.append(b.popleft())
+                except IndexError:
+                    break
+
+        # forget the buffers of threads that are gone once they are empty
+        with buffers_lock:
+            buffers[:] = [
+                (t, b) for t, b in buffers if t.is_alive() or len(b) > 0
+            ]
+
+        if dropped > 0:
+            records.append((time.time(), f"dropped {dropped} trace records"))
+            dropped = 0
+
+        if spans_dropped > 0:
+            n, spans_dropped = spans_dropped, 0
+            msg = f"dropped {n} spans"
+            if spans_error != "":
+                msg += f" ({spans_error})"
+            records.append((time.time(), msg))
+
+        if len(records) == 0:
+            return
+
+        # records from different threads are interleaved by time
+        records.sort(key=lambda r: r[0])  # type: ignore
+
+        out = "\n".join(_format(r) for r in records) + "\n"
+
+        if trace_output == "stdout":
+            sys.stdout.write(out)
+            sys.stdout.flush()
+        else:
+            if trace_file is None:
+                trace_file = open(trace_output, "a")
+
+            trace_file.write(out)
+            trace_file.flush()
+
+        if otlp_output != "":
+            _enqueue(_spans(records))
+
+
+def _write() -> None:
+    reported = time.monotonic()
+
+    while not stopping.wait(trace_flush):
+        if cache_report > 0 and time.monotonic() - reported >= cache_report:
+            reported = time.monotonic()
+            _record((time.time(), "CACHE", json.dumps(cache_stats())))
+
+        try:
+            flush()
+        except Exception as e:
+            print(f"error writing trace records: {e}")
+
+    try:
+        flush()
+    except Exception as e:
+        print(f"error writing trace records: {e}")
+
+
+def shutdown() -> None:
+    """write out all buffered trace records and export the remaining spans"""
+
+    # the function handler calls this through fn.shutdown before its workers
+    # exit, they skip atexit, which is left for other ways of exiting
+    if stopping.is_set():
+        return
+
+    stopping.set()
+
+    if writer is not None:
+        writer.join(trace_flush + 1)
+
+    # records from threads that kept going after the writer stopped
+    try:
+        flush()
+    except Exception as e:
+        print(f"error writing trace records: {e}")
+
+    if exporter is None:
+        return
+
+    # each batch still waiting gets as long as a collector may take
+    timeout = otlp_timeout * (otlp_queue.qsize() + 1)
+
+    try:
+        otlp_queue.put(None, timeout=timeout)
+    except queue.Full:
+        return
 
-    return cache[ctx_s]  # type: ignore
+    exporter.join(timeout)
+
+
+atexit.register(shutdown)
+
+
+def _logperf(xpair: str, xexecution: str, xcontext: str, event: str) -> None:
+    if not _sampled(xcontext):
+        return
+
+    _record((time.time(), xpair, xexecution, xcontext, event))
+
+
+def _logdebug(msg: str, *args: typing.Any) -> None:
+    # arguments are only formatted when debug records are kept
+    if not debug:
+        return
+
+    if len(args) > 0:
+        msg = msg % args
+
+    if debug_max > 0 and len(msg) > debug_max:
+        msg = msg[:debug_max] + "..."
+
+    _record((time.time(), msg))
+
+
+def _connection(
+    endpoint: typing.Tuple[str, str, int]
+) -> http.client.HTTPConnection:
+    now = time.monotonic()
+
+    with pool_lock:
+        idle = pool.get(endpoint, [])
+
+        # drop connections that have been idle for too long
+        while len(idle) > 0 and now - idle[0][1] > pool_idle:
+            idle.pop(0)[0].close()
+
+        if len(idle) > 0:
+            return idle.pop()[0]
+
+    scheme, host, port = endpoint
+
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=call_timeout)
+
+    return http.client.HTTPConnection(host, port, timeout=call_timeout)
+
+
+def _release(
+    endpoint: typing.Tuple[str, str, int], conn: http.client.HTTPConnection
+) -> None:
+    with pool_lock:
+        idle = pool.setdefault(endpoint, [])
+
+        if len(idle) >= pool_size:
+            conn.close()
+            return
+
+        idle.append((conn, time.monotonic()))
+
+
+def _post(url: str, data: bytes, headers: typing.Dict[str, str]) -> bytes:
+    u = urllib.parse.urlsplit(url)
+
+    endpoint = (
+        u.scheme,
+        u.hostname or "",
+        u.port or (443 if u.scheme == "https" else 80),
+    )
+
+    path = u.path or "/"
+    if u.query:
+        path += "?" + u.query
+
+    while True:
+        conn = _connection(endpoint)
+        reused = conn.sock is not None
+
+        try:
+            conn.request("POST", path, body=data, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+
+            # the other side closed a pooled connection before we used it,
+            # try again on another one
+            if reused:
+                continue
+
+            raise
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            _release(endpoint, conn)
+
+        if response.status >= 400:
+            raise Exception(f"HTTP Error {response.status}: {response.reason}")
+
+        return body
+
+
+def cache_stats() -> typing.Dict[str, typing.Any]:
+    """size, hit rate and evictions of the ctx cache"""
+
+    with cache_lock:
+        lookups = cache_hits + cache_misses
+
+        return {
+            "entries": len(cache),
+            "bytes": cache_size,
+            "hits": cache_hits,
+            "misses": cache_misses,
+            "hit_rate": cache_hits / lookups if lookups > 0 else 0.0,
+            "evictions": cache_evictions,
+            "released": cache_released,
+        }
+
+
+def _parse(ctx_s: str) -> typing.Dict[str, typing.Any]:
+    global cache_size, cache_hits, cache_misses, cache_evictions
+
+    with cache_lock:
+        ctx = cache.get(ctx_s)
+
+        if ctx is not None:
+            cache.move_to_end(ctx_s)
+            cache_hits += 1
+            return ctx  # type: ignore
+
+        cache_misses += 1
+
+    try:
+        ctx = json.loads(ctx_s)
+    except Exception as e:
+        raise Exception(f"error parsing ctx {ctx_s}: {e}")
+
+    # a ctx that is larger than the whole cache is not kept
+    if len(ctx_s) > cache_bytes:
+        return ctx  # type: ignore
+
+    with cache_lock:
+        if ctx_s not in cache:
+            cache[ctx_s] = ctx
+            cache_size += len(ctx_s)
+
+        while len(cache) > cache_entries or cache_size > cache_bytes:
+            k, _ = cache.popitem(last=False)
+            cache_size -= len(k)
+            cache_evictions += 1
+
+    return ctx  # type: ignore
+
+
+def _release_ctx(ctx_s: str) -> None:
+    global cache_size, cache_released
+
+    with cache_lock:
+        if cache.pop(ctx_s, None) is not None:
+            cache_size -= len(ctx_s)
+            cache_released += 1
 
 
 def start(ctx_s: str) -> typing.Dict[str, typing.Any]:
-    _logdebug(f"starting request with context {ctx_s} (len {len(ctx_s)})")
+    _logdebug("starting request with context %s (len %d)", ctx_s, len(ctx_s))
     ctx = _parse(ctx_s)
 
     _logperf(ctx["xpair"], ctx["xpair"], ctx["xcontext"], "start")
 
-    _logdebug(f"parsed ctx to {ctx}")
+    _logdebug("parsed ctx to %s", ctx)
 
     return ctx["data"]  # type: ignore
 
@@ -69,7 +665,10 @@ def end(ctx_s: str, data: typing.Optional[typing.Any]) -> str:
 
     output = json.dumps(new_ctx)
 
-    _logdebug(f"returning {output}")
+    # the request is done, its ctx will not be needed again
+    _release_ctx(ctx_s)
+
+    _logdebug("returning %s", output)
 
     return output
 
@@ -77,7 +676,7 @@ def end(ctx_s: str, data: typing.Optional[typing.Any]) -> str:
 def call(
     ctx_s: str, func: str, i: typing.Dict[str, typing.Any], asynchronous: bool = False
 ) -> typing.Dict[str, typing.Any]:
-    _logdebug(f"calling {func} with input {i}")
+    _logdebug("calling %s with input %s", func, i)
 
     # new context by copying the old one
     new_ctx = _dictcopy(_parse(ctx_s))
@@ -102,15 +701,13 @@ def call(
             if asynchronous
             else {}
         )
+
+        # the called function's server span is a child of this call
+        headers["traceparent"] = _traceparent(new_ctx["xcontext"], new_ctx["xpair"])
         endpoint = os.getenv(f"ENDPOINT_{func.upper()}")
-        req = urllib.request.Request(
-            f"{endpoint}", data=data, headers=headers, method="POST"
-        )
-        with urllib.request.urlopen(req) as response:
-            response_data = response.read()
-            # Process response_data as needed
+        response_data = _post(f"{endpoint}", data, headers)
     except Exception as e:
-        _logdebug(f"error calling {func}: {e}")
+        _logdebug("error calling %s: %s", func, e)
 
     _logperf(new_ctx["xpair"], xexecution, new_ctx["xcontext"], f"end-call-{func}")
 
@@ -123,16 +720,50 @@ def call(
         data = json.loads(response_data.decode("utf-8"))["data"]
     except Exception as e:
         _logdebug(
-            f"error parsing response {response_data.decode('utf-8')} from {func}: {e}"
+            "error parsing response %s from %s: %s",
+            response_data.decode("utf-8"),
+            func,
+            e,
         )
 
-    _logdebug(f"got response {response_data.decode('utf-8')} from {func}")
+    if debug:
+        _logdebug("got response %s from %s", response_data.decode("utf-8"), func)
 
     return data  # type: ignore
 
 
+def call_many(
+    ctx_s: str,
+    calls: typing.Sequence[typing.Tuple[str, typing.Dict[str, typing.Any], bool]],
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    make several calls, given as (func, input, asynchronous), at the same time
+    and return their results in order, each call is traced like with call
+    """
+
+    global executor
+
+    if len(calls) <= 1:
+        return [call(ctx_s, func, i, asynchronous) for func, i, asynchronous in calls]
+
+    with executor_lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=call_workers)
+
+    # the last call is made on this thread while the others are in flight
+    futures = [
+        executor.submit(call, ctx_s, func, i, asynchronous)
+        for func, i, asynchronous in calls[:-1]
+    ]
+
+    func, i, asynchronous = calls[-1]
+    last = call(ctx_s, func, i, asynchronous)
+
+    return [f.result() for f in futures] + [last]
+
+
 def dbget(ctx_s: str, key: str) -> typing.Any:
-    _logdebug(f"getting {key} from db")
+    _logdebug("getting %s from db", key)
 
     ctx = _parse(ctx_s)
 
@@ -147,26 +778,26 @@ def dbget(ctx_s: str, key: str) -> typing.Any:
     try:
         v = kv.read(key)[0]
     except Exception as e:
-        _logdebug(f"error getting {key} from db (returning None): {e}")
+        _logdebug("error getting %s from db (returning None): %s", key, e)
 
     _logperf(xpair, xexecution, ctx["xcontext"], f"end-db-get")
 
     if v == "":
         return None
 
-    _logdebug(f"got {v} from db for {key}")
+    _logdebug("got %s from db for %s", v, key)
 
     # unmarshal the value from json
     try:
         v = json.loads(v)
     except:
-        _logdebug(f"error unmarshalling {v} from db")
+        _logdebug("error unmarshalling %s from db", v)
 
     return v
 
 
 def dbset(ctx_s: str, key: str, value: typing.Any) -> None:
-    _logdebug(f"setting {key} to {value} in db")
+    _logdebug("setting %s to %s in db", key, value)
 
     ctx = _parse(ctx_s)
 
@@ -181,13 +812,47 @@ def dbset(ctx_s: str, key: str, value: typing.Any) -> None:
     try:
         value = json.dumps(value)
     except:
-        _logdebug(f"error marshalling {value} to db")
+        _logdebug("error marshalling %s to db", value)
 
     try:
         kv.update(key, value)
     except Exception as e:
-        _logdebug(f"error setting {key} to {value} in db: {e}")
+        _logdebug("error setting %s to %s in db: %s", key, value, e)
+
+    _logperf(xpair, xexecution, ctx["xcontext"], f"end-db-set")
+
+    _logdebug("set %s to %s in db", key, value)
+
+
+def dbset_many(ctx_s: str, values: typing.Dict[str, typing.Any]) -> None:
+    _logdebug("setting %s in db", list(values.keys()))
+
+    ctx = _parse(ctx_s)
+
+    xexecution = ctx["xpair"]
+
+    # generate a new xpair
+    xpair = str(uuid.uuid4())
+
+    _logperf(xpair, xexecution, ctx["xcontext"], f"start-db-set")
+
+    # marshal the values to json
+    marshalled: typing.Dict[str, str] = {}
+    for key, value in values.items():
+        try:
+            marshalled[key] = json.dumps(value)
+        except:
+            _logdebug("error marshalling %s to db", value)
+            marshalled[key] = value
+
+    try:
+        errors = kv.update_many(marshalled)
+        for key, e in zip(marshalled.keys(), errors):
+            if e is not None:
+                _logdebug("error setting %s to %s in db: %s", key, marshalled[key], e)
+    except Exception as e:
+        _logdebug("error setting %s in db: %s", list(marshalled.keys()), e)
 
     _logperf(xpair, xexecution, ctx["xcontext"], f"end-db-set")
 
-    _logdebug(f"set {key} to {value} in db")
+    _logdebug("set %s in db", list(marshalled.keys()))
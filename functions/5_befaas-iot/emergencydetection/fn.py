@@ -56,3 +56,7 @@ def fn(ctx: str) -> str:
     )
 
     return befaas.end(ctx, {"emergency": emergency})  # type: ignore
+
+
+# the handler calls this before it exits, so that no trace records are lost
+shutdown = befaas.shutdown
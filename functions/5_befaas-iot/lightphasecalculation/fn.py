@@ -37,32 +37,30 @@ def isNumber(x: typing.Any) -> bool:
 def initialDBUpdate(
     ctx: str, condition: typing.Any, plan: typing.Any, emergency: typing.Any
 ) -> None:
+    # these keys are independent, so write them in one batch
+    updates: typing.Dict[str, typing.Any] = {}
+
     if isinstance(condition, (int, float, complex)):
-        befaas.dbset(ctx, "lightcalculationcondition", condition)
+        updates["lightcalculationcondition"] = condition
 
     if not plan == None:
-        befaas.dbset(ctx, "lightcalculationplates", [car.get("plate") for car in plan])
-        befaas.dbset(
-            ctx,
-            "lightcalculationdirections",
-            [car.get("direction") for car in plan],
-        )
-        befaas.dbset(
-            ctx,
-            "lightcalculationspeeds",
-            [car.get("speed") for car in plan],
-        )
+        updates["lightcalculationplates"] = [car.get("plate") for car in plan]
+        updates["lightcalculationdirections"] = [car.get("direction") for car in plan]
+        updates["lightcalculationspeeds"] = [car.get("speed") for car in plan]
 
     # Active emergencies are handled immediately
     if not emergency == None:
         if not emergency.get("active") == None:
-            befaas.dbset(ctx, "lightcalculationlights", ["yellow"])
-            befaas.dbset(ctx, "lightcalculationblink", True)
-            befaas.dbset(ctx, "lightcalculationemergency", True)
-            befaas.dbset(ctx, "lightcalculationemergencytype", emergency["type"])
+            updates["lightcalculationlights"] = ["yellow"]
+            updates["lightcalculationblink"] = True
+            updates["lightcalculationemergency"] = True
+            updates["lightcalculationemergencytype"] = emergency["type"]
         else:
-            befaas.dbset(ctx, "lightcalculationemergency", False)
-            befaas.dbset(ctx, "lightcalculationemergencytype", None)
+            updates["lightcalculationemergency"] = False
+            updates["lightcalculationemergencytype"] = None
+
+    if len(updates) > 0:
+        befaas.dbset_many(ctx, updates)
 
 
 def checkAndLock(ctx: str) -> bool:
@@ -153,3 +151,7 @@ def fn(ctx: str) -> str:
         return befaas.end(ctx, None)  # type: ignore
 
     return befaas.end(ctx, None)  # type: ignore
+
+
+# the handler calls this before it exits, so that no trace records are lost
+shutdown = befaas.shutdown
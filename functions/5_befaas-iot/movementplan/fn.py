@@ -49,3 +49,7 @@ def fn(ctx: str) -> str:
     befaas.call(ctx, "lightphasecalculation", {"plan": cars}, asynchronous=True)
 
     return befaas.end(ctx, None)  # type: ignore
+
+
+# the handler calls this before it exits, so that no trace records are lost
+shutdown = befaas.shutdown
@@ -94,9 +94,17 @@ def fn(ctx: str) -> str:
     # We loaded a picture successfully and parsed it.
 
     res = {"objects": objects}
-    befaas.call(ctx, "trafficstatistics", res, asynchronous=True)
-    befaas.call(ctx, "emergencydetection", res, asynchronous=False)
-
-    befaas.call(ctx, "movementplan", res, asynchronous=False)
+    befaas.call_many(
+        ctx,
+        [
+            ("trafficstatistics", res, True),
+            ("emergencydetection", res, False),
+            ("movementplan", res, False),
+        ],
+    )
 
     return befaas.end(ctx, res)  # type: ignore
+
+
+# the handler calls this before it exits, so that no trace records are lost
+shutdown = befaas.shutdown
@@ -48,3 +48,7 @@ def fn(ctx: str) -> str:
     befaas.dbset(ctx, f"trafficstatistics{timestamp}", statistics)
 
     return befaas.end(ctx, statistics)  # type: ignore
+
+
+# the handler calls this before it exits, so that no trace records are lost
+shutdown = befaas.shutdown
@@ -97,3 +97,7 @@ def fn(ctx: str) -> str:
     )
 
     return befaas.end(ctx, None)  # type: ignore
+
+
+# the handler calls this before it exits, so that no trace records are lost
+shutdown = befaas.shutdown
@@ -15,18 +15,13 @@ def fn(i: typing.Optional[str]) -> typing.Optional[str]:
     if i is None or i == "":
         # it's a read!
         try:
-            v = kv.read(key)
+            # concurrent versions are resolved deterministically
+            v = kv.read_one(key)
         except:
             # no value yet
             return "No value yet"
 
-        if len(v) == 0:
-            return "No value yet"
-
-        if len(v) != 1:
-            print(f"have {len(v)} values, choosing first")
-
-        return str(v[0])
+        return str(v)
 
     # else: it's a write!
     # just write the input value to the key
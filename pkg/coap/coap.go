@@ -3,6 +3,7 @@ package coap
 import (
 	"log"
 	"net"
+	"strconv"
 
 	"github.com/OpenFogStack/tinyFaaS/pkg/rproxy"
 	"github.com/pfandzelter/go-coap"
@@ -27,7 +28,7 @@ func Start(r *rproxy.RProxy, listenAddr string) {
 
 			log.Printf("have request for path: %s (async: %v)", p, async)
 
-			s, res := r.Call(p, m.Payload, async)
+			s, res, retryAfter := r.Call(p, m.Payload, async)
 
 			mes := &coap.Message{
 				Type:      coap.Acknowledgement,
@@ -46,6 +47,13 @@ func Start(r *rproxy.RProxy, listenAddr string) {
 				mes.Code = coap.NotFound
 			case rproxy.StatusError:
 				mes.Code = coap.InternalServerError
+			case rproxy.StatusOverloaded:
+				mes.Code = coap.ServiceUnavailable
+
+				// CoAP carries the time to wait before retrying in Max-Age
+				if seconds, err := strconv.ParseUint(retryAfter, 10, 32); err == nil {
+					mes.SetOption(coap.MaxAge, uint32(seconds))
+				}
 			}
 
 			return mes
@@ -10,6 +10,7 @@ import (
 	"net/http"
 	"os"
 	"path"
+	"strings"
 	"sync"
 	"time"
 
@@ -98,6 +99,15 @@ func (db *DockerBackend) Create(name string, env string, threads int, filedir st
 	if err != nil {
 		return nil, err
 	}
+
+	// the Python runtimes share part of their function handler
+	// cp ./runtimes/python3-common/* <folder>
+	if strings.HasPrefix(dh.env, "python3") {
+		err = util.CopyAll("./runtimes/python3-common", dh.filePath)
+		if err != nil {
+			return nil, err
+		}
+	}
 	log.Println("copied runtime files to folder", dh.filePath)
 
 	// copy function into folder
@@ -78,7 +78,7 @@ func getNodeID(fredClient fred.ClientClient, fredHost string) (string, error) {
 	return nodeID, nil
 }
 
-func (db *DockerKVBackend) createOrReplicateKeygroup(keygroup string) error {
+func (db *DockerKVBackend) createOrReplicateKeygroup(keygroup string, mutable bool) error {
 	// first: check if the keygroup exists
 	keygroupInfo, err := db.fredClient.GetKeygroupInfo(context.Background(), &fred.GetKeygroupInfoRequest{
 		Keygroup: keygroup,
@@ -87,7 +87,7 @@ func (db *DockerKVBackend) createOrReplicateKeygroup(keygroup string) error {
 	if err != nil {
 		// an error! does that mean the keygroup does not exist?
 		log.Println("error getting keygroup info", err)
-		return db.createKeygroup(keygroup)
+		return db.createKeygroup(keygroup, mutable)
 	}
 
 	// the keygroup exists!
@@ -134,10 +134,10 @@ func (db *DockerKVBackend) createOrReplicateKeygroup(keygroup string) error {
 	return nil
 }
 
-func (db *DockerKVBackend) createKeygroup(keygroup string) error {
+func (db *DockerKVBackend) createKeygroup(keygroup string, mutable bool) error {
 	_, err := db.fredClient.CreateKeygroup(context.Background(), &fred.CreateKeygroupRequest{
 		Keygroup: keygroup,
-		Mutable:  true,
+		Mutable:  mutable,
 		Expiry:   0,
 	})
 
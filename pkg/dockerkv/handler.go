@@ -12,6 +12,7 @@ import (
 	"os"
 	"path"
 	"path/filepath"
+	"strings"
 	"sync"
 	"time"
 
@@ -184,6 +185,15 @@ func (db *DockerKVBackend) Create(name string, env string, threads int, filedir
 	if err != nil {
 		return nil, err
 	}
+
+	// the Python runtimes share part of their function handler
+	// cp ./runtimes/python3-common/* <folder>
+	if strings.HasPrefix(dh.env, "python3") {
+		err = util.CopyAll("./runtimes/python3-common", dh.filePath)
+		if err != nil {
+			return nil, err
+		}
+	}
 	log.Println("copied runtime files to folder", dh.filePath)
 
 	// copy function into folder
@@ -383,7 +393,11 @@ func (db *DockerKVBackend) Create(name string, env string, threads int, filedir
 	// let's see if this works
 	dh.fredKeygroup = fmt.Sprintf("tinyFaaS%s", dh.name)
 
-	err = db.createOrReplicateKeygroup(dh.fredKeygroup)
+	// functions that only use kv.append() need an immutable keygroup,
+	// FReD does not allow appends otherwise
+	mutable := dh.envs["KV_APPEND_ONLY"] != "true"
+
+	err = db.createOrReplicateKeygroup(dh.fredKeygroup, mutable)
 
 	if err != nil {
 		log.Printf("error creating fred keygroup: %s", err)
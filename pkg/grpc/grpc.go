@@ -9,6 +9,8 @@ import (
 	"github.com/OpenFogStack/tinyFaaS/pkg/grpc/tinyfaas"
 	"github.com/OpenFogStack/tinyFaaS/pkg/rproxy"
 	"google.golang.org/grpc"
+	"google.golang.org/grpc/codes"
+	"google.golang.org/grpc/status"
 )
 
 // GRPCServer is the grpc endpoint for this tinyFaaS instance.
@@ -21,7 +23,7 @@ func (gs *GRPCServer) Request(ctx context.Context, d *tinyfaas.Data) (*tinyfaas.
 
 	log.Printf("have request for path: %s (async: %v)", d.FunctionIdentifier, false)
 
-	s, res := gs.r.Call(d.FunctionIdentifier, []byte(d.Data), false)
+	s, res, retryAfter := gs.r.Call(d.FunctionIdentifier, []byte(d.Data), false)
 
 	switch s {
 	case rproxy.StatusOK:
@@ -34,6 +36,8 @@ func (gs *GRPCServer) Request(ctx context.Context, d *tinyfaas.Data) (*tinyfaas.
 		return nil, fmt.Errorf("function %s not found", d.FunctionIdentifier)
 	case rproxy.StatusError:
 		return nil, fmt.Errorf("error calling function %s", d.FunctionIdentifier)
+	case rproxy.StatusOverloaded:
+		return nil, status.Errorf(codes.Unavailable, "function %s is overloaded, retry after %s seconds", d.FunctionIdentifier, retryAfter)
 	}
 	return &tinyfaas.Response{
 		Response: string(res),
@@ -31,7 +31,7 @@ func Start(r *rproxy.RProxy, listenAddr string) {
 			return
 		}
 
-		s, res := r.Call(p, req_body, async)
+		s, res, retryAfter := r.Call(p, req_body, async)
 
 		switch s {
 		case rproxy.StatusOK:
@@ -43,6 +43,12 @@ func Start(r *rproxy.RProxy, listenAddr string) {
 			w.WriteHeader(http.StatusNotFound)
 		case rproxy.StatusError:
 			w.WriteHeader(http.StatusInternalServerError)
+		case rproxy.StatusOverloaded:
+			if retryAfter != "" {
+				w.Header().Set("Retry-After", retryAfter)
+			}
+			w.WriteHeader(http.StatusServiceUnavailable)
+			w.Write(res)
 		}
 	})
 
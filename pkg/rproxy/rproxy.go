@@ -8,6 +8,7 @@ import (
 	"math/rand"
 	"net/http"
 	"sync"
+	"time"
 )
 
 type Status uint32
@@ -17,11 +18,34 @@ const (
 	StatusAccepted
 	StatusNotFound
 	StatusError
+	StatusOverloaded
 )
 
+// handlers that may reject async requests answer within this time, so a
+// rejection can still be reported to the client
+const asyncAckWait = 50 * time.Millisecond
+
+// handlers tell in this header of their answer to an async request what they
+// do when they have no room for it, only "reject" is worth waiting for
+const asyncOverflowHeader = "X-tinyFaaS-Async-Overflow"
+
+// function handlers keep connections open, so keep enough idle connections
+// around that concurrent invocations do not have to open new ones
+// idle connections are dropped before the handlers time them out
+var client = &http.Client{
+	Transport: &http.Transport{
+		MaxIdleConns:        1024,
+		MaxIdleConnsPerHost: 64,
+		IdleConnTimeout:     30 * time.Second,
+	},
+}
+
 type RProxy struct {
 	hosts map[string][]string
 	hl    sync.RWMutex
+
+	// handler ip -> whether it rejects async requests it has no room for
+	rejects sync.Map
 }
 
 func New() *RProxy {
@@ -43,6 +67,11 @@ func (r *RProxy) Add(name string, ips []string) error {
 	// 	return fmt.Errorf("function already exists")
 	// }
 
+	// the new handlers tell how they handle overflow on their first answer
+	for _, ip := range r.hosts[name] {
+		r.rejects.Delete(ip)
+	}
+
 	r.hosts[name] = ips
 	return nil
 }
@@ -55,17 +84,23 @@ func (r *RProxy) Del(name string) error {
 		return fmt.Errorf("function not found")
 	}
 
+	for _, ip := range r.hosts[name] {
+		r.rejects.Delete(ip)
+	}
+
 	delete(r.hosts, name)
 	return nil
 }
 
-func (r *RProxy) Call(name string, payload []byte, async bool) (Status, []byte) {
+// Call invokes a function and returns its status and response. For
+// StatusOverloaded, it also returns the Retry-After the function handler sent.
+func (r *RProxy) Call(name string, payload []byte, async bool) (Status, []byte, string) {
 
 	handler, ok := r.hosts[name]
 
 	if !ok {
 		log.Printf("function not found: %s", name)
-		return StatusNotFound, nil
+		return StatusNotFound, nil, ""
 	}
 
 	// log.Printf("have handlers: %s", handler)
@@ -78,27 +113,64 @@ func (r *RProxy) Call(name string, payload []byte, async bool) (Status, []byte)
 	// call function
 	if async {
 		// log.Printf("async request accepted")
+		ack := make(chan *http.Response, 1)
+
 		go func() {
-			resp, err := http.Post(fmt.Sprintf("http://%s:8000/fn", h), "application/binary", bytes.NewBuffer(payload))
+			req, err := http.NewRequest(http.MethodPost, fmt.Sprintf("http://%s:8000/fn", h), bytes.NewBuffer(payload))
 
 			if err != nil {
+				ack <- nil
 				return
 			}
 
+			req.Header.Set("Content-Type", "application/binary")
+
+			// handlers that understand this acknowledge the request before
+			// running the function, so the connection is free again right away
+			req.Header.Set("X-tinyFaaS-Async", "true")
+
+			resp, err := client.Do(req)
+
+			if err != nil {
+				ack <- nil
+				return
+			}
+
+			r.rejects.Store(h, resp.Header.Get(asyncOverflowHeader) == "reject")
+
+			ack <- resp
+
+			// the body must be read for the connection to be reused
+			io.Copy(io.Discard, resp.Body)
 			resp.Body.Close()
 
 			// log.Printf("async request finished")
 		}()
-		return StatusAccepted, nil
+
+		// handlers that never reject are not waited for, neither are
+		// handlers that have not answered an async request yet
+		if reject, ok := r.rejects.Load(h); !ok || !reject.(bool) {
+			return StatusAccepted, nil, ""
+		}
+
+		select {
+		case resp := <-ack:
+			if resp != nil && resp.StatusCode == http.StatusServiceUnavailable {
+				return StatusOverloaded, nil, resp.Header.Get("Retry-After")
+			}
+		case <-time.After(asyncAckWait):
+		}
+
+		return StatusAccepted, nil, ""
 	}
 
 	// call function and return results
 	// log.Printf("sync request starting")
-	resp, err := http.Post(fmt.Sprintf("http://%s:8000/fn", h), "application/binary", bytes.NewBuffer(payload))
+	resp, err := client.Post(fmt.Sprintf("http://%s:8000/fn", h), "application/binary", bytes.NewBuffer(payload))
 
 	if err != nil {
 		log.Print(err)
-		return StatusError, nil
+		return StatusError, nil, ""
 	}
 
 	// log.Printf("sync request finished")
@@ -108,10 +180,15 @@ func (r *RProxy) Call(name string, payload []byte, async bool) (Status, []byte)
 
 	if err != nil {
 		log.Print(err)
-		return StatusError, nil
+		return StatusError, nil, ""
 	}
 
 	// log.Printf("have response for sync request: %s", res_body)
 
-	return StatusOK, res_body
+	// the function handler shed the request, the client should try again later
+	if resp.StatusCode == http.StatusServiceUnavailable {
+		return StatusOverloaded, res_body, resp.Header.Get("Retry-After")
+	}
+
+	return StatusOK, res_body, ""
 }
@@ -0,0 +1,321 @@
+# request handling that the python3 and python3-kv function handlers share,
+# the manager copies this next to their functionhandler.py
+
+from __future__ import annotations
+
+import collections
+import threading
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    import concurrent.futures
+    import email.message
+    import io
+
+
+def body_chunks(
+    rfile: io.BufferedIOBase, headers: email.message.Message, chunk_size: int
+) -> typing.Iterator[bytes]:
+    """the request body in chunks of at most chunk_size bytes as they arrive"""
+
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            size = int(rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                # skip trailers
+                while rfile.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+
+            yield from read_chunks(rfile, size, chunk_size)
+            rfile.readline()
+
+    yield from read_chunks(rfile, int(headers.get("Content-Length", 0)), chunk_size)
+
+
+def read_chunks(
+    rfile: io.BufferedIOBase, remaining: int, chunk_size: int
+) -> typing.Iterator[bytes]:
+    while remaining > 0:
+        data = rfile.read(min(remaining, chunk_size))
+        if not data:
+            raise ConnectionError("request body ended early")
+        remaining -= len(data)
+        yield data
+
+
+def read_body(
+    rfile: io.BufferedIOBase, headers: email.message.Message, chunk_size: int
+) -> memoryview:
+    """the whole request body, however it is framed"""
+
+    # a chunked body has no length up front, so it is collected as it comes
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        buf = bytearray()
+        for chunk in body_chunks(rfile, headers, chunk_size):
+            buf += chunk
+        return memoryview(buf)
+
+    # otherwise read straight into a buffer of the right size, fn_bytes gets
+    # a view of it without any further copies
+    body = memoryview(bytearray(int(headers.get("Content-Length", 0))))
+
+    n = 0
+    while n < len(body):
+        r = rfile.readinto(body[n:])
+        if not r:
+            raise ConnectionError("request body ended early")
+        n += r
+
+    return body
+
+
+class Admission:
+    def __init__(self, limit: int, queue: int, timeout: float) -> None:
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout if timeout > 0 else None
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self, wait: bool = False) -> bool:
+        """
+        take a slot, false if there is none and no room in the queue to wait
+        for one, with wait, block until there is a slot however long it takes
+        """
+
+        with self.cond:
+            if self.limit <= 0 or (self.in_flight < self.limit and self.waiting == 0):
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+
+            if not wait and self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            try:
+                ok = self.cond.wait_for(
+                    lambda: self.in_flight < self.limit,
+                    None if wait else self.timeout,
+                )
+            finally:
+                self.waiting -= 1
+
+            if not ok:
+                self.timed_out += 1
+                return False
+
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self) -> None:
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.cond:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "max_in_flight": self.limit,
+                "max_queue": self.queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+
+class AsyncPool:
+    def __init__(self, workers: int, size: int, overflow: str) -> None:
+        self.size = size
+        self.overflow = overflow
+
+        self.cond = threading.Condition()
+        self.queue: "collections.deque[typing.Callable[[], None]]" = (
+            collections.deque()
+        )
+        self.running = 0
+        self.closed = False
+        self.accepted = 0
+        self.dropped = 0
+        self.overflowed = 0
+
+        self.workers = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for t in self.workers:
+            t.start()
+
+    def submit(self, task: typing.Callable[[], None]) -> bool:
+        """queue a task, false if there is no room for it"""
+
+        with self.cond:
+            if len(self.queue) >= self.size:
+                if self.overflow != "drop-oldest" or self.size == 0:
+                    self.overflowed += 1
+                    return False
+
+                self.queue.popleft()
+                self.dropped += 1
+
+            self.queue.append(task)
+            self.accepted += 1
+            self.cond.notify()
+
+            return True
+
+    def work(self) -> None:
+        while True:
+            with self.cond:
+                while len(self.queue) == 0:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+
+                task = self.queue.popleft()
+                self.running += 1
+
+            try:
+                task()
+            finally:
+                with self.cond:
+                    self.running -= 1
+
+    def close(self) -> None:
+        """wait for all queued tasks to finish"""
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        for t in self.workers:
+            t.join()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        with self.cond:
+            return {
+                "queue_depth": len(self.queue),
+                "running": self.running,
+                "workers": len(self.workers),
+                "max_queue": self.size,
+                "overflow": self.overflow,
+                "accepted": self.accepted,
+                "dropped": self.dropped,
+                "overflowed": self.overflowed,
+            }
+
+
+class Batcher:
+    def __init__(
+        self,
+        fn_batch: typing.Callable[
+            [typing.List[typing.Optional[str]]], typing.List[typing.Any]
+        ],
+        size: int,
+        wait: float,
+    ) -> None:
+        # futures take a while to import, so only batching pays for them
+        import concurrent.futures
+
+        self.future = concurrent.futures.Future
+
+        self.fn_batch = fn_batch
+        self.size = size
+        self.wait = wait
+
+        self.cond = threading.Condition()
+        self.items: typing.List[
+            typing.Tuple[typing.Optional[str], concurrent.futures.Future]
+        ] = []
+        self.deadline = 0.0
+        self.batches = 0
+        self.batched = 0
+
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def submit(self, d: typing.Optional[str]) -> concurrent.futures.Future:
+        """add an input to the next batch, the future has its result"""
+
+        f: concurrent.futures.Future = self.future()
+
+        with self.cond:
+            if len(self.items) == 0:
+                self.deadline = time.monotonic() + self.wait
+
+            self.items.append((d, f))
+
+            if len(self.items) == 1 or len(self.items) >= self.size:
+                self.cond.notify()
+
+        return f
+
+    def dispatch(self) -> None:
+        # batches run one after the other, inputs that arrive in the meantime
+        # make up the next one
+        while True:
+            with self.cond:
+                while len(self.items) == 0:
+                    self.cond.wait()
+
+                while len(self.items) < self.size:
+                    remaining = self.deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                batch = self.items[: self.size]
+                self.items = self.items[self.size :]
+
+                # whatever is left has waited long enough already
+                self.deadline = time.monotonic()
+
+                self.batches += 1
+                self.batched += len(batch)
+
+            self.run(batch)
+
+    def run(
+        self,
+        batch: typing.List[
+            typing.Tuple[typing.Optional[str], concurrent.futures.Future]
+        ],
+    ) -> None:
+        try:
+            results = self.fn_batch([d for d, _ in batch])
+
+            if len(results) != len(batch):
+                raise Exception(
+                    f"fn_batch returned {len(results)} results for {len(batch)} inputs"
+                )
+        except Exception as e:
+            for _, f in batch:
+                f.set_exception(e)
+            return
+
+        # a failed input can have an exception in place of its result
+        for (_, f), r in zip(batch, results):
+            if isinstance(r, Exception):
+                f.set_exception(r)
+            else:
+                f.set_result(r)
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        with self.cond:
+            return {
+                "queue_depth": len(self.items),
+                "max_size": self.size,
+                "max_wait": self.wait * 1000.0,
+                "batches": self.batches,
+                "items": self.batched,
+                "mean_size": self.batched / self.batches if self.batches > 0 else 0.0,
+            }
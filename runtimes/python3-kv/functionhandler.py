@@ -1,49 +1,759 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
 import typing
 import http.server
 
-if __name__ == "__main__":
+import handlerlib
+
+started = time.time()
+
+# connections from the reverse proxy are kept open for further requests until
+# they have been idle for HANDLER_KEEPALIVE_TIMEOUT seconds or have served
+# HANDLER_KEEPALIVE_REQUESTS requests
+keepalive_timeout = float(os.environ.get("HANDLER_KEEPALIVE_TIMEOUT", "60"))
+keepalive_requests = int(os.environ.get("HANDLER_KEEPALIVE_REQUESTS", "1000"))
+
+# with HANDLER_PROCESSES > 1, the handler forks that many worker processes that
+# share port 8000 with SO_REUSEPORT, so that CPU-bound functions are not
+# serialized by the GIL
+# each worker imports fn (and with it kv) on its own and is replaced by a
+# fresh one after it has served HANDLER_MAX_REQUESTS requests (0 for never),
+# plus a random amount of up to as many again so that workers are not all
+# replaced at the same time
+# the replacement takes over the listening socket of the old worker and
+# starts accepting connections once it is ready, only then the old worker
+# stops, so no connection is turned away
+# a worker that fails is restarted after a backoff that grows from
+# HANDLER_RESTART_BACKOFF seconds up to 30 seconds while it keeps failing
+processes = int(os.environ.get("HANDLER_PROCESSES", "1"))
+max_requests = int(os.environ.get("HANDLER_MAX_REQUESTS", "0"))
+restart_backoff = float(os.environ.get("HANDLER_RESTART_BACKOFF", "1"))
+restart_backoff_max = 30.0
+
+# at most HANDLER_MAX_IN_FLIGHT invocations run at the same time (0 for no
+# limit), up to HANDLER_MAX_QUEUE more wait for their turn for at most
+# HANDLER_QUEUE_TIMEOUT seconds (0 to wait indefinitely)
+# everything beyond that is rejected right away with a 503 and a Retry-After
+# of HANDLER_RETRY_AFTER seconds, so that admitted requests stay fast
+max_in_flight = int(os.environ.get("HANDLER_MAX_IN_FLIGHT", "0"))
+max_queue = int(os.environ.get("HANDLER_MAX_QUEUE", "0"))
+queue_timeout = float(os.environ.get("HANDLER_QUEUE_TIMEOUT", "0"))
+retry_after = os.environ.get("HANDLER_RETRY_AFTER", "1")
+
+# invocations with an X-tinyFaaS-Async header are acknowledged with a 202 right
+# away and run on HANDLER_ASYNC_WORKERS background threads, with up to
+# HANDLER_ASYNC_QUEUE more waiting
+# once they run, they take up a slot of HANDLER_MAX_IN_FLIGHT like any other
+# invocation
+# HANDLER_ASYNC_OVERFLOW decides what happens when the queue is full:
+#   "sync" (default): run the invocation like a synchronous one
+#   "reject": answer with a 503 and a Retry-After
+#   "drop-oldest": discard the invocation that has waited the longest
+async_workers = int(os.environ.get("HANDLER_ASYNC_WORKERS", "4"))
+async_queue = int(os.environ.get("HANDLER_ASYNC_QUEUE", "128"))
+async_overflow = os.environ.get("HANDLER_ASYNC_OVERFLOW", "sync")
+
+if async_overflow not in ("sync", "reject", "drop-oldest"):
+    raise Exception(f"unknown HANDLER_ASYNC_OVERFLOW {async_overflow}")
+
+# functions that define fn_batch(List[Optional[str]]) -> List[Optional[str]]
+# can have concurrent invocations collected into batches of up to
+# HANDLER_BATCH_SIZE inputs (0 for no batching), which wait at most
+# HANDLER_BATCH_WAIT milliseconds for the batch to fill up
+batch_size = int(os.environ.get("HANDLER_BATCH_SIZE", "0"))
+batch_wait = float(os.environ.get("HANDLER_BATCH_WAIT", "5")) / 1000.0
+
+# functions that define fn_stream get the request body in chunks of up to
+# HANDLER_CHUNK_SIZE bytes
+chunk_size = int(os.environ.get("HANDLER_CHUNK_SIZE", "65536"))
+
+
+def process_start() -> float:
+    """wall clock time at which the interpreter was started"""
+
+    # /proc has the start time in clock ticks since boot, which /proc/uptime
+    # lets us convert without losing precision
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+
+        return time.time() - uptime + ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return started
+
+
+# taken before any workers are forked, so they all share it
+interpreter_started = process_start()
+
+
+def run_worker(
+    slot: int,
+    ready: typing.Optional[typing.Any],
+    listener: typing.Optional[socket.socket] = None,
+    takeover: bool = False,
+) -> None:
+    # a worker and its replacement run in two slots of the readiness array,
+    # see run_prefork
+    index = slot % processes
+
+    # wall clock times of the startup steps, logged after the first request
+    timeline = {"interpreter": interpreter_started, "handler": started}
+    if ready is not None:
+        timeline["worker"] = time.time()
+
     try:
         import fn
     except ImportError:
         raise ImportError("Failed to import fn.py")
 
+    timeline["fn_import"] = time.time()
+
+    # functions that work on binary payloads can define
+    # fn_bytes(memoryview) -> bytes instead of fn(str) -> str, which skips
+    # decoding the request and encoding the response
+    fn_bytes = getattr(fn, "fn_bytes", None)
+
+    # functions that handle large payloads can define
+    # fn_stream(Iterator[bytes]) -> Iterable[bytes] that consumes the request
+    # body as it arrives and whose output is sent with chunked encoding as it
+    # is produced
+    fn_stream = getattr(fn, "fn_stream", None)
+
+    # kv connects to the middleware lazily, warm up the connection in the
+    # background so that /health only reports OK once it is ready
+    kv = sys.modules.get("kv")
+    warmup = kv is not None and os.environ.get("KV_WARMUP", "true") == "true"
+
+    if warmup:
+        kv.warmup()  # type: ignore
+
+    # expensive setup, e.g., loading a model, can go into an fn.init() that
+    # runs in the background before /health reports OK
+    init = getattr(fn, "init", None)
+
+    # and what it buffers, e.g., trace records, can be written out by an
+    # fn.shutdown() that runs after the worker has answered its last request,
+    # workers exit without running atexit handlers
+    shutdown = getattr(fn, "shutdown", None)
+
+    # number of requests served, whether the worker has asked to be replaced,
+    # whether it is about to stop, whether init has run and whether the
+    # startup timeline has been logged
+    state = {
+        "served": 0,
+        "replacing": False,
+        "draining": False,
+        "initialized": False,
+        "logged": False,
+    }
+    limit = max_requests + random.randint(0, max_requests)
+    state_lock = threading.Lock()
+
+    # open connections and whether they are waiting for their next request
+    connections: typing.Dict[typing.Any, bool] = {}
+
+    admission = handlerlib.Admission(max_in_flight, max_queue, queue_timeout)
+    async_pool = handlerlib.AsyncPool(async_workers, async_queue, async_overflow)
+
+    batcher = None
+    if batch_size > 0 and hasattr(fn, "fn_batch"):
+        batcher = handlerlib.Batcher(fn.fn_batch, batch_size, batch_wait)
+
+    def worker_ready() -> bool:
+        return state["initialized"] and (not warmup or kv.ready())  # type: ignore
+
+    def health() -> typing.Tuple[bool, str]:
+        if ready is None:
+            if not state["initialized"]:
+                return False, "init not done"
+
+            if not worker_ready():
+                return False, "kv not ready"
+
+            return True, "OK"
+
+        # only healthy if every worker, or its replacement, is
+        n = sum(1 for i in range(processes) if ready[i] or ready[i + processes])
+        if n < processes:
+            return False, f"{n}/{processes} workers ready"
+
+        return True, "OK"
+
+    def startup() -> typing.Dict[str, typing.Any]:
+        events = dict(timeline)
+        if kv is not None:
+            events.update(kv.timeline())
+
+        # milliseconds since the interpreter started, in order
+        t0 = events["interpreter"]
+        return {
+            "worker": index,
+            "pid": os.getpid(),
+            "timeline": {
+                k: round((t - t0) * 1000, 3)
+                for k, t in sorted(events.items(), key=lambda e: e[1])
+            },
+        }
+
+    def first_request(done: bool) -> None:
+        if state["logged"]:
+            return
+
+        if not done:
+            timeline.setdefault("first_request", time.time())
+            return
+
+        with state_lock:
+            if state["logged"]:
+                return
+            state["logged"] = True
+
+        timeline["first_response"] = time.time()
+        print(f"STARTUP;{json.dumps(startup())}")
+
+    def call(body: memoryview) -> bytes:
+        if fn_bytes is not None:
+            res = fn_bytes(body)
+        else:
+            d: typing.Optional[str] = str(body, "utf-8")
+            if d == "":
+                d = None
+
+            if batcher is not None:
+                r = batcher.submit(d).result()
+            else:
+                r = fn.fn(d)
+
+            res = r.encode("utf-8") if r is not None else b""
+
+        # make sure writes buffered by kv reach FReD before the caller sees
+        # the response, if the function asked for that
+        if kv is not None:
+            kv.flush_on_response()
+
+        return res if res is not None else b""
+
     # create a webserver at port 8080 and execute fn.fn for every request
     class tinyFaaSFNHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        timeout = keepalive_timeout
+
+        def setup(self) -> None:
+            super().setup()
+            self.requests_served = 0
+
+            # a new connection was opened for a request that is on its way,
+            # it only counts as idle once that has been answered
+            with state_lock:
+                connections[self] = False
+
+        def finish(self) -> None:
+            with state_lock:
+                connections.pop(self, None)
+
+            super().finish()
+
+        def parse_request(self) -> bool:
+            # a request has arrived, the connection is busy until it is done
+            with state_lock:
+                connections[self] = False
+
+            return super().parse_request()
+
+        def handle_one_request(self) -> None:
+            super().handle_one_request()
+
+            with state_lock:
+                if self in connections:
+                    connections[self] = True
+
+        def respond(
+            self,
+            status: int,
+            body: bytes = b"",
+            headers: typing.Optional[typing.Dict[str, str]] = None,
+            close: bool = False,
+        ) -> None:
+            self.send_response(status)
+
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+
+            # every response is framed, so the connection can be reused
+            self.send_header("Content-Length", str(len(body)))
+            self.finish_headers(close)
+            self.wfile.write(body)
+
+        def finish_headers(self, close: bool = False) -> None:
+            self.requests_served += 1
+            if (
+                close
+                or self.requests_served >= keepalive_requests
+                or state["draining"]
+            ):
+                self.send_header("Connection", "close")
+                self.close_connection = True
+
+            # tell the reverse proxy whether async invocations can be rejected,
+            # it only waits for the acknowledgement of handlers that may
+            # reject them
+            if self.headers.get("X-tinyFaaS-Async", "").lower() == "true":
+                self.send_header("X-tinyFaaS-Async-Overflow", async_overflow)
+
+            self.end_headers()
+
         def do_GET(self) -> None:
             if self.path == "/health":
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write("OK".encode("utf-8"))
+                ok, msg = health()
+
+                if not ok:
+                    self.respond(503, msg.encode("utf-8"))
+                    print(f"reporting health: {msg}")
+                    return
+
+                self.respond(200, msg.encode("utf-8"))
                 print("reporting health: OK")
                 return
 
+            if self.path == "/metrics":
+                metrics = {
+                    "handler": admission.stats(),
+                    "async": async_pool.stats(),
+                    "startup": startup(),
+                }
+                if batcher is not None:
+                    metrics["batch"] = batcher.stats()
+                if kv is not None:
+                    metrics["kv"] = kv.stats()
+
+                self.respond(
+                    200,
+                    json.dumps(metrics).encode("utf-8"),
+                    {"Content-Type": "application/json"},
+                )
+                return
+
             self.log_error(f"GET request to unknown path {self.path}")
-            self.send_response(404)
-            self.end_headers()
+            self.respond(404)
             return
 
         def do_POST(self) -> None:
-            d: typing.Optional[str] = self.rfile.read(
-                int(self.headers["Content-Length"])
-            ).decode("utf-8")
-            if d == "":
-                d = None
+            first_request(False)
+
+            body = None
+
+            # streaming functions are always invoked synchronously
+            async_header = self.headers.get("X-tinyFaaS-Async", "").lower() == "true"
+            if async_header and fn_stream is None:
+                body = handlerlib.read_body(self.rfile, self.headers, chunk_size)
+
+                if async_pool.submit(lambda: self.call_async(body)):  # type: ignore
+                    self.respond(202)
+                    self.served()
+                    first_request(True)
+                    return
+
+                if async_overflow == "reject":
+                    self.respond(503, b"overloaded", {"Retry-After": retry_after})
+                    self.served()
+                    return
+
+            if not admission.acquire():
+                # the body is not read, so the connection can't be reused
+                self.respond(
+                    503,
+                    b"overloaded",
+                    {"Retry-After": retry_after},
+                    close=True,
+                )
+                self.served()
+                return
+
+            try:
+                self.invoke(body)
+            finally:
+                admission.release()
+                self.served()
+                first_request(True)
+
+        def invoke_stream(self) -> None:
+            body = handlerlib.body_chunks(self.rfile, self.headers, chunk_size)
+
+            try:
+                out = iter(fn_stream(body))  # type: ignore
+                # errors before the first chunk can still be reported
+                first = next(out, None)
+            except Exception as e:
+                self.log_error(str(e))
+                self.respond(500, str(e).encode("utf-8"), close=True)
+                return
+
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.finish_headers()
+
             try:
-                res = fn.fn(d)
-                self.send_response(200)
-                self.end_headers()
-                if res is not None:
-                    self.wfile.write(res.encode("utf-8"))
+                chunk = first
+                while chunk is not None:
+                    if len(chunk) > 0:
+                        self.wfile.write(
+                            b"".join((b"%x\r\n" % len(chunk), chunk, b"\r\n"))
+                        )
+                    chunk = next(out, None)
+
+                # the rest of the request has to be read before the
+                # connection can be used for the next one
+                for _ in body:
+                    pass
+
+                if kv is not None:
+                    kv.flush_on_response()
+            except Exception as e:
+                # the status is already out, leaving out the last chunk tells
+                # the client that the response is incomplete
+                self.log_error(str(e))
+                self.close_connection = True
+                return
+
+            self.wfile.write(b"0\r\n\r\n")
+
+        def invoke(self, body: typing.Optional[memoryview] = None) -> None:
+            if fn_stream is not None:
+                self.invoke_stream()
+                return
+
+            if body is None:
+                body = handlerlib.read_body(self.rfile, self.headers, chunk_size)
 
+            try:
+                self.respond(200, call(body))
                 return
             except Exception as e:
                 self.log_error(str(e))
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(str(e).encode("utf-8"))
+                self.respond(500, str(e).encode("utf-8"))
+                return
+
+        def call_async(self, body: memoryview) -> None:
+            # async invocations count towards HANDLER_MAX_IN_FLIGHT like all
+            # others, they were accepted already so they wait as long as needed
+            admission.acquire(wait=True)
+
+            # nobody waits for the result
+            try:
+                call(body)
+            except Exception as e:
+                self.log_error(f"async invocation failed: {e}")
+            finally:
+                admission.release()
+
+        def served(self) -> None:
+            # only prefork workers are recycled, a single process has nobody
+            # to take over its connections
+            if max_requests <= 0 or ready is None:
+                return
+
+            with state_lock:
+                state["served"] += 1
+
+                if state["served"] < limit or state["replacing"]:
+                    return
+
+                state["replacing"] = True
+
+                # keep serving until the supervisor has a replacement ready
+                # and stops this worker, see start for one that isn't ready
+                if ready[slot] != 0:
+                    ready[slot] = 2
+
+            print(f"worker {index} served {limit} requests, recycling")
+
+    def stop(httpd: http.server.HTTPServer) -> None:
+        with state_lock:
+            state["draining"] = True
+
+        httpd.shutdown()
+
+        # connections that wait for their next request would keep the worker
+        # around until they time out, the others close after their response
+        closed = set()
+
+        while True:
+            with state_lock:
+                if len(connections) == 0:
+                    return
+
+                idle = [
+                    h
+                    for h, waiting in connections.items()
+                    if waiting and h not in closed
+                ]
+
+            for h in idle:
+                closed.add(h)
+                try:
+                    h.connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+            time.sleep(0.05)
+
+    class tinyFaaSServer(http.server.ThreadingHTTPServer):
+        # wait for requests in flight when the worker stops
+        daemon_threads = False
+        request_queue_size = socket.SOMAXCONN
+
+        def server_bind(self) -> None:
+            if listener is None:
+                super().server_bind()
                 return
 
-    with http.server.ThreadingHTTPServer(("", 8000), tinyFaaSFNHandler) as httpd:
+            # prefork workers accept on a socket that the supervisor created
+            # and keeps open, connections that queue up on it while one
+            # worker stops are accepted by the next
+            self.socket.close()
+            self.socket = listener
+            self.server_address = listener.getsockname()
+            self.server_name, self.server_port = self.server_address[:2]
+
+        def server_activate(self) -> None:
+            if listener is None:
+                super().server_activate()
+
+    def start() -> None:
+        if init is not None:
+            try:
+                init()
+            except Exception as e:
+                print(f"fn.init failed: {e}")
+                sys.stdout.flush()
+                os._exit(1)
+
+            timeline["init"] = time.time()
+
+        with state_lock:
+            state["initialized"] = True
+
+        while not worker_ready():
+            time.sleep(0.05)
+
+        timeline["ready"] = time.time()
+        if ready is not None:
+            with state_lock:
+                ready[slot] = 2 if state["replacing"] else 1
+
+    starting = threading.Thread(target=start, daemon=True)
+    starting.start()
+
+    # a replacement shares its listening socket with the worker it replaces,
+    # or with the one that failed before it, and only accepts connections
+    # once it can handle them
+    if takeover:
+        starting.join()
+
+    with tinyFaaSServer(("", 8000), tinyFaaSFNHandler) as httpd:
+        # stop gracefully, so that requests in flight are answered and writes
+        # buffered in kv are flushed
+        def terminate(signum: int, frame: typing.Any) -> None:
+            threading.Thread(target=stop, args=(httpd,)).start()
+
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, terminate)
+
         httpd.serve_forever()
+
+    if ready is not None:
+        ready[slot] = 0
+
+    async_pool.close()
+
+    if shutdown is not None:
+        try:
+            shutdown()
+        except Exception as e:
+            print(f"fn.shutdown failed: {e}")
+
+    if kv is not None:
+        kv.flush()
+
+
+def run_prefork() -> None:
+    import multiprocessing
+
+    # every worker has a slot in the readiness array that is shared with all
+    # of them for /health, and the worker that replaces it uses the other
+    # slot for the same index (index + processes)
+    # 0: not ready, 1: ready, 2: ready but asks to be replaced
+    ready = multiprocessing.RawArray("b", 2 * processes)
+
+    # one listening socket per index, a worker and its replacement share it
+    def listen() -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", 8000))
+        sock.listen(socket.SOMAXCONN)
+        return sock
+
+    listeners = [listen() for _ in range(processes)]
+
+    # pid of the worker in each slot, 0 if there is none
+    pids = [0] * (2 * processes)
+    # slot of the worker that serves each index, its replacement uses the other
+    active = list(range(processes))
+    # workers that have been asked to stop
+    stopped: typing.Set[int] = set()
+    # restarts of failing workers are delayed: index -> (backoff, not before),
+    # until the last worker started for the index is ready
+    backoff = [(0.0, 0.0)] * processes
+    last = list(range(processes))
+
+    def other(slot: int) -> int:
+        return (slot + processes) % (2 * processes)
+
+    def spawn(slot: int, takeover: bool) -> None:
+        index = slot % processes
+        pid = os.fork()
+
+        if pid == 0:
+            # the parent's handlers are not the worker's, it sets up its own
+            # once it serves
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            for i, sock in enumerate(listeners):
+                if i != index:
+                    sock.close()
+
+            code = 0
+            try:
+                run_worker(slot, ready, listeners[index], takeover)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException as e:
+                print(f"worker {index} failed: {e}")
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+
+        pids[slot] = pid
+        last[index] = slot
+
+    def terminate(slot: int) -> None:
+        stopped.add(pids[slot])
+
+        try:
+            os.kill(pids[slot], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    stopping = False
+
+    def stop(signum: int, frame: typing.Any) -> None:
+        nonlocal stopping
+        stopping = True
+
+        for slot, pid in enumerate(pids):
+            if pid != 0:
+                terminate(slot)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(processes):
+        spawn(i, False)
+
+    while True:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+
+            if pid == 0:
+                break
+
+            if pid not in pids:
+                continue
+
+            slot = pids.index(pid)
+            index = slot % processes
+            pids[slot] = 0
+            ready[slot] = 0
+
+            if stopping or pid in stopped:
+                stopped.discard(pid)
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+
+            # don't spin if a worker keeps failing, e.g., because fn is broken,
+            # but keep handling the other workers in the meantime
+            delay = 0.0
+            if code != 0:
+                delay = max(backoff[index][0] * 2, restart_backoff)
+                delay = min(delay, restart_backoff_max)
+
+            backoff[index] = (delay, time.monotonic() + delay)
+
+            print(
+                f"worker {index} exited with status {code}, "
+                f"starting a new one in {delay:.1f}s"
+            )
+
+            # the replacement, if there is one, takes over right away
+            if slot == active[index] and pids[other(slot)] != 0:
+                active[index] = other(slot)
+
+        # workers finish their requests before they exit, the container
+        # would kill them if we went first
+        if stopping:
+            if all(pid == 0 for pid in pids):
+                sys.exit(0)
+
+            time.sleep(0.05)
+            continue
+
+        now = time.monotonic()
+
+        for i in range(processes):
+            a = active[i]
+            b = other(a)
+
+            if ready[last[i]] != 0:
+                backoff[i] = (0.0, 0.0)
+
+            if now < backoff[i][1]:
+                continue
+
+            if pids[a] == 0 and pids[b] == 0:
+                # the worker is gone, connections wait on its socket for the
+                # next one
+                spawn(a, True)
+            elif pids[a] != 0 and ready[a] == 2 and pids[b] == 0:
+                spawn(b, True)
+            elif pids[a] != 0 and pids[b] != 0 and ready[b] != 0:
+                # the replacement is ready, the old worker can go
+                active[i] = b
+                if pids[a] not in stopped:
+                    terminate(a)
+
+        time.sleep(0.05)
+
+
+if __name__ == "__main__":
+    if processes > 1:
+        run_prefork()
+    else:
+        run_worker(0, None)
@@ -1,10 +1,42 @@
+from __future__ import annotations
+
+import atexit
+import collections
+import importlib
+import math
 import os
+import random
+import socket
+import threading
+import time
 import typing
 
-import grpc
+if typing.TYPE_CHECKING:
+    import grpc
+
+    import fred.middleware_pb2 as fred
+    import fred.middleware_pb2_grpc as fred_grpc
+
+
+class _Lazy:
+    # stands in for a module that is only imported once it is used
+    # grpc and the protobuf descriptors make up most of the time it takes to
+    # import kv, this keeps them off the path to importing fn
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __getattr__(self, attr: str) -> typing.Any:
+        value = getattr(importlib.import_module(self._name), attr)
+
+        # later lookups find the attribute without coming through here
+        setattr(self, attr, value)
+        return value
 
-import fred.middleware_pb2 as fred
-import fred.middleware_pb2_grpc as fred_grpc
+
+if not typing.TYPE_CHECKING:
+    grpc = _Lazy("grpc")
+    fred = _Lazy("fred.middleware_pb2")
+    fred_grpc = _Lazy("fred.middleware_pb2_grpc")
 
 
 __keygroup = os.environ.get("__KV_KEYGROUP")
@@ -20,71 +52,1340 @@ if __host is None:
 if __node is None:
     raise Exception("missing __KV_NODE")
 
-# set up connection to middleware
+# optional read cache in front of read() and scan()
+# disabled unless KV_CACHE_SIZE is set to a positive number of entries
+# entries are served for KV_CACHE_TTL milliseconds before going back to FReD
+__cache_size = int(os.environ.get("KV_CACHE_SIZE", "0"))
+__cache_ttl = float(os.environ.get("KV_CACHE_TTL", "500")) / 1000.0
 
-__channel = grpc.insecure_channel(__host)
-__client = fred_grpc.MiddlewareStub(__channel)
+# read cache: key -> (expiry, values, versions)
+__read_cache: "collections.OrderedDict[str, typing.Any]" = collections.OrderedDict()
+# scan cache: (key, count) -> (expiry, values)
+__scan_cache: "collections.OrderedDict[typing.Any, typing.Any]" = (
+    collections.OrderedDict()
+)
+__cache_lock = threading.Lock()
+# bumped on every invalidation so that reads racing with a write do not
+# put the old value back into the cache
+__cache_gen = 0
+__cache_hits = 0
+__cache_misses = 0
 
-# let the middleware know which node we would like to use
-cr = fred.ChooseReplicaRequest()
-cr.keygroup = __keygroup
-cr.nodeId = __node
+# maximum number of requests that read_many() and update_many() keep in flight
+# on the channel at the same time
+__batch_in_flight = int(os.environ.get("KV_BATCH_IN_FLIGHT", "16"))
 
-try:
-    __client.ChooseReplica(cr)
-except Exception as e:
-    print("failed to choose replica")
-    print(e)
-    raise e
+# optional write-behind buffer for update() and delete()
+# KV_WRITE_BEHIND selects when buffered writes are sent to FReD:
+#   "off" (default): every write is sent immediately
+#   "async": a background thread flushes every KV_FLUSH_INTERVAL milliseconds
+#   "response": like "async", but the function handler also flushes before it
+#     sends the response
+#   "explicit": writes are only sent on kv.flush() or when the buffer is full
+# repeated writes to the same key between two flushes are coalesced, and at
+# most KV_WRITE_BUFFER_SIZE keys are buffered, a writer that fills the buffer
+# waits for it to be flushed
+# writes that fail to flush stay buffered, and count against the buffer size,
+# until a later flush sends them
+# update() and delete() only raise if they could not buffer their write, i.e.,
+# the buffer is full of writes that FReD does not take, errors flushing the
+# writes that they did buffer are only logged
+__write_behind = os.environ.get("KV_WRITE_BEHIND", "off")
+__flush_interval = float(os.environ.get("KV_FLUSH_INTERVAL", "100")) / 1000.0
+__write_buffer_size = int(os.environ.get("KV_WRITE_BUFFER_SIZE", "1024"))
 
+if __write_behind not in ("off", "async", "response", "explicit"):
+    raise Exception(f"unknown KV_WRITE_BEHIND mode {__write_behind}")
 
-def read(key: str) -> typing.List[str]:
+# buffered writes: key -> value, or None for a delete
+__pending: "collections.OrderedDict[str, typing.Optional[str]]" = (
+    collections.OrderedDict()
+)
+# the batch that is currently being flushed, still visible to reads
+__flushing: typing.Dict[str, typing.Optional[str]] = {}
+__pending_lock = threading.Lock()
+__flush_lock = threading.Lock()
+
+# the connection to the middleware is set up lazily on first use, or ahead of
+# time in the background with warmup()
+# choosing the replica is retried up to KV_CONNECT_RETRIES times with
+# exponential backoff (starting at KV_CONNECT_BACKOFF milliseconds) and jitter
+# warmup() keeps going in rounds of these retries, with pauses between rounds
+# that grow the same way up to 30 seconds, so that a middleware that is down
+# for a while is not flooded with attempts
+__connect_retries = int(os.environ.get("KV_CONNECT_RETRIES", "10"))
+__connect_backoff = float(os.environ.get("KV_CONNECT_BACKOFF", "100")) / 1000.0
+__connect_backoff_max = 5.0
+__warmup_backoff_max = 30.0
+
+# optional replica-aware routing
+# with KV_ROUTING=latency, kv discovers all replicas of the keygroup, measures
+# the round trip time to each of them every KV_PROBE_INTERVAL milliseconds and
+# asks the middleware to use the fastest one
+# only replicas of the keygroup are candidates, so writes always go to a node
+# that holds the keygroup
+# when a request fails because the replica is unavailable, that replica is
+# skipped for one probe interval and the request is retried on the next best
+__routing = os.environ.get("KV_ROUTING", "off")
+__probe_interval = float(os.environ.get("KV_PROBE_INTERVAL", "10000")) / 1000.0
+__probe_timeout = 1.0
+
+if __routing not in ("off", "latency"):
+    raise Exception(f"unknown KV_ROUTING mode {__routing}")
+
+# node currently chosen at the middleware
+__replica = __node
+# replicas of the keygroup: node id -> host
+__replicas: typing.Dict[str, str] = {}
+# last measured round trip time in seconds: node id -> rtt
+__rtt: typing.Dict[str, float] = {}
+# replicas that failed a request: node id -> time until they are skipped
+__unhealthy: typing.Dict[str, float] = {}
+__routing_lock = threading.Lock()
+
+# errors that mean the replica (rather than the request) is at fault
+__failover_codes = ("UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL")
+
+# optional read-your-writes session consistency
+# with KV_SESSION=true, kv remembers a lower bound for the version of every key
+# this function instance has written or read, and only accepts reads that
+# include it
+# stale reads are retried up to KV_SESSION_RETRIES times, on another replica
+# if routing is enabled
+# the first write to a key that has not been read yet costs an extra read to
+# learn the version it created, update_many() and flush() pipeline these reads
+__session_enabled = os.environ.get("KV_SESSION", "false") == "true"
+__session_retries = int(os.environ.get("KV_SESSION_RETRIES", "5"))
+__session_backoff = 0.01
+__session_size = int(os.environ.get("KV_SESSION_SIZE", "10000"))
+
+# required version per key: key -> version vector
+__session: "collections.OrderedDict[str, typing.Dict[str, int]]" = (
+    collections.OrderedDict()
+)
+__session_lock = threading.Lock()
+
+__channel: typing.Optional[grpc.Channel] = None
+__client: typing.Optional[fred_grpc.MiddlewareStub] = None
+__connect_lock = threading.Lock()
+
+# wall clock times of the connection setup steps, for cold start profiling
+__timeline: typing.Dict[str, float] = {}
+
+
+class _Histogram:
+    # log-linear buckets in the style of HdrHistogram: every power of two is
+    # split into 2**_SUB_BITS buckets, so that values are recorded with a
+    # relative error of about 3% in constant memory
+    _SUB_BITS = 5
+
+    def __init__(self) -> None:
+        self.buckets: typing.Dict[typing.Tuple[int, int], int] = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        shift = max(0, value.bit_length() - self._SUB_BITS - 1)
+        bucket = (shift, value >> shift)
+
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> int:
+        # highest value in the bucket that holds the p-th percentile
+        if self.count == 0:
+            return 0
+
+        seen = 0
+
+        for shift, mantissa in sorted(self.buckets):
+            seen += self.buckets[(shift, mantissa)]
+
+            if seen >= p / 100.0 * self.count:
+                return min(((mantissa + 1) << shift) - 1, self.max)
+
+        return self.max
+
+
+# per keygroup and operation: latency histograms in microseconds
+__latency: typing.Dict[str, typing.Dict[str, _Histogram]] = {}
+__bytes_sent = 0
+__bytes_received = 0
+# failed rpcs by grpc status code
+__errors: typing.Dict[str, int] = {}
+# retries by reason
+__retries: typing.Dict[str, int] = {}
+__stats_lock = threading.Lock()
+
+
+def _record(
+    method: str,
+    request: typing.Any,
+    start: float,
+    response: typing.Any,
+    code: typing.Optional[grpc.StatusCode],
+) -> None:
+    global __bytes_sent, __bytes_received
+
+    op = method.rsplit("/", 1)[-1]
+    keygroup = getattr(request, "keygroup", "") or "-"
+    latency = int((time.perf_counter() - start) * 1_000_000)
+
+    with __stats_lock:
+        h = __latency.setdefault(keygroup, {}).setdefault(op, _Histogram())
+        h.record(latency)
+
+        __bytes_sent += request.ByteSize()
+
+        if response is not None:
+            __bytes_received += response.ByteSize()
+
+        if code is not None and code != grpc.StatusCode.OK:
+            __errors[code.name] = __errors.get(code.name, 0) + 1
+
+
+def _count_retry(reason: str) -> None:
+    with __stats_lock:
+        __retries[reason] = __retries.get(reason, 0) + 1
+
+
+def _stats_interceptor() -> grpc.UnaryUnaryClientInterceptor:
+    # the base class comes from grpc, so this is only defined once we connect
+    class _StatsInterceptor(grpc.UnaryUnaryClientInterceptor):  # type: ignore
+        # sees every call on the channel, including futures
+        def intercept_unary_unary(
+            self,
+            continuation: typing.Callable[..., typing.Any],
+            client_call_details: grpc.ClientCallDetails,
+            request: typing.Any,
+        ) -> typing.Any:
+            start = time.perf_counter()
+            outcome = continuation(client_call_details, request)
+
+            def done(f: typing.Any) -> None:
+                try:
+                    response = f.result() if f.code() == grpc.StatusCode.OK else None
+                    _record(
+                        client_call_details.method, request, start, response, f.code()
+                    )
+                except Exception as e:
+                    print("failed to record kv stats")
+                    print(e)
+
+            outcome.add_done_callback(done)
+
+            return outcome
+
+    return _StatsInterceptor()
+
+
+def stats() -> typing.Dict[str, typing.Any]:
+    """latency percentiles (in milliseconds) and counters of all kv calls"""
+
+    with __stats_lock:
+        latency = {
+            keygroup: {
+                op: {
+                    "count": h.count,
+                    "mean": h.total / h.count / 1000.0 if h.count > 0 else 0.0,
+                    "p50": h.percentile(50) / 1000.0,
+                    "p90": h.percentile(90) / 1000.0,
+                    "p99": h.percentile(99) / 1000.0,
+                    "max": h.max / 1000.0,
+                }
+                for op, h in ops.items()
+            }
+            for keygroup, ops in __latency.items()
+        }
+
+        s = {
+            "latency": latency,
+            "bytes_sent": __bytes_sent,
+            "bytes_received": __bytes_received,
+            "errors": dict(__errors),
+            "retries": dict(__retries),
+        }
+
+    s["cache"] = cache_stats()
+
+    return s
+
+
+def _connect_once() -> None:
+    # one attempt at setting up the connection, the lock is only held for the
+    # attempt itself, never while waiting to retry
+    global __channel, __client
+
+    with __connect_lock:
+        if __client is not None:
+            return
+
+        channel = grpc.intercept_channel(
+            grpc.insecure_channel(__host), _stats_interceptor()
+        )
+        client = fred_grpc.MiddlewareStub(channel)
+        __timeline.setdefault("kv_channel", time.time())
+
+        # let the middleware know which node we would like to use
+        cr = fred.ChooseReplicaRequest()
+        cr.keygroup = __keygroup
+        cr.nodeId = __node
+
+        try:
+            client.ChooseReplica(cr)
+        except Exception:
+            channel.close()
+            raise
+
+        __timeline.setdefault("kv_choose_replica", time.time())
+
+        __channel = channel
+        __client = client
+
+    if __routing == "latency":
+        threading.Thread(target=_prober, daemon=True).start()
+
+
+def _connect_retrying(log: bool) -> None:
+    backoff = __connect_backoff
+
+    for attempt in range(__connect_retries + 1):
+        try:
+            _connect_once()
+            return
+        except Exception as e:
+            if attempt == __connect_retries:
+                raise e
+
+            if log:
+                print(f"failed to choose replica (attempt {attempt + 1}), retrying")
+
+            _count_retry("connect")
+            time.sleep(random.uniform(0, backoff))
+            backoff = min(backoff * 2, __connect_backoff_max)
+
+
+def connect() -> None:
+    """set up the connection to the middleware, does nothing if it exists"""
+
+    try:
+        _connect_retrying(True)
+    except Exception as e:
+        print("failed to choose replica")
+        print(e)
+        raise e
+
+
+def timeline() -> typing.Dict[str, float]:
+    """wall clock times at which the channel was set up and the replica chosen"""
+
+    return dict(__timeline)
+
+
+def ready() -> bool:
+    """true once the connection to the middleware is set up"""
+
+    return __client is not None
+
+
+def warmup() -> None:
+    """connect to the middleware in a background thread until it succeeds"""
+
+    def _warmup() -> None:
+        pause = __connect_backoff
+        rounds = 0
+
+        while True:
+            try:
+                _connect_retrying(False)
+                return
+            except Exception as e:
+                rounds += 1
+                print(
+                    f"failed to choose replica in {rounds} rounds of retries, "
+                    f"next round in {pause:.1f}s: {e}"
+                )
+
+            _count_retry("warmup")
+            time.sleep(random.uniform(pause / 2, pause))
+            pause = min(pause * 2, __warmup_backoff_max)
+
+    threading.Thread(target=_warmup, daemon=True).start()
+
+
+def _client() -> fred_grpc.MiddlewareStub:
+    if __client is None:
+        connect()
+
+    return __client  # type: ignore
+
+
+def _probe(host: str) -> float:
+    # a tcp handshake is the cheapest round trip we can make to a replica
+    h, p = host.rsplit(":", 1)
+
+    start = time.perf_counter()
+
+    try:
+        with socket.create_connection((h, int(p)), timeout=__probe_timeout):
+            pass
+    except OSError:
+        return math.inf
+
+    return time.perf_counter() - start
+
+
+def _choose_replica(node: str) -> None:
+    global __replica
+
+    cr = fred.ChooseReplicaRequest()
+    cr.keygroup = __keygroup
+    cr.nodeId = node
+
+    _client().ChooseReplica(cr)
+
+    if node != __replica:
+        print(f"switched from replica {__replica} to {node}")
+
+    __replica = node
+
+
+def _best_replica() -> typing.Optional[str]:
+    now = time.monotonic()
+
+    with __routing_lock:
+        candidates = [
+            n
+            for n, rtt in __rtt.items()
+            if rtt != math.inf and __unhealthy.get(n, 0) <= now
+        ]
+
+        if len(candidates) == 0:
+            return None
+
+        # prefer the configured node if it is just as fast
+        return min(candidates, key=lambda n: (__rtt[n], n != __node))
+
+
+def _route() -> None:
+    global __replicas, __rtt
+
+    r = fred.GetKeygroupInfoRequest()
+    r.keygroup = __keygroup
+
+    info = _client().GetKeygroupInfo(r)
+
+    replicas = {replica.nodeId: replica.host for replica in info.replica}
+    rtt = {n: _probe(h) for n, h in replicas.items()}
+
+    with __routing_lock:
+        __replicas = replicas
+        __rtt = rtt
+        current = rtt.get(__replica, math.inf)
+        current_healthy = __unhealthy.get(__replica, 0) <= time.monotonic()
+
+    best = _best_replica()
+
+    if best is None or best == __replica:
+        return
+
+    # do not flap between replicas that are about equally fast
+    if current_healthy and rtt[best] > 0.8 * current:
+        return
+
+    _choose_replica(best)
+
+
+def _prober() -> None:
+    while True:
+        try:
+            _route()
+        except Exception as e:
+            print("failed to probe replicas")
+            print(e)
+
+        time.sleep(__probe_interval)
+
+
+def _replica_failed(e: typing.Any) -> bool:
+    # whether the replica (rather than the request) is at fault
+    if not isinstance(e, grpc.RpcError):
+        return False
+
+    return e.code().name in __failover_codes  # type: ignore
+
+
+def _failover(e: Exception) -> bool:
+    # returns true if we switched to another replica and should retry
+    if __routing == "off" or not _replica_failed(e):
+        return False
+
+    with __routing_lock:
+        __unhealthy[__replica] = time.monotonic() + __probe_interval
+
+    best = _best_replica()
+
+    if best is None or best == __replica:
+        return False
+
+    try:
+        _choose_replica(best)
+    except Exception as err:
+        print(f"failed to fail over to replica {best}")
+        print(err)
+        return False
+
+    return True
+
+
+_T = typing.TypeVar("_T")
+
+
+def _call(f: typing.Callable[[], _T]) -> _T:
+    try:
+        return f()
+    except Exception as e:
+        if not _failover(e):
+            raise e
+
+        _count_retry("failover")
+
+        return f()
+
+
+def _dominates(a: typing.Dict[str, int], b: typing.Dict[str, int]) -> bool:
+    # a dominates b if a has seen every write that b has seen, and more
+    if a == b:
+        return False
+
+    return all(a.get(n, 0) >= v for n, v in b.items())
+
+
+def _is_stale(
+    versions: typing.List[typing.Dict[str, int]],
+    cached: typing.List[typing.Dict[str, int]],
+) -> bool:
+    # a response is stale if every item in it is older than something we have
+    # already seen, e.g., because a lagging replica answered
+    if len(versions) == 0 or len(cached) == 0:
+        return False
+
+    return all(any(_dominates(c, v) for c in cached) for v in versions)
+
+
+def _cache_get(
+    cache: "collections.OrderedDict[typing.Any, typing.Any]", key: typing.Any
+) -> typing.Optional[typing.Tuple[typing.Any, ...]]:
+    # returns the entry without its expiry
+    global __cache_hits, __cache_misses
+
+    with __cache_lock:
+        entry = cache.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            __cache_misses += 1
+            return None
+
+        cache.move_to_end(key)
+        __cache_hits += 1
+        return (list(entry[1]),) + tuple(entry[2:])
+
+
+def _cache_put(
+    cache: "collections.OrderedDict[typing.Any, typing.Any]",
+    key: typing.Any,
+    entry: typing.Tuple[typing.Any, ...],
+) -> None:
+    # must hold __cache_lock
+    cache[key] = entry
+    cache.move_to_end(key)
+
+    while len(cache) > __cache_size:
+        cache.popitem(last=False)
+
+
+def _invalidate(key: str) -> None:
+    global __cache_gen
+
+    if __cache_size <= 0:
+        return
+
+    with __cache_lock:
+        __cache_gen += 1
+        __read_cache.pop(key, None)
+        # any scan could include this key
+        __scan_cache.clear()
+
+
+def invalidate(key: str) -> None:
+    """drop key from the read cache, for writes that did not go through kv"""
+
+    _invalidate(key)
+
+
+def cache_stats() -> typing.Dict[str, int]:
+    with __cache_lock:
+        return {
+            "hits": __cache_hits,
+            "misses": __cache_misses,
+            "size": len(__read_cache) + len(__scan_cache),
+        }
+
+
+def _read_request(key: str) -> fred.ReadRequest:
     r = fred.ReadRequest()
 
     r.keygroup = __keygroup
     r.id = key
 
-    data = __client.Read(r)
+    return r
+
+
+def _read_call(key: str) -> typing.Callable[[], typing.Any]:
+    return lambda: _client().Read.future(_read_request(key))
 
+
+def _read_response(
+    key: str, gen: int, data: fred.ReadResponse
+) -> typing.Tuple[typing.List[str], typing.List[typing.Dict[str, int]]]:
     values: typing.List[str] = []
+    versions: typing.List[typing.Dict[str, int]] = []
 
     for item in data.items:
         values.append(item.val)
+        versions.append(dict(item.version))
+
+    if __cache_size > 0:
+        with __cache_lock:
+            old = __read_cache.get(key)
+
+            if gen != __cache_gen:
+                return values, versions
+
+            # never go back in time: if the replica returned an older version
+            # than the one in our (expired) entry, keep serving what we have
+            if old is not None and _is_stale(versions, old[2]):
+                values, versions = list(old[1]), old[2]
+
+            _cache_put(
+                __read_cache,
+                key,
+                (time.monotonic() + __cache_ttl, list(values), versions),
+            )
+
+    return values, versions
+
+
+def _covers(
+    versions: typing.List[typing.Dict[str, int]], required: typing.Dict[str, int]
+) -> bool:
+    # the items of a response together include every write we require
+    return all(any(v.get(n, 0) >= c for v in versions) for n, c in required.items())
+
+
+def _session_ok(key: str, versions: typing.List[typing.Dict[str, int]]) -> bool:
+    if not __session_enabled:
+        return True
+
+    with __session_lock:
+        required = __session.get(key)
+
+    return required is None or _covers(versions, required)
+
+
+def _session_put(key: str, version: typing.Dict[str, int]) -> None:
+    # must hold __session_lock
+    __session[key] = version
+    __session.move_to_end(key)
+
+    while len(__session) > __session_size:
+        __session.popitem(last=False)
+
+
+def _session_observe(key: str, versions: typing.List[typing.Dict[str, int]]) -> None:
+    # never accept anything older than what we have seen once
+    if not __session_enabled or len(versions) == 0:
+        return
+
+    with __session_lock:
+        required = dict(__session.get(key, {}))
+
+        for v in versions:
+            for n, c in v.items():
+                required[n] = max(required.get(n, 0), c)
+
+        _session_put(key, required)
+
+
+def _session_bump(key: str) -> bool:
+    # FReD does not tell us the version of a write, but the replica we wrote
+    # to must have counted at least one more write than we have seen from it
+    # false if there is no version to count from
+    with __session_lock:
+        required = __session.get(key)
+
+        if required is None:
+            return False
+
+        required = dict(required)
+        required[__replica] = required.get(__replica, 0) + 1
+        _session_put(key, required)
+
+    return True
+
+
+def _session_write(key: str) -> None:
+    _session_write_many([key])
+
+
+def _session_unknown(keys: typing.Sequence[str]) -> typing.List[str]:
+    # records writes to keys, returns those whose version has to be read back
+    if not __session_enabled:
+        return []
+
+    return [k for k in keys if not _session_bump(k)]
+
+
+def _session_write_many(keys: typing.Sequence[str]) -> None:
+    # without a version to count from, any existing version would do, so ask
+    # the replica that took the writes which versions it has now, in one
+    # pipeline rather than one read after the other
+    unknown = _session_unknown(keys)
+
+    def done(i: int, data: fred.ReadResponse) -> None:
+        _session_observe(unknown[i], [dict(item.version) for item in data.items])
+
+    errors = _pipeline([_read_call(k) for k in unknown], done, __batch_in_flight)
+
+    for k, e in zip(unknown, errors):
+        if e is not None:
+            print(f"failed to read back the version of {k} after writing it")
+            print(e)
+
+
+def _session_forget(key: str) -> None:
+    if not __session_enabled:
+        return
+
+    with __session_lock:
+        __session.pop(key, None)
+
+
+def _session_retry() -> None:
+    # give replication some time, or ask another replica
+    if __routing != "off":
+        with __routing_lock:
+            others = [
+                n for n, rtt in __rtt.items() if n != __replica and rtt != math.inf
+            ]
+
+        if len(others) > 0:
+            try:
+                _choose_replica(min(others, key=lambda n: __rtt[n]))
+                return
+            except Exception as e:
+                print("failed to choose another replica for stale read")
+                print(e)
+
+    time.sleep(__session_backoff)
+
+
+def _merge_default(items: typing.List[typing.Tuple[str, typing.Dict[str, int]]]) -> str:
+    # drop versions that another version has superseded, then pick the same
+    # winner among the concurrent rest no matter in which order they arrived
+    latest = [
+        (value, version)
+        for value, version in items
+        if not any(_dominates(other, version) for _, other in items)
+    ]
+
+    return max(
+        latest,
+        key=lambda item: (sum(item[1].values()), sorted(item[1].items()), item[0]),
+    )[0]
+
+
+# resolves concurrent versions of a key in read_one()
+__merge: typing.Callable[
+    [typing.List[typing.Tuple[str, typing.Dict[str, int]]]], str
+] = _merge_default
+
+
+def set_merge(
+    merge: typing.Callable[[typing.List[typing.Tuple[str, typing.Dict[str, int]]]], str]
+) -> None:
+    """
+    set the function that read_one() uses to resolve concurrent versions of a
+    key, it gets a list of (value, version vector) and returns the value
+    """
+
+    global __merge
+
+    __merge = merge
+
+
+def _update_request(key: str, value: str) -> fred.UpdateRequest:
+    r = fred.UpdateRequest()
+
+    r.keygroup = __keygroup
+    r.id = key
+    r.data = value
+
+    return r
+
+
+def _delete_request(key: str) -> fred.DeleteRequest:
+    r = fred.DeleteRequest()
+
+    r.keygroup = __keygroup
+    r.id = key
+
+    return r
+
+
+def _pipeline(
+    calls: typing.Sequence[typing.Callable[[], typing.Any]],
+    done: typing.Callable[[int, typing.Any], typing.Any],
+    max_in_flight: int,
+) -> typing.List[typing.Any]:
+    # like _call, the calls that the replica failed are made once more if we
+    # switched to another replica
+    results = _pipeline_once(calls, done, max_in_flight)
+
+    failed = [i for i, r in enumerate(results) if _replica_failed(r)]
+
+    if len(failed) == 0 or not _failover(results[failed[0]]):
+        return results
+
+    _count_retry("failover")
+
+    retried = _pipeline_once(
+        [calls[i] for i in failed],
+        lambda j, r: done(failed[j], r),
+        max_in_flight,
+    )
+
+    for i, r in zip(failed, retried):
+        results[i] = r
+
+    return results
+
+
+def _pipeline_once(
+    calls: typing.Sequence[typing.Callable[[], typing.Any]],
+    done: typing.Callable[[int, typing.Any], typing.Any],
+    max_in_flight: int,
+) -> typing.List[typing.Any]:
+    # issue all calls as futures on the shared channel, but never have more
+    # than max_in_flight of them outstanding
+    # results are in the order of calls, errors are returned in place
+    results: typing.List[typing.Any] = [None] * len(calls)
+    in_flight: typing.Deque[typing.Tuple[int, typing.Any]] = collections.deque()
+
+    def collect() -> None:
+        i, f = in_flight.popleft()
+        try:
+            results[i] = done(i, f.result())
+        except Exception as e:
+            results[i] = e
+
+    for i, call in enumerate(calls):
+        if len(in_flight) >= max(max_in_flight, 1):
+            collect()
+
+        try:
+            in_flight.append((i, call()))
+        except Exception as e:
+            results[i] = e
+
+    while len(in_flight) > 0:
+        collect()
+
+    return results
+
+
+def _try_buffer(key: str, value: typing.Optional[str]) -> typing.Tuple[bool, bool]:
+    # returns whether the write was buffered and whether the buffer is full
+    # a key that is buffered already takes no extra room
+    with __pending_lock:
+        size = len(__pending) + len(__flushing)
+        buffered = key in __pending or key in __flushing or size < __write_buffer_size
+
+        if buffered:
+            __pending[key] = value
+            __pending.move_to_end(key)
+
+        full = len(__pending) + len(__flushing) >= __write_buffer_size
+
+    if buffered:
+        _invalidate(key)
+
+    return buffered, full
+
+
+def _buffer(key: str, value: typing.Optional[str]) -> None:
+    buffered, full = _try_buffer(key, value)
+
+    if not full:
+        return
+
+    # apply back pressure instead of growing without bound
+    try:
+        flush()
+    except Exception as e:
+        if not buffered:
+            raise Exception(f"kv write buffer is full, {key} was not written: {e}")
+
+        # the write is buffered and goes out with a later flush
+        print("failed to flush writes")
+        print(e)
+        return
+
+    if not buffered and not _try_buffer(key, value)[0]:
+        raise Exception(f"kv write buffer is full, {key} was not written")
+
+
+def _buffered(key: str) -> typing.Tuple[bool, typing.Optional[str]]:
+    with __pending_lock:
+        if key in __pending:
+            return True, __pending[key]
+
+        if key in __flushing:
+            return True, __flushing[key]
+
+    return False, None
+
+
+def _buffered_read(key: str) -> typing.Optional[typing.List[str]]:
+    # reads see the function's own buffered writes
+    if __write_behind == "off":
+        return None
+
+    found, value = _buffered(key)
+
+    if not found:
+        return None
+
+    if value is None:
+        raise Exception(f"key {key} not found")
+
+    return [value]
+
+
+def _write_call(
+    key: str, value: typing.Optional[str]
+) -> typing.Callable[[], typing.Any]:
+    # a buffered write as a call for _pipeline, None is a delete
+    if value is None:
+        return lambda: _client().Delete.future(_delete_request(key))
+
+    return lambda: _client().Update.future(_update_request(key, value))
+
+
+def flush() -> None:
+    """send all buffered writes to FReD"""
+
+    if __write_behind == "off":
+        return
+
+    global __flushing
+
+    with __flush_lock:
+        with __pending_lock:
+            if len(__pending) == 0:
+                return
+
+            __flushing = dict(__pending)
+            __pending.clear()
+
+        batch = list(__flushing.items())
+
+        def done(i: int, _: typing.Any) -> None:
+            k, v = batch[i]
+
+            if v is None:
+                _session_forget(k)
+
+        errors = _pipeline(
+            [_write_call(k, v) for k, v in batch], done, __batch_in_flight
+        )
+
+        _session_write_many(
+            [k for (k, v), e in zip(batch, errors) if e is None and v is not None]
+        )
+
+        with __pending_lock:
+            # put writes that failed back in front of the buffer so that the
+            # next flush tries again, unless the key has been written since
+            for (k, v), e in reversed(list(zip(batch, errors))):
+                if e is not None and k not in __pending:
+                    __pending[k] = v
+                    __pending.move_to_end(k, last=False)
+
+            __flushing = {}
+
+        for k, _ in batch:
+            _invalidate(k)
+
+    failed = [f"{k}: {e}" for (k, _), e in zip(batch, errors) if e is not None]
+
+    if len(failed) > 0:
+        raise Exception(f"failed to flush {len(failed)} writes: {', '.join(failed)}")
+
+
+def flush_on_response() -> None:
+    """called by the function handler before it sends a response"""
+
+    if __write_behind == "response":
+        flush()
+
+
+def _flusher() -> None:
+    while True:
+        time.sleep(__flush_interval)
+
+        try:
+            flush()
+        except Exception as e:
+            print("failed to flush writes")
+            print(e)
+
+
+def _flush_at_exit() -> None:
+    try:
+        flush()
+    except Exception as e:
+        print("failed to flush writes at exit")
+        print(e)
+
+
+if __write_behind in ("async", "response"):
+    threading.Thread(target=_flusher, daemon=True).start()
+
+if __write_behind != "off":
+    atexit.register(_flush_at_exit)
+
+
+def _cache_generation() -> int:
+    # a response is only cached if no write has happened since the request
+    return __cache_gen
+
+
+def _read_local(
+    key: str,
+) -> typing.Optional[
+    typing.Tuple[typing.List[str], typing.List[typing.Dict[str, int]]]
+]:
+    # our own latest write, or a cached value that is recent enough
+    buffered = _buffered_read(key)
+    if buffered is not None:
+        return buffered, [{}]
+
+    if __cache_size > 0:
+        cached = _cache_get(__read_cache, key)
+        if cached is not None and _session_ok(key, cached[1]):
+            return cached[0], cached[1]
+
+    return None
+
+
+def _read_items(
+    key: str,
+) -> typing.Tuple[typing.List[str], typing.List[typing.Dict[str, int]]]:
+    local = _read_local(key)
+    if local is not None:
+        return local
+
+    for attempt in range(__session_retries + 1):
+        gen = __cache_gen
+
+        data = _call(lambda: _client().Read(_read_request(key)))
+
+        values, versions = _read_response(key, gen, data)
+
+        if _session_ok(key, versions):
+            _session_observe(key, versions)
+            return values, versions
+
+        if attempt < __session_retries:
+            print(f"replica {__replica} returned a stale version of {key}, retrying")
+            _count_retry("session")
+            _session_retry()
+
+    raise Exception(
+        f"no replica returned a version of {key} that includes this session"
+    )
+
+
+def read(key: str) -> typing.List[str]:
+    return _read_items(key)[0]
+
+
+def read_one(key: str) -> str:
+    """
+    read a single value for key, concurrent versions are resolved with the
+    merge function (see set_merge())
+    """
+
+    values, versions = _read_items(key)
+
+    if len(values) == 0:
+        raise Exception(f"key {key} not found")
+
+    if len(values) == 1:
+        return values[0]
+
+    return __merge(list(zip(values, versions)))
+
+
+def _read_many_response(
+    key: str, gen: int, data: fred.ReadResponse
+) -> typing.List[str]:
+    values, versions = _read_response(key, gen, data)
+
+    if not _session_ok(key, versions):
+        # fall back to a single read that retries
+        return read(key)
+
+    _session_observe(key, versions)
 
     return values
 
 
-def scan(key: str, count: int) -> typing.List[str]:
+def read_many(
+    keys: typing.Sequence[str], max_in_flight: typing.Optional[int] = None
+) -> typing.List[typing.Union[typing.List[str], Exception]]:
+    """
+    read several keys at once, returns the values for each key in the order
+    of keys, or the exception if reading that key failed
+    """
+
+    results: typing.List[typing.Any] = [None] * len(keys)
+    missing: typing.List[int] = []
+
+    for i, key in enumerate(keys):
+        try:
+            buffered = _buffered_read(key)
+        except Exception as e:
+            buffered = e  # type: ignore
+
+        if buffered is not None:
+            results[i] = buffered
+            continue
+
+        if __cache_size > 0:
+            cached = _cache_get(__read_cache, key)
+            if cached is not None and _session_ok(key, cached[1]):
+                results[i] = cached[0]
+                continue
+
+        missing.append(i)
+
+    gen = __cache_gen
+
+    fetched = _pipeline(
+        [_read_call(keys[i]) for i in missing],
+        lambda j, data: _read_many_response(keys[missing[j]], gen, data),
+        max_in_flight or __batch_in_flight,
+    )
+
+    for i, r in zip(missing, fetched):
+        results[i] = r
+
+    return results
+
+
+def _scan_request(key: str, count: int) -> fred.ScanRequest:
     r = fred.ScanRequest()
 
     r.keygroup = __keygroup
     r.id = key
     r.count = count
 
-    data = __client.Scan(r)
+    return r
+
+
+def _scan_local(key: str, count: int) -> typing.Optional[typing.List[str]]:
+    if __cache_size <= 0:
+        return None
+
+    cached = _cache_get(__scan_cache, (key, count))
+
+    return None if cached is None else cached[0]
+
 
+def _scan_response(
+    key: str, count: int, gen: int, data: fred.ScanResponse
+) -> typing.List[str]:
     values: typing.List[str] = []
 
     for item in data.data:
         values.append(item.data)
 
+    if __cache_size > 0:
+        with __cache_lock:
+            if gen != __cache_gen:
+                return values
+
+            _cache_put(
+                __scan_cache,
+                (key, count),
+                (time.monotonic() + __cache_ttl, list(values)),
+            )
+
     return values
 
 
-def update(key: str, value: str) -> None:
-    r = fred.UpdateRequest()
+def scan(key: str, count: int) -> typing.List[str]:
+    # buffered writes could fall into any range, so send them first
+    flush()
+
+    cached = _scan_local(key, count)
+    if cached is not None:
+        return cached
+
+    gen = __cache_gen
+
+    data = _call(lambda: _client().Scan(_scan_request(key, count)))
+
+    return _scan_response(key, count, gen, data)
+
+
+def _scan_page(key: str, count: int) -> typing.Any:
+    return _client().Scan.future(_scan_request(key, count))
+
+
+def scan_iter(
+    key: str, count: typing.Optional[int] = None, page_size: int = 100
+) -> typing.Iterator[typing.Tuple[str, str]]:
+    """
+    lazily scan up to count (key, value) pairs starting at key, or all of
+    them if count is None, fetching page_size pairs per request
+    the next page is requested while the caller is still busy with the
+    current one
+    """
+
+    # buffered writes could fall into the range, so send them first
+    flush()
+
+    remaining = count
+    first = True
+
+    requested = page_size if remaining is None else min(page_size, remaining)
+    page = _scan_page(key, requested) if requested > 0 else None
+
+    try:
+        while page is not None:
+            data = page.result().data
+            page = None
+
+            items = [(item.id, item.data) for item in data]
+
+            # pages after the first start at the last key we have already seen
+            if not first and len(items) > 0 and items[0][0] == key:
+                items = items[1:]
+
+            if remaining is not None:
+                items = items[:remaining]
+                remaining -= len(items)
+
+            if len(data) == requested and (remaining is None or remaining > 0):
+                key = data[-1].id
+                first = False
+                requested = (
+                    page_size if remaining is None else min(page_size, remaining)
+                ) + 1
+                page = _scan_page(key, requested)
+
+            yield from items
+    finally:
+        if page is not None:
+            page.cancel()
+
+
+def append(value: str) -> str:
+    """
+    append a value to the keygroup and return the key that FReD generated for
+    it, keys are increasing so the log can be read back with scan_iter()
+
+    note that FReD only allows appends to immutable keygroups
+    """
+
+    # appends are not idempotent: one that timed out may still have been
+    # written, so it is never retried on another replica
+    data = _client().Append(_append_request(value))
+
+    return data.id  # type: ignore
+
+
+def _append_request(value: str) -> fred.AppendRequest:
+    r = fred.AppendRequest()
 
     r.keygroup = __keygroup
-    r.id = key
     r.data = value
 
-    __client.Update(r)
+    return r
 
 
-def delete(key: str) -> None:
-    r = fred.DeleteRequest()
+def update(key: str, value: str) -> None:
+    if __write_behind != "off":
+        _buffer(key, value)
+        return
 
-    r.keygroup = __keygroup
-    r.id = key
+    try:
+        _call(lambda: _client().Update(_update_request(key, value)))
+        _session_write(key)
+    finally:
+        _invalidate(key)
+
+
+def update_many(
+    items: typing.Mapping[str, str], max_in_flight: typing.Optional[int] = None
+) -> typing.List[typing.Optional[Exception]]:
+    """
+    write several keys at once, returns None for each key that was written
+    successfully or the exception if writing it failed, in the order of items
+    """
+
+    keys = list(items.keys())
+
+    if __write_behind != "off":
+        results: typing.List[typing.Optional[Exception]] = []
+
+        for k in keys:
+            try:
+                _buffer(k, items[k])
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+    try:
+        errors = _pipeline(
+            [_write_call(k, items[k]) for k in keys],
+            lambda i, _: None,
+            max_in_flight or __batch_in_flight,
+        )
+
+        _session_write_many([k for k, e in zip(keys, errors) if e is None])
+
+        return errors
+    finally:
+        for k in keys:
+            _invalidate(k)
+
+
+def delete(key: str) -> None:
+    if __write_behind != "off":
+        _buffer(key, None)
+        return
 
-    __client.Delete(r)
+    try:
+        _call(lambda: _client().Delete(_delete_request(key)))
+        _session_forget(key)
+    finally:
+        _invalidate(key)
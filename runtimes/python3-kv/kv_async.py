@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import asyncio
+import typing
+
+import kv
+
+if typing.TYPE_CHECKING:
+    import grpc
+
+# asyncio versions of the kv operations, to wait for many of them at once
+# they share everything with kv: the channel and its stats, the replica that
+# kv has chosen and routes to, failover to another replica, read-your-writes
+# sessions and the read cache
+# only the calls themselves are awaited, the steps of kv that block, i.e.,
+# setting up the connection, failing over, flushing before a scan and
+# retrying a stale read, run in the event loop's default executor
+# writes go straight to FReD, they bypass kv's write-behind buffer, so a write
+# buffered in kv that is flushed later still wins
+
+_T = typing.TypeVar("_T")
+
+
+def _resolve(result: asyncio.Future[typing.Any], f: grpc.Future) -> None:
+    if result.done():
+        return
+
+    if f.cancelled():
+        result.cancel()
+        return
+
+    e = f.exception()
+
+    if e is not None:
+        result.set_exception(e)
+    else:
+        result.set_result(f.result())
+
+
+def _wrap(f: grpc.Future) -> asyncio.Future[typing.Any]:
+    # a call on kv's channel as a future of the running loop, cancelling one
+    # cancels the other
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+
+    def done(f: grpc.Future) -> None:
+        try:
+            loop.call_soon_threadsafe(_resolve, result, f)
+        except RuntimeError:
+            # the loop is gone, nobody waits for the result anymore
+            pass
+
+    f.add_done_callback(done)
+    result.add_done_callback(lambda r: f.cancel() if r.cancelled() else None)
+
+    return result
+
+
+async def _blocking(f: typing.Callable[..., _T], *args: typing.Any) -> _T:
+    return await asyncio.get_running_loop().run_in_executor(None, f, *args)
+
+
+async def _client() -> typing.Any:
+    if not kv.ready():
+        await _blocking(kv.connect)
+
+    return kv._client()
+
+
+async def _call(call: typing.Callable[[typing.Any], grpc.Future]) -> typing.Any:
+    # like kv._call: retry once if kv failed over to another replica
+    try:
+        return await _wrap(call(await _client()))
+    except Exception as e:
+        if not await _blocking(kv._failover, e):
+            raise e
+
+    kv._count_retry("failover")
+
+    return await _wrap(call(await _client()))
+
+
+async def _session_write(key: str) -> None:
+    for k in kv._session_unknown([key]):
+        try:
+            data = await _wrap((await _client()).Read.future(kv._read_request(k)))
+        except Exception as e:
+            print(f"failed to read back the version of {k} after writing it")
+            print(e)
+            return
+
+        kv._session_observe(k, [dict(item.version) for item in data.items])
+
+
+async def read(key: str) -> typing.List[str]:
+    local = kv._read_local(key)
+    if local is not None:
+        return local[0]
+
+    gen = kv._cache_generation()
+
+    data = await _call(lambda c: c.Read.future(kv._read_request(key)))
+
+    values, versions = kv._read_response(key, gen, data)
+
+    if not kv._session_ok(key, versions):
+        # kv retries on another replica or after a while
+        return await _blocking(kv.read, key)
+
+    kv._session_observe(key, versions)
+
+    return values
+
+
+async def scan(key: str, count: int) -> typing.List[str]:
+    # buffered writes could fall into any range, so send them first
+    await _blocking(kv.flush)
+
+    cached = kv._scan_local(key, count)
+    if cached is not None:
+        return cached
+
+    gen = kv._cache_generation()
+
+    data = await _call(lambda c: c.Scan.future(kv._scan_request(key, count)))
+
+    return kv._scan_response(key, count, gen, data)
+
+
+async def update(key: str, value: str) -> None:
+    try:
+        await _call(lambda c: c.Update.future(kv._update_request(key, value)))
+        await _session_write(key)
+    finally:
+        kv.invalidate(key)
+
+
+async def delete(key: str) -> None:
+    try:
+        await _call(lambda c: c.Delete.future(kv._delete_request(key)))
+        kv._session_forget(key)
+    finally:
+        kv.invalidate(key)
+
+
+async def append(value: str) -> str:
+    # never retried, see kv.append
+    c = await _client()
+    data = await _wrap(c.Append.future(kv._append_request(value)))
+
+    return str(data.id)
+
+
+__ops: typing.Dict[str, typing.Callable[..., typing.Awaitable[typing.Any]]] = {
+    "read": read,
+    "scan": scan,
+    "update": update,
+    "delete": delete,
+    "append": append,
+}
+
+
+def gather(
+    ops: typing.Sequence[typing.Tuple[typing.Any, ...]],
+    return_exceptions: bool = False,
+) -> typing.List[typing.Any]:
+    """
+    run a list of operations concurrently from synchronous code, e.g.,
+    gather([("update", "a", "1"), ("read", "b")]), and return their results
+    in order
+    """
+
+    for op in ops:
+        if op[0] not in __ops:
+            raise Exception(f"unknown kv operation {op[0]}")
+
+    async def _all() -> typing.List[typing.Any]:
+        return await asyncio.gather(
+            *[__ops[op[0]](*op[1:]) for op in ops],
+            return_exceptions=return_exceptions,
+        )
+
+    return asyncio.run(_all())
@@ -1,47 +1,617 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+import http
+import json
+import os
+import sys
+import threading
+import time
 import typing
 import http.server
-import socketserver
+
+import handlerlib
+
+started = time.time()
+
+# HANDLER_SERVER selects the server that runs the function:
+#   "asyncio": an asyncio HTTP/1.1 server with keep-alive and pipelining that
+#     runs up to HANDLER_WORKERS invocations concurrently, on uvloop if it is
+#     installed
+#   "stdlib": the threading http.server from the standard library
+#   "auto" (default): "asyncio" if uvloop is installed, "stdlib" otherwise
+server = os.environ.get("HANDLER_SERVER", "auto")
+workers = os.environ.get("HANDLER_WORKERS")
+
+# connections from the reverse proxy are kept open for further requests until
+# they have been idle for HANDLER_KEEPALIVE_TIMEOUT seconds or have served
+# HANDLER_KEEPALIVE_REQUESTS requests
+keepalive_timeout = float(os.environ.get("HANDLER_KEEPALIVE_TIMEOUT", "60"))
+keepalive_requests = int(os.environ.get("HANDLER_KEEPALIVE_REQUESTS", "1000"))
+
+# the stdlib server runs at most HANDLER_MAX_IN_FLIGHT invocations at the same
+# time (0 for no limit), up to HANDLER_MAX_QUEUE more wait for their turn for
+# at most HANDLER_QUEUE_TIMEOUT seconds (0 to wait indefinitely)
+# everything beyond that is rejected right away with a 503 and a Retry-After
+# of HANDLER_RETRY_AFTER seconds, so that admitted requests stay fast
+# the asyncio server is bounded by HANDLER_WORKERS instead
+max_in_flight = int(os.environ.get("HANDLER_MAX_IN_FLIGHT", "0"))
+max_queue = int(os.environ.get("HANDLER_MAX_QUEUE", "0"))
+queue_timeout = float(os.environ.get("HANDLER_QUEUE_TIMEOUT", "0"))
+retry_after = os.environ.get("HANDLER_RETRY_AFTER", "1")
+
+# invocations with an X-tinyFaaS-Async header are acknowledged with a 202 right
+# away and run on HANDLER_ASYNC_WORKERS background threads, with up to
+# HANDLER_ASYNC_QUEUE more waiting
+# with the stdlib server, they take up a slot of HANDLER_MAX_IN_FLIGHT like
+# any other invocation once they run
+# HANDLER_ASYNC_OVERFLOW decides what happens when the queue is full:
+#   "sync" (default): run the invocation like a synchronous one
+#   "reject": answer with a 503 and a Retry-After
+#   "drop-oldest": discard the invocation that has waited the longest
+async_workers = int(os.environ.get("HANDLER_ASYNC_WORKERS", "4"))
+async_queue = int(os.environ.get("HANDLER_ASYNC_QUEUE", "128"))
+async_overflow = os.environ.get("HANDLER_ASYNC_OVERFLOW", "sync")
+
+if async_overflow not in ("sync", "reject", "drop-oldest"):
+    raise Exception(f"unknown HANDLER_ASYNC_OVERFLOW {async_overflow}")
+
+# functions that define fn_batch(List[Optional[str]]) -> List[Optional[str]]
+# can have concurrent invocations collected into batches of up to
+# HANDLER_BATCH_SIZE inputs (0 for no batching), which wait at most
+# HANDLER_BATCH_WAIT milliseconds for the batch to fill up
+batch_size = int(os.environ.get("HANDLER_BATCH_SIZE", "0"))
+batch_wait = float(os.environ.get("HANDLER_BATCH_WAIT", "5")) / 1000.0
+
+# functions that define fn_stream get the request body in chunks of up to
+# HANDLER_CHUNK_SIZE bytes
+chunk_size = int(os.environ.get("HANDLER_CHUNK_SIZE", "65536"))
+
+if server not in ("auto", "asyncio", "stdlib"):
+    raise Exception(f"unknown HANDLER_SERVER {server}")
+
+uvloop = None
+if server != "stdlib":
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        pass
+
+if server == "auto":
+    server = "asyncio" if uvloop is not None else "stdlib"
+
+# asyncio takes a while to import, so the stdlib server goes without it
+if server == "asyncio":
+    import asyncio
+
+if server == "asyncio":
+    import concurrent.futures
+
+
+def process_start() -> float:
+    """wall clock time at which the interpreter was started"""
+
+    # /proc has the start time in clock ticks since boot, which /proc/uptime
+    # lets us convert without losing precision
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+
+        return time.time() - uptime + ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return started
+
 
 if __name__ == "__main__":
+    # wall clock times of the startup steps, logged after the first request
+    timeline = {"interpreter": process_start(), "handler": started}
+
     try:
         import fn
     except ImportError:
         raise ImportError("Failed to import fn.py")
 
+    timeline["fn_import"] = time.time()
+
+    # functions that work on binary payloads can define
+    # fn_bytes(memoryview) -> bytes instead of fn(str) -> str, which skips
+    # decoding the request and encoding the response
+    fn_bytes = getattr(fn, "fn_bytes", None)
+
+    # functions that handle large payloads can define
+    # fn_stream(Iterator[bytes]) -> Iterable[bytes] that consumes the request
+    # body as it arrives and whose output is sent with chunked encoding as it
+    # is produced
+    fn_stream = getattr(fn, "fn_stream", None)
+
+    # expensive setup, e.g., loading a model, can go into an fn.init() that
+    # runs in the background before /health reports OK
+    init = getattr(fn, "init", None)
+
+    # whether init has run and whether the startup timeline has been logged
+    state = {"initialized": False, "logged": False}
+    state_lock = threading.Lock()
+
+    def start() -> None:
+        if init is not None:
+            try:
+                init()
+            except Exception as e:
+                print(f"fn.init failed: {e}")
+                sys.stdout.flush()
+                os._exit(1)
+
+            timeline["init"] = time.time()
+
+        timeline["ready"] = time.time()
+        state["initialized"] = True
+
+    def first_request(done: bool) -> None:
+        if state["logged"]:
+            return
+
+        if not done:
+            timeline.setdefault("first_request", time.time())
+            return
+
+        with state_lock:
+            if state["logged"]:
+                return
+            state["logged"] = True
+
+        timeline["first_response"] = time.time()
+
+        # milliseconds since the interpreter started, in order
+        t0 = timeline["interpreter"]
+        events = {
+            k: round((t - t0) * 1000, 3)
+            for k, t in sorted(timeline.items(), key=lambda e: e[1])
+        }
+        print(f"STARTUP;{json.dumps({'pid': os.getpid(), 'timeline': events})}")
+
+    admission = handlerlib.Admission(max_in_flight, max_queue, queue_timeout)
+    async_pool = handlerlib.AsyncPool(async_workers, async_queue, async_overflow)
+
+    batcher = None
+    if batch_size > 0 and hasattr(fn, "fn_batch"):
+        batcher = handlerlib.Batcher(fn.fn_batch, batch_size, batch_wait)
+
+    def metrics() -> bytes:
+        m = {"async": async_pool.stats()}
+        if server == "stdlib":
+            m["handler"] = admission.stats()
+        if batcher is not None:
+            m["batch"] = batcher.stats()
+
+        return json.dumps(m).encode("utf-8")
+
+    def call_async(body: memoryview) -> None:
+        # nobody waits for the result
+        try:
+            call(body)
+        except Exception as e:
+            print(f"async invocation failed: {e}")
+
+    def decode(body: memoryview) -> typing.Optional[str]:
+        d = str(body, "utf-8")
+        return d if d != "" else None
+
+    def encode(res: typing.Optional[str]) -> bytes:
+        return res.encode("utf-8") if res is not None else b""
+
+    def call(body: memoryview) -> bytes:
+        if fn_bytes is not None:
+            return fn_bytes(body) or b""
+
+        if batcher is not None:
+            return encode(batcher.submit(decode(body)).result())
+
+        return encode(fn.fn(decode(body)))
+
     # create a webserver at port 8080 and execute fn.fn for every request
     class tinyFaaSFNHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        timeout = keepalive_timeout
+
+        def setup(self) -> None:
+            super().setup()
+            self.requests_served = 0
+
+        def respond(
+            self,
+            status: int,
+            body: bytes = b"",
+            headers: typing.Optional[typing.Dict[str, str]] = None,
+            close: bool = False,
+        ) -> None:
+            self.send_response(status)
+
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+
+            # every response is framed, so the connection can be reused
+            self.send_header("Content-Length", str(len(body)))
+            self.finish_headers(close)
+            self.wfile.write(body)
+
+        def finish_headers(self, close: bool = False) -> None:
+            self.requests_served += 1
+            if close or self.requests_served >= keepalive_requests:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+
+            # tell the reverse proxy whether async invocations can be rejected,
+            # it only waits for the acknowledgement of handlers that may
+            # reject them
+            if self.headers.get("X-tinyFaaS-Async", "").lower() == "true":
+                self.send_header("X-tinyFaaS-Async-Overflow", async_overflow)
+
+            self.end_headers()
+
         def do_GET(self) -> None:
             print(f"GET {self.path}")
             if self.path == "/health":
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write("OK".encode("utf-8"))
+                if not state["initialized"]:
+                    self.respond(503, "init not done".encode("utf-8"))
+                    print("reporting health: init not done")
+                    return
+
+                self.respond(200, "OK".encode("utf-8"))
                 print("reporting health: OK")
                 return
 
-            self.send_response(404)
-            self.end_headers()
+            if self.path == "/metrics":
+                self.respond(200, metrics(), {"Content-Type": "application/json"})
+                return
+
+            self.respond(404)
             return
 
+        def stream(self) -> None:
+            body = handlerlib.body_chunks(self.rfile, self.headers, chunk_size)
+
+            try:
+                out = iter(fn_stream(body))  # type: ignore
+                # errors before the first chunk can still be reported
+                first = next(out, None)
+            except Exception as e:
+                print(e)
+                self.respond(500, str(e).encode("utf-8"), close=True)
+                return
+
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.finish_headers()
+
+            try:
+                chunk = first
+                while chunk is not None:
+                    if len(chunk) > 0:
+                        self.wfile.write(frame(chunk))
+                    chunk = next(out, None)
+
+                # the rest of the request has to be read before the
+                # connection can be used for the next one
+                for _ in body:
+                    pass
+            except Exception as e:
+                # the status is already out, leaving out the last chunk tells
+                # the client that the response is incomplete
+                print(e)
+                self.close_connection = True
+                return
+
+            self.wfile.write(b"0\r\n\r\n")
+
         def do_POST(self) -> None:
-            d: typing.Optional[str] = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
-            if d == "":
-                d = None
+            first_request(False)
+
+            body = None
+
+            # streaming functions are always invoked synchronously
+            async_header = self.headers.get("X-tinyFaaS-Async", "").lower() == "true"
+            if async_header and fn_stream is None:
+                body = handlerlib.read_body(self.rfile, self.headers, chunk_size)
+
+                if async_pool.submit(lambda: self.call_async(body)):  # type: ignore
+                    self.respond(202)
+                    first_request(True)
+                    return
+
+                if async_overflow == "reject":
+                    self.respond(503, b"overloaded", {"Retry-After": retry_after})
+                    return
+
+            if not admission.acquire():
+                # the body is not read, so the connection can't be reused
+                self.respond(
+                    503,
+                    b"overloaded",
+                    {"Retry-After": retry_after},
+                    close=True,
+                )
+                return
 
             try:
-                res = fn.fn(d)
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(res.encode("utf-8"))
+                self.invoke(body)
+            finally:
+                admission.release()
+                first_request(True)
+
+        def invoke(self, body: typing.Optional[memoryview] = None) -> None:
+            if fn_stream is not None:
+                self.stream()
+                return
+
+            if body is None:
+                body = handlerlib.read_body(self.rfile, self.headers, chunk_size)
+
+            try:
+                self.respond(200, call(body))
                 return
             except Exception as e:
                 print(e)
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(str(e).encode("utf-8"))
+                self.respond(500, str(e).encode("utf-8"))
                 return
 
-    with socketserver.TCPServer(("", 8000), tinyFaaSFNHandler) as httpd:
-        httpd.serve_forever()
+        def call_async(self, body: memoryview) -> None:
+            # async invocations count towards HANDLER_MAX_IN_FLIGHT like all
+            # others, they were accepted already so they wait as long as needed
+            admission.acquire(wait=True)
+
+            try:
+                call_async(body)
+            finally:
+                admission.release()
+
+    def frame(chunk: bytes) -> bytes:
+        return b"".join((b"%x\r\n" % len(chunk), chunk, b"\r\n"))
+
+    async def invoke(
+        method: str, path: str, body: bytes, asynchronous: bool
+    ) -> typing.Tuple[int, bytes]:
+        if method == "GET":
+            print(f"GET {path}")
+            if path == "/health":
+                if not state["initialized"]:
+                    print("reporting health: init not done")
+                    return 503, "init not done".encode("utf-8")
+
+                print("reporting health: OK")
+                return 200, "OK".encode("utf-8")
+
+            if path == "/metrics":
+                return 200, metrics()
+
+            return 404, b""
+
+        if method != "POST":
+            return 501, b""
+
+        if asynchronous:
+            if async_pool.submit(lambda: call_async(memoryview(body))):
+                return 202, b""
+
+            if async_overflow == "reject":
+                return 503, b"overloaded"
+
+        try:
+            # waiting for a batch doesn't need to tie up a thread
+            if batcher is not None and fn_bytes is None:
+                f = batcher.submit(decode(memoryview(body)))
+                return 200, encode(await asyncio.wrap_future(f))
+
+            res = await asyncio.get_running_loop().run_in_executor(
+                executor, call, memoryview(body)
+            )
+            return 200, res
+        except Exception as e:
+            print(e)
+            return 500, str(e).encode("utf-8")
+
+    async def body_chunks(
+        reader: asyncio.StreamReader, headers: typing.Dict[str, str]
+    ) -> typing.AsyncIterator[bytes]:
+        if headers.get("transfer-encoding", "").lower() != "chunked":
+            remaining = int(headers.get("content-length", "0"))
+            while remaining > 0:
+                data = await reader.readexactly(min(remaining, chunk_size))
+                remaining -= len(data)
+                yield data
+            return
+
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size > 0:
+                data = await reader.readexactly(min(size, chunk_size))
+                size -= len(data)
+                yield data
+            await reader.readline()
+
+    async def read_body(
+        reader: asyncio.StreamReader, headers: typing.Dict[str, str]
+    ) -> bytes:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            return b"".join([c async for c in body_chunks(reader, headers)])
+
+        length = int(headers.get("content-length", "0"))
+        return await reader.readexactly(length) if length > 0 else b""
+
+    def head(status: int, fields: typing.Dict[str, str], keep_alive: bool) -> bytes:
+        h = f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+        for k, v in fields.items():
+            h += f"{k}: {v}\r\n"
+        if not keep_alive:
+            h += "Connection: close\r\n"
+        h += "\r\n"
+
+        return h.encode("latin-1")
+
+    async def stream(
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        headers: typing.Dict[str, str],
+        keep_alive: bool,
+    ) -> bool:
+        # fn_stream runs on the executor like any other invocation and hands
+        # reads and writes back to the event loop, waiting for each of them
+        loop = asyncio.get_running_loop()
+        chunks = body_chunks(reader, headers)
+
+        async def next_chunk() -> typing.Optional[bytes]:
+            try:
+                return await chunks.__anext__()
+            except StopAsyncIteration:
+                return None
+
+        async def send(data: bytes) -> None:
+            writer.write(data)
+            await writer.drain()
+
+        def body() -> typing.Iterator[bytes]:
+            while True:
+                data = asyncio.run_coroutine_threadsafe(next_chunk(), loop).result()
+                if data is None:
+                    return
+                yield data
+
+        def write(data: bytes) -> None:
+            asyncio.run_coroutine_threadsafe(send(data), loop).result()
+
+        def run() -> bool:
+            b = body()
+
+            try:
+                out = iter(fn_stream(b))  # type: ignore
+                # errors before the first chunk can still be reported
+                first = next(out, None)
+            except Exception as e:
+                print(e)
+                res = str(e).encode("utf-8")
+                write(head(500, {"Content-Length": str(len(res))}, False) + res)
+                return False
+
+            write(head(200, {"Transfer-Encoding": "chunked"}, keep_alive))
+
+            try:
+                chunk = first
+                while chunk is not None:
+                    if len(chunk) > 0:
+                        write(frame(chunk))
+                    chunk = next(out, None)
+
+                # the rest of the request has to be read before the
+                # connection can be used for the next one
+                for _ in b:
+                    pass
+            except Exception as e:
+                # the status is already out, leaving out the last chunk tells
+                # the client that the response is incomplete
+                print(e)
+                return False
+
+            write(b"0\r\n\r\n")
+            return keep_alive
+
+        return await loop.run_in_executor(executor, run)
+
+    async def handle(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # requests on a connection are answered in order, so pipelined
+        # requests simply wait in the reader until it is their turn
+        served = 0
+
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(), keepalive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+                if request_line == b"":
+                    break
+
+                method, path, version = request_line.decode("latin-1").split()
+
+                headers: typing.Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = line.decode("latin-1").split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = (version == "HTTP/1.1" and connection != "close") or (
+                    version == "HTTP/1.0" and connection == "keep-alive"
+                )
+
+                served += 1
+                if served >= keepalive_requests:
+                    keep_alive = False
+
+                if method == "POST":
+                    first_request(False)
+
+                if method == "POST" and fn_stream is not None:
+                    keep_alive = await stream(reader, writer, headers, keep_alive)
+                else:
+                    body = await read_body(reader, headers)
+                    asynchronous = (
+                        headers.get("x-tinyfaas-async", "").lower() == "true"
+                    )
+                    status, res = await invoke(method, path, body, asynchronous)
+
+                    fields = {"Content-Length": str(len(res))}
+                    # only rejected invocations answer a POST with a 503
+                    if method == "POST" and status == 503:
+                        fields["Retry-After"] = retry_after
+
+                    # see finish_headers
+                    if asynchronous:
+                        fields["X-tinyFaaS-Async-Overflow"] = async_overflow
+
+                    writer.write(head(status, fields, keep_alive) + res)
+                    await writer.drain()
+
+                if method == "POST":
+                    first_request(True)
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve() -> None:
+        s = await asyncio.start_server(handle, "", 8000)
+        async with s:
+            await s.serve_forever()
+
+    threading.Thread(target=start, daemon=True).start()
+
+    if server == "asyncio":
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(workers) if workers is not None else None
+        )
+
+        if uvloop is not None:
+            uvloop.install()
+        asyncio.run(serve())
+    else:
+        # persistent connections would starve each other on a single thread
+        with http.server.ThreadingHTTPServer(("", 8000), tinyFaaSFNHandler) as httpd:
+            httpd.serve_forever()
@@ -1,6 +1,7 @@
 #!/bin/bash
 
-# upload.sh folder-name name env threads
+# upload.sh folder-name name env threads [envs]
+# envs is an optional JSON array of "KEY=value" strings for the function
 
 set -e
 
@@ -22,6 +23,8 @@ then
     exit
 fi
 
+ENVS="${5:-[]}"
+
 pushd "$1" >/dev/null || exit
-curl http://localhost:8080/upload --data "{\"name\": \"$2\", \"env\": \"$3\", \"threads\": $4, \"zip\": \"$(zip -r - ./* | base64 | tr -d '\n')\"}"
+curl http://localhost:8080/upload --data "{\"name\": \"$2\", \"env\": \"$3\", \"threads\": $4, \"envs\": $ENVS, \"zip\": \"$(zip -r - ./* | base64 | tr -d '\n')\"}"
 popd >/dev/null || exit
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+
+import typing
+
+
+def fn(input: typing.Optional[str]) -> typing.Optional[str]:
+    """echo the input"""
+    return f"1:{input}"
+
+
+def fn_batch(
+    input: typing.List[typing.Optional[str]],
+) -> typing.List[typing.Optional[str]]:
+    """echo every input, prefixed with the size of the batch it came in"""
+    return [f"{len(input)}:{i}" for i in input]
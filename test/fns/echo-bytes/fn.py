@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+
+import typing
+
+
+def fn(input: typing.Optional[str]) -> typing.Optional[str]:
+    """echo the input"""
+    return input
+
+
+def fn_bytes(input: memoryview) -> bytes:
+    """echo the raw input, which does not have to be valid UTF-8"""
+    return bytes(input)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+
+import typing
+
+
+def fn(input: typing.Optional[str]) -> typing.Optional[str]:
+    """echo the input in upper case"""
+    return input.upper() if input is not None else None
+
+
+def fn_stream(input: typing.Iterator[bytes]) -> typing.Iterator[bytes]:
+    """echo the input in upper case, chunk by chunk as it arrives"""
+    for chunk in input:
+        yield chunk.upper()
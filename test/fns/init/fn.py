@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+
+import typing
+
+inits = 0
+
+
+def init() -> None:
+    """count how often init runs"""
+    global inits
+    inits += 1
+
+
+def fn(input: typing.Optional[str]) -> typing.Optional[str]:
+    """output how often init has run"""
+    return str(inits)
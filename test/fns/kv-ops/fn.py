@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import typing
+import kv
+import kv_async
+
+
+def fn(input: typing.Optional[str]) -> typing.Optional[str]:
+    """
+    run the kv operation in the input:
+    "append value" appends value and outputs its key
+    "log key" outputs all values from key on, one per line
+    "head key n" outputs the first n values from key on, one per line
+    "set k1=v1,k2=v2" writes all keys at once
+    "get k1,k2" reads all keys at once and outputs their values, one per line
+    "one key" reads key and outputs one value, however many versions it has
+    "gather k1=v1,k2=v2" writes all keys concurrently with kv_async, then reads
+    them concurrently and outputs their values, one per line
+    """
+
+    op, _, arg = (input or "").partition(" ")
+
+    if op == "append":
+        return kv.append(arg)
+
+    if op == "log":
+        # a small page size so that the log spans several pages
+        return "\n".join(v for _, v in kv.scan_iter(arg, page_size=2))
+
+    if op == "head":
+        key, _, count = arg.partition(" ")
+        return "\n".join(v for _, v in kv.scan_iter(key, int(count), page_size=2))
+
+    if op == "set":
+        items = dict(i.split("=", 1) for i in arg.split(","))
+
+        failed = [k for k, e in zip(items, kv.update_many(items)) if e is not None]
+        if len(failed) > 0:
+            raise Exception(f"writing {failed} failed")
+
+        return "ok"
+
+    if op == "get":
+        values = []
+
+        for r in kv.read_many(arg.split(",")):
+            if isinstance(r, Exception):
+                raise r
+            values.append(r[0])
+
+        return "\n".join(values)
+
+    if op == "gather":
+        items = dict(i.split("=", 1) for i in arg.split(","))
+
+        kv_async.gather([("update", k, v) for k, v in items.items()])
+        values = kv_async.gather([("read", k) for k in items])
+
+        return "\n".join(v[0] for v in values)
+
+    if op == "one":
+        return kv.read_one(arg)
+
+    raise Exception(f"unknown operation {op}")
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+import time
+import typing
+
+
+def fn(input: typing.Optional[str]) -> typing.Optional[str]:
+    """sleep for as many seconds as the input says, then echo it"""
+    time.sleep(float(input or "0"))
+    return input
@@ -2,6 +2,9 @@
 
 import unittest
 
+import concurrent.futures
+import http.client
+import json
 import os
 import os.path as path
 import signal
@@ -19,6 +22,8 @@ connection: typing.Dict[str, typing.Union[str, int]] = {
     "coap_port": 5683,
 }
 
+REPEAT = 10
+
 tf_process: typing.Optional[subprocess.Popen] = None  # type: ignore
 src_path = "."
 fn_path = path.join(src_path, "test", "fns")
@@ -116,8 +121,14 @@ def tearDownModule() -> None:
     return
 
 
-def startFunction(folder_name: str, fn_name: str, env: str, threads: int) -> str:
-    """starts a function, returns name"""
+def startFunction(
+    folder_name: str,
+    fn_name: str,
+    env: str,
+    threads: int,
+    envs: typing.Optional[typing.Dict[str, str]] = None,
+) -> str:
+    """starts a function with optional environment variables, returns name"""
 
     # get full path of folder
     folder_name = os.path.abspath(folder_name)
@@ -125,7 +136,14 @@ def startFunction(folder_name: str, fn_name: str, env: str, threads: int) -> str
     # use the upload.sh script
     try:
         subprocess.run(
-            ["./upload.sh", folder_name, fn_name, env, str(threads)],
+            [
+                "./upload.sh",
+                folder_name,
+                fn_name,
+                env,
+                str(threads),
+                json.dumps([f"{k}={v}" for k, v in (envs or {}).items()]),
+            ],
             cwd=script_path,
             check=True,
             capture_output=True,
@@ -337,6 +355,254 @@ class TestEcho(TinyFaaSTest):
         self.assertIsNotNone(response)
         self.assertEqual(response.response, payload)
 
+    def test_invoke_http_keepalive(self) -> None:
+        """invoke a function several times over one connection"""
+
+        payload = "Hello World!"
+
+        conn = http.client.HTTPConnection(self.host, self.http_port, timeout=10)
+
+        try:
+            conn.connect()
+            sock = conn.sock
+
+            for i in range(REPEAT):
+                conn.request("POST", f"/{self.fn}", body=f"{payload} {i}")
+                res = conn.getresponse()
+
+                # check the response
+                self.assertEqual(res.status, 200)
+                self.assertEqual(res.read().decode("utf-8"), f"{payload} {i}")
+
+                # check that the connection is still the same
+                self.assertIs(conn.sock, sock)
+        finally:
+            conn.close()
+
+        return
+
+    def test_invoke_http_async(self) -> None:
+        """invoke a function async"""
+
+        # make an async request to the function with a payload
+        req = urllib.request.Request(
+            f"http://{self.host}:{self.http_port}/{self.fn}",
+            data="Hello World!".encode("utf-8"),
+            headers={"X-tinyFaaS-Async": "true"},
+        )
+
+        res = urllib.request.urlopen(req, timeout=10)
+
+        # check the response
+        self.assertEqual(res.status, 202)
+
+        return
+
+
+class TestEchoBytes(TinyFaaSTest):
+    fn = ""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(TestEchoBytes, cls).setUpClass()
+        cls.fn = startFunction(
+            path.join(fn_path, "echo-bytes"), "echobytes", "python3", 1
+        )
+
+    def setUp(self) -> None:
+        super(TestEchoBytes, self).setUp()
+        self.fn = TestEchoBytes.fn
+
+    def test_invoke_http(self) -> None:
+        """invoke a function with a payload that is not valid UTF-8"""
+
+        payload = bytes(range(256))
+
+        req = urllib.request.Request(
+            f"http://{self.host}:{self.http_port}/{self.fn}",
+            data=payload,
+        )
+
+        res = urllib.request.urlopen(req, timeout=10)
+
+        # check the response
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.read(), payload)
+
+        return
+
+
+class TestEchoStream(TinyFaaSTest):
+    fns: typing.List[str] = []
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(TestEchoStream, cls).setUpClass()
+        cls.fns = [
+            startFunction(
+                path.join(fn_path, "echo-stream"),
+                f"echostream{server}",
+                "python3",
+                1,
+                {"HANDLER_SERVER": server},
+            )
+            for server in ["asyncio", "stdlib"]
+        ]
+
+    def setUp(self) -> None:
+        super(TestEchoStream, self).setUp()
+        self.fns = TestEchoStream.fns
+
+    def test_invoke_http(self) -> None:
+        """invoke a function with a payload that spans several chunks"""
+
+        # larger than the default HANDLER_CHUNK_SIZE
+        payload = "Hello World!" * 20000
+
+        for fn in self.fns:
+            with self.subTest(fn=fn):
+                req = urllib.request.Request(
+                    f"http://{self.host}:{self.http_port}/{fn}",
+                    data=payload.encode("utf-8"),
+                )
+
+                res = urllib.request.urlopen(req, timeout=10)
+
+                # check the response
+                self.assertEqual(res.status, 200)
+                self.assertEqual(res.read().decode("utf-8"), payload.upper())
+
+        return
+
+
+class TestEchoBatch(TinyFaaSTest):
+    fn = ""
+    batch_size = 4
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(TestEchoBatch, cls).setUpClass()
+        cls.fn = startFunction(
+            path.join(fn_path, "echo-batch"),
+            "echobatch",
+            "python3",
+            1,
+            {"HANDLER_BATCH_SIZE": str(cls.batch_size), "HANDLER_BATCH_WAIT": "50"},
+        )
+
+    def setUp(self) -> None:
+        super(TestEchoBatch, self).setUp()
+        self.fn = TestEchoBatch.fn
+
+    def test_invoke_http(self) -> None:
+        """invoke a function concurrently so that inputs are batched"""
+
+        def invoke(payload: str) -> str:
+            req = urllib.request.Request(
+                f"http://{self.host}:{self.http_port}/{self.fn}",
+                data=payload.encode("utf-8"),
+            )
+
+            res = urllib.request.urlopen(req, timeout=10)
+            self.assertEqual(res.status, 200)
+
+            return res.read().decode("utf-8")
+
+        payloads = [f"Hello World {i}!" for i in range(REPEAT * self.batch_size)]
+
+        with concurrent.futures.ThreadPoolExecutor(self.batch_size) as executor:
+            results = list(executor.map(invoke, payloads))
+
+        # every response is the output for its own input
+        sizes = []
+        for payload, result in zip(payloads, results):
+            size, _, output = result.partition(":")
+            self.assertEqual(output, payload)
+            sizes.append(int(size))
+
+        # and at least some inputs were handled in a batch
+        self.assertTrue(all(1 <= s <= self.batch_size for s in sizes))
+        self.assertGreater(max(sizes), 1)
+
+        return
+
+
+class TestInit(TinyFaaSTest):
+    fn = ""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(TestInit, cls).setUpClass()
+        cls.fn = startFunction(path.join(fn_path, "init"), "initcount", "python3", 1)
+
+    def setUp(self) -> None:
+        super(TestInit, self).setUp()
+        self.fn = TestInit.fn
+
+    def test_invoke_http(self) -> None:
+        """invoke a function that has an init"""
+
+        for _ in range(REPEAT):
+            res = urllib.request.urlopen(
+                f"http://{self.host}:{self.http_port}/{self.fn}", timeout=10
+            )
+
+            # check that init ran exactly once before the first invocation
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.read().decode("utf-8"), "1")
+
+        return
+
+
+class TestAsyncReject(TinyFaaSTest):
+    fn = ""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super(TestAsyncReject, cls).setUpClass()
+        cls.fn = startFunction(
+            path.join(fn_path, "sleep"),
+            "sleepreject",
+            "python3",
+            1,
+            {
+                "HANDLER_ASYNC_OVERFLOW": "reject",
+                "HANDLER_ASYNC_QUEUE": "0",
+                "HANDLER_RETRY_AFTER": "3",
+            },
+        )
+
+    def setUp(self) -> None:
+        super(TestAsyncReject, self).setUp()
+        self.fn = TestAsyncReject.fn
+
+    def test_invoke_http_async(self) -> None:
+        """async invocations that the handler has no room for are rejected"""
+
+        def invoke() -> typing.Tuple[int, typing.Optional[str]]:
+            req = urllib.request.Request(
+                f"http://{self.host}:{self.http_port}/{self.fn}",
+                data="0".encode("utf-8"),
+                headers={"X-tinyFaaS-Async": "true"},
+            )
+
+            try:
+                res = urllib.request.urlopen(req, timeout=10)
+                return res.status, None
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers.get("Retry-After")
+
+        # the reverse proxy learns from the first answer that this handler
+        # rejects async invocations, from then on it waits for the answer
+        invoke()
+
+        for _ in range(REPEAT):
+            status, retry_after = invoke()
+            self.assertEqual(status, 503)
+            self.assertEqual(retry_after, "3")
+
+        return
+
 
 class TestBinary(TinyFaaSTest):
     fn = ""
@@ -2,11 +2,13 @@
 
 import unittest
 
+import json
 import os
 import os.path as path
 import signal
 import subprocess
 import sys
+import time
 import typing
 import urllib.error
 import urllib.request
@@ -120,8 +122,14 @@ def tearDownModule() -> None:
     return
 
 
-def startFunction(folder_name: str, fn_name: str, env: str, threads: int) -> str:
-    """starts a function, returns name"""
+def startFunction(
+    folder_name: str,
+    fn_name: str,
+    env: str,
+    threads: int,
+    envs: typing.Optional[typing.Dict[str, str]] = None,
+) -> str:
+    """starts a function with optional environment variables, returns name"""
 
     # get full path of folder
     folder_name = os.path.abspath(folder_name)
@@ -129,7 +137,14 @@ def startFunction(folder_name: str, fn_name: str, env: str, threads: int) -> str
     # use the upload.sh script
     try:
         subprocess.run(
-            ["./upload.sh", folder_name, fn_name, env, str(threads)],
+            [
+                "./upload.sh",
+                folder_name,
+                fn_name,
+                env,
+                str(threads),
+                json.dumps([f"{k}={v}" for k, v in (envs or {}).items()]),
+            ],
             cwd=script_path,
             check=True,
             capture_output=True,
@@ -259,6 +274,136 @@ class TestEchoKV(TinyFaaSDockerKVTest):
         )
 
 
+class TestEchoKVAsync(TinyFaaSDockerKVTest):
+    fn = ""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.fn = startFunction(
+            path.join(fn_path, "echo-kv"), "echokvasync", "python3-kv", 1
+        )
+
+    def setUp(self) -> None:
+        super(TestEchoKVAsync, self).setUp()
+        self.fn = TestEchoKVAsync.fn
+
+    def invoke(
+        self, payload: str, headers: typing.Optional[typing.Dict[str, str]] = None
+    ) -> typing.Any:
+        req = urllib.request.Request(
+            f"http://{self.host}:{self.http_port}/{self.fn}",
+            data=payload.encode("utf-8"),
+            headers=headers or {},
+        )
+
+        return urllib.request.urlopen(req, timeout=10)
+
+    def test_invoke_http_async(self) -> None:
+        """invoke a function async, check that it runs after the ack"""
+
+        res = self.invoke("async", {"X-tinyFaaS-Async": "true"})
+
+        # check the response
+        self.assertEqual(res.status, 202)
+
+        # the list eventually contains the async input
+        for _ in range(REPEAT):
+            res = self.invoke("sync")
+            self.assertEqual(res.status, 200)
+
+            if "async" in res.read().decode("utf-8").splitlines():
+                break
+
+            time.sleep(0.5)
+        else:
+            self.fail("async invocation did not run")
+
+        return
+
+
+class TinyFaaSKVOpsTest(TinyFaaSDockerKVTest):
+    fn = ""
+
+    def invoke(self, op: str) -> str:
+        req = urllib.request.Request(
+            f"http://{self.host}:{self.http_port}/{self.fn}",
+            data=op.encode("utf-8"),
+        )
+
+        res = urllib.request.urlopen(req, timeout=10)
+
+        self.assertEqual(res.status, 200)
+
+        return str(res.read().decode("utf-8"))
+
+
+class TestKVLog(TinyFaaSKVOpsTest):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.fn = startFunction(
+            path.join(fn_path, "kv-ops"),
+            "kvlog",
+            "python3-kv",
+            1,
+            {"KV_APPEND_ONLY": "true"},
+        )
+
+    def setUp(self) -> None:
+        super(TestKVLog, self).setUp()
+        self.fn = TestKVLog.fn
+
+    def test_append_scan_iter(self) -> None:
+        """append to the log, read it back over several pages"""
+
+        values = [f"{PAYLOAD} {i}" for i in range(5)]
+
+        keys = [self.invoke(f"append {v}") for v in values]
+
+        # every append gets its own key
+        self.assertEqual(len(set(keys)), len(values))
+
+        self.assertEqual(self.invoke(f"log {keys[0]}"), "\n".join(values))
+        self.assertEqual(self.invoke(f"log {keys[2]}"), "\n".join(values[2:]))
+
+        return
+
+
+class TestKVBatch(TinyFaaSKVOpsTest):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.fn = startFunction(path.join(fn_path, "kv-ops"), "kvbatch", "python3-kv", 1)
+
+    def setUp(self) -> None:
+        super(TestKVBatch, self).setUp()
+        self.fn = TestKVBatch.fn
+
+    def test_update_many_read_many(self) -> None:
+        """write several keys at once, read them back at once"""
+
+        items = {f"key{i}": f"{PAYLOAD} {i}" for i in range(REPEAT)}
+
+        self.assertEqual(
+            self.invoke("set " + ",".join(f"{k}={v}" for k, v in items.items())), "ok"
+        )
+
+        # read them back in a different order
+        keys = sorted(items, reverse=True)
+
+        self.assertEqual(
+            self.invoke("get " + ",".join(keys)), "\n".join(items[k] for k in keys)
+        )
+
+        # overwrite some of them
+        items.update({"key0": "updated", "key5": "updated"})
+
+        self.assertEqual(self.invoke("set key0=updated,key5=updated"), "ok")
+        self.assertEqual(
+            self.invoke("get " + ",".join(keys)), "\n".join(items[k] for k in keys)
+        )
+
+        return
+
+
 if __name__ == "__main__":
     # check that make is installed
     try:
@@ -0,0 +1,1478 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import os.path as path
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+# these tests run the function handlers as local processes, the way their
+# containers would, so they need neither Docker nor a tinyFaaS instance
+connection: typing.Dict[str, typing.Union[str, int]] = {
+    "host": "localhost",
+    "http_port": 8000,
+}
+
+STARTUP_TIMEOUT = 10
+
+src_path = "."
+fn_path = path.join(src_path, "test", "fns")
+befaas_path = path.join(src_path, "functions", "5_befaas-iot")
+runtime_path = path.join(src_path, "runtimes")
+
+# the kv tests talk to a fake FReD with the stubs that the kv runtime uses
+try:
+    import grpc
+
+    sys.path.insert(0, path.join(runtime_path, "python3-kv"))
+    import fred.middleware_pb2 as fred
+    import fred.middleware_pb2_grpc as fred_grpc
+
+    _Servicer: typing.Any = fred_grpc.MiddlewareServicer
+except ImportError:
+    grpc = None
+    _Servicer = object
+
+
+class Handler:
+    """a function handler running as a local process with a function"""
+
+    def __init__(
+        self,
+        runtime: str,
+        fn_name: str,
+        env: typing.Dict[str, str],
+        fn_dir: str = fn_path,
+        files: typing.Sequence[str] = (),
+    ) -> None:
+        # the same files the image has, runtime and function side by side
+        self.dir = tempfile.mkdtemp(prefix="tinyfaas-")
+        for src in [
+            path.join(runtime_path, runtime),
+            path.join(runtime_path, "python3-common"),
+            path.join(fn_dir, fn_name),
+        ]:
+            shutil.copytree(
+                src,
+                self.dir,
+                dirs_exist_ok=True,
+                ignore=shutil.ignore_patterns("__pycache__"),
+            )
+
+        # files the function needs next to it, e.g., befaas.py
+        for f in files:
+            shutil.copy(f, self.dir)
+
+        self.out = open(path.join(self.dir, "handler.out"), "w")
+        self.output = ""
+
+        self.process = subprocess.Popen(
+            [sys.executable, "functionhandler.py"],
+            cwd=self.dir,
+            env={**os.environ, "PYTHONUNBUFFERED": "1", **env},
+            stdout=self.out,
+            stderr=subprocess.STDOUT,
+        )
+
+        # wait for the handler to listen
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(
+                    (str(connection["host"]), int(connection["http_port"])), 1
+                ).close()
+                return
+            except OSError:
+                pass
+
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.stop()
+                raise Exception(f"handler did not start:\n{self.output}")
+
+            time.sleep(0.05)
+
+    def log(self) -> str:
+        if self.output != "":
+            return self.output
+
+        with open(path.join(self.dir, "handler.out")) as f:
+            return f.read()
+
+    def wait_healthy(self) -> None:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while request("GET", "/health")[0] != 200:
+            if time.monotonic() > deadline:
+                raise Exception(f"handler did not get healthy:\n{self.log()}")
+            time.sleep(0.05)
+
+    def stop(self) -> typing.Optional[int]:
+        """stop the handler like the container would, returns its exit code"""
+
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+        try:
+            self.process.wait(timeout=STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+        self.out.close()
+        self.output = self.log()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+        return self.process.returncode
+
+
+def request(
+    method: str,
+    path: str,
+    body: typing.Optional[bytes] = None,
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+    """make a request on a new connection, returns status, headers and body"""
+
+    conn = http.client.HTTPConnection(
+        str(connection["host"]), int(connection["http_port"]), timeout=10
+    )
+
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        res = conn.getresponse()
+        return res.status, dict(res.getheaders()), res.read()
+    finally:
+        conn.close()
+
+
+class FakeFReD(_Servicer):
+    """
+    a FReD middleware with one keygroup on several nodes, writes reach the
+    nodes that did not take them after lag seconds
+    """
+
+    def __init__(
+        self, nodes: typing.Sequence[str] = ("nodeA", "nodeB"), lag: float = 0.0
+    ) -> None:
+        if grpc is None:
+            raise unittest.SkipTest(
+                "grpcio is not installed -- if you want to run kv tests, install the dependencies in requirements.txt"
+            )
+
+        self.lag = lag
+        # every call sleeps this long, to see how many are in flight at once
+        self.delay = 0.0
+
+        self.lock = threading.Lock()
+        # node -> key -> (value, version vector)
+        self.stores: typing.Dict[str, typing.Dict[str, typing.Any]] = {
+            n: {} for n in nodes
+        }
+        self.chosen = nodes[0]
+        self.dead: typing.Set[str] = set()
+        # the whole middleware is unreachable
+        self.down = False
+        # concurrent versions that Read returns next to the stored one:
+        # key -> [(value, version vector)]
+        self.siblings: typing.Dict[str, typing.List[typing.Any]] = {}
+        self.seq = 0
+
+        self.calls: typing.Counter[str] = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        # kv measures the round trip time to a replica with a tcp handshake
+        self.listeners = {}
+        for n in nodes:
+            sock = socket.create_server(("127.0.0.1", 0))
+            threading.Thread(target=self.accept, args=(sock,), daemon=True).start()
+            self.listeners[n] = sock
+
+        self.server = grpc.server(concurrent.futures.ThreadPoolExecutor(32))
+        fred_grpc.add_MiddlewareServicer_to_server(self, self.server)
+        self.port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+
+    def env(self, node: str = "nodeA") -> typing.Dict[str, str]:
+        return {
+            "__KV_KEYGROUP": "kg",
+            "__KV_HOST": f"127.0.0.1:{self.port}",
+            "__KV_NODE": node,
+        }
+
+    def accept(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                sock.accept()[0].close()
+            except OSError:
+                return
+
+    def kill(self, node: str) -> None:
+        """node stops answering requests and probes"""
+
+        with self.lock:
+            self.dead.add(node)
+
+        self.listeners[node].close()
+
+    def stop(self) -> None:
+        self.server.stop(None)
+
+        for sock in self.listeners.values():
+            sock.close()
+
+    def enter(self, method: str, context: typing.Any) -> str:
+        # counts the call and returns the node that serves it
+        with self.lock:
+            self.calls[method] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            node = self.chosen
+            unavailable = self.down or node in self.dead
+
+        try:
+            time.sleep(self.delay)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+        if unavailable:
+            context.abort(grpc.StatusCode.UNAVAILABLE, f"{node} is unavailable")
+
+        return node
+
+    def replicate(self, node: str, key: str, entry: typing.Any) -> None:
+        def apply(n: str) -> None:
+            with self.lock:
+                self.stores[n][key] = entry
+
+        apply(node)
+
+        for n in self.stores:
+            if n == node:
+                continue
+
+            if self.lag > 0:
+                threading.Timer(self.lag, apply, args=(n,)).start()
+            else:
+                apply(n)
+
+    def ChooseReplica(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        with self.lock:
+            self.calls["ChooseReplica"] += 1
+            unavailable = self.down or request.nodeId in self.dead
+            if not unavailable:
+                self.chosen = request.nodeId
+
+        if unavailable:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "no such replica")
+
+        return fred.Empty()
+
+    def GetKeygroupInfo(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        self.enter("GetKeygroupInfo", context)
+
+        return fred.GetKeygroupInfoResponse(
+            mutable=True,
+            replica=[
+                fred.KeygroupReplica(
+                    nodeId=n, host=f"127.0.0.1:{s.getsockname()[1]}"
+                )
+                for n, s in self.listeners.items()
+            ],
+        )
+
+    def Read(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        node = self.enter("Read", context)
+
+        with self.lock:
+            entry = self.stores[node].get(request.id)
+            siblings = list(self.siblings.get(request.id, []))
+
+        if entry is None or entry[0] is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"no key {request.id}")
+
+        return fred.ReadResponse(
+            items=[
+                fred.Item(id=request.id, val=v, version=vv)
+                for v, vv in [entry] + siblings
+            ]
+        )
+
+    def Scan(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        node = self.enter("Scan", context)
+
+        with self.lock:
+            items = sorted(
+                (k, e[0])
+                for k, e in self.stores[node].items()
+                if k >= request.id and e[0] is not None
+            )
+
+        return fred.ScanResponse(
+            data=[fred.Data(id=k, data=v) for k, v in items[: request.count]]
+        )
+
+    def write(self, method: str, request: typing.Any, context: typing.Any) -> None:
+        node = self.enter(method, context)
+
+        with self.lock:
+            version = dict(self.stores[node].get(request.id, (None, {}))[1])
+
+        version[node] = version.get(node, 0) + 1
+
+        # a delete leaves a tombstone with its version
+        value = request.data if method == "Update" else None
+        self.replicate(node, request.id, (value, version))
+
+    def Update(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        self.write("Update", request, context)
+        return fred.Empty()
+
+    def Delete(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        self.write("Delete", request, context)
+        return fred.Empty()
+
+    def Append(self, request: typing.Any, context: typing.Any) -> typing.Any:
+        node = self.enter("Append", context)
+
+        with self.lock:
+            self.seq += 1
+            key = "%020d" % self.seq
+
+        self.replicate(node, key, (request.data, {node: 1}))
+
+        return fred.AppendResponse(id=key)
+
+
+class FakeFunctions:
+    """
+    the other functions that a befaas function calls, they answer with the ctx
+    they got after delay seconds
+    """
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        # path, headers and body of every request
+        self.requests: typing.List[typing.Tuple[str, typing.Any, bytes]] = []
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+
+                with fake.lock:
+                    fake.connections += 1
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+                with fake.lock:
+                    fake.requests.append((self.path, self.headers, body))
+
+                time.sleep(fake.delay)
+
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: typing.Any) -> None:
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def env(self, functions: typing.Sequence[str]) -> typing.Dict[str, str]:
+        port = self.server.server_address[1]
+
+        return {
+            f"ENDPOINT_{f.upper()}": f"http://127.0.0.1:{port}/{f}" for f in functions
+        }
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TinyFaaSHandlerTest(unittest.TestCase):
+    runtime = ""
+    fn_name = ""
+    fn_dir = fn_path
+    files: typing.Sequence[str] = ()
+    env: typing.Dict[str, str] = {}
+
+    def setUp(self) -> None:
+        # the shared tests only run for the classes that pick a runtime
+        if self.runtime == "":
+            self.skipTest("no runtime")
+
+        self.handler = Handler(
+            self.runtime, self.fn_name, self.env, self.fn_dir, self.files
+        )
+
+    def invoke(self, payload: str) -> str:
+        status, _, body = request("POST", "/fn", payload.encode())
+        self.assertEqual(status, 200, body)
+        return body.decode()
+
+    def tearDown(self) -> None:
+        if self.runtime != "":
+            self.handler.stop()
+
+
+class KeepAliveTest(TinyFaaSHandlerTest):
+    fn_name = "sleep"
+    env = {"HANDLER_KEEPALIVE_REQUESTS": "5"}
+
+    def test_keepalive(self) -> None:
+        """a connection serves HANDLER_KEEPALIVE_REQUESTS requests, then closes"""
+
+        conn = http.client.HTTPConnection(
+            str(connection["host"]), int(connection["http_port"]), timeout=10
+        )
+
+        try:
+            conn.connect()
+            sock = conn.sock
+
+            for i in range(5):
+                conn.request("POST", "/fn", body=f"0.0{i}")
+                res = conn.getresponse()
+
+                self.assertEqual(res.status, 200)
+                self.assertEqual(res.read(), f"0.0{i}".encode())
+
+                if i < 4:
+                    self.assertIs(conn.sock, sock)
+
+            # the last one told the client to go away
+            self.assertEqual(res.getheader("Connection"), "close")
+            self.assertIsNone(conn.sock)
+        finally:
+            conn.close()
+
+        return
+
+
+class TestKeepAlivePython3(KeepAliveTest):
+    runtime = "python3"
+    env = {**KeepAliveTest.env, "HANDLER_SERVER": "stdlib"}
+
+
+class TestKeepAlivePython3Asyncio(KeepAliveTest):
+    runtime = "python3"
+    env = {**KeepAliveTest.env, "HANDLER_SERVER": "asyncio"}
+
+
+class TestKeepAlivePython3KV(KeepAliveTest):
+    runtime = "python3-kv"
+
+
+class TestAsyncioServer(TinyFaaSHandlerTest):
+    runtime = "python3"
+    fn_name = "sleep"
+    env = {"HANDLER_SERVER": "asyncio", "HANDLER_WORKERS": "4"}
+
+    def test_pipelining(self) -> None:
+        """pipelined requests are answered in order on the same connection"""
+
+        bodies = ["0.2", "0", "0.1"]
+
+        with socket.create_connection(
+            (str(connection["host"]), int(connection["http_port"])), 10
+        ) as sock:
+            sock.sendall(
+                b"".join(
+                    f"POST /fn HTTP/1.1\r\nHost: localhost\r\n"
+                    f"Content-Length: {len(b)}\r\n\r\n{b}".encode()
+                    for b in bodies
+                )
+            )
+
+            f = sock.makefile("rb")
+
+            for b in bodies:
+                self.assertIn(b" 200 ", f.readline())
+
+                length = 0
+                while True:
+                    line = f.readline().strip()
+                    if line == b"":
+                        break
+
+                    k, v = line.split(b":", 1)
+                    if k.lower() == b"content-length":
+                        length = int(v)
+
+                self.assertEqual(f.read(length), b.encode())
+
+        return
+
+    def test_workers(self) -> None:
+        """up to HANDLER_WORKERS invocations run at the same time"""
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: self.invoke("0.3"), range(8)))
+        duration = time.monotonic() - start
+
+        self.assertEqual(results, ["0.3"] * 8)
+
+        # two rounds of four
+        self.assertGreaterEqual(duration, 0.6)
+        self.assertLess(duration, 1.2)
+
+        return
+
+
+class BytesTest(TinyFaaSHandlerTest):
+    fn_name = "echo-bytes"
+
+    def test_invoke(self) -> None:
+        """fn_bytes gets the raw body, which does not have to be UTF-8"""
+
+        payload = bytes(range(256)) * 64
+
+        status, _, body = request("POST", "/fn", payload)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, payload)
+
+        return
+
+
+class TestBytesPython3(BytesTest):
+    runtime = "python3"
+    env = {"HANDLER_SERVER": "stdlib"}
+
+
+class TestBytesPython3Asyncio(BytesTest):
+    runtime = "python3"
+    env = {"HANDLER_SERVER": "asyncio"}
+
+
+class TestBytesPython3KV(BytesTest):
+    runtime = "python3-kv"
+
+
+class InitTest(TinyFaaSHandlerTest):
+    fn_name = "init"
+
+    def test_init(self) -> None:
+        """init runs once before the first invocation, startup is logged"""
+
+        self.handler.wait_healthy()
+
+        for _ in range(3):
+            status, _, body = request("POST", "/fn", b"")
+            self.assertEqual(status, 200)
+            self.assertEqual(body, b"1")
+
+        self.handler.stop()
+
+        startup = [
+            json.loads(line.split(";", 1)[1])
+            for line in self.handler.log().splitlines()
+            if line.startswith("STARTUP;")
+        ]
+        self.assertEqual(len(startup), 1)
+
+        # the steps are logged in the order they happened
+        timeline = startup[0]["timeline"]
+        steps = ["fn_import", "init", "ready", "first_request", "first_response"]
+        self.assertEqual([k for k in timeline if k in steps], steps)
+        self.assertEqual(list(timeline.values()), sorted(timeline.values()))
+
+        return
+
+
+class TestInitPython3(InitTest):
+    runtime = "python3"
+    env = {"HANDLER_SERVER": "stdlib"}
+
+
+class TestInitPython3Asyncio(InitTest):
+    runtime = "python3"
+    env = {"HANDLER_SERVER": "asyncio"}
+
+
+class TestInitPython3KV(InitTest):
+    runtime = "python3-kv"
+
+
+class AsyncTest(TinyFaaSHandlerTest):
+    fn_name = "sleep"
+    env = {
+        "HANDLER_ASYNC_WORKERS": "1",
+        "HANDLER_ASYNC_QUEUE": "1",
+        "HANDLER_ASYNC_OVERFLOW": "drop-oldest",
+    }
+
+    def test_async(self) -> None:
+        """async invocations are acknowledged before they run"""
+
+        for _ in range(3):
+            start = time.monotonic()
+            status, _, _ = request(
+                "POST", "/fn", b"0.3", {"X-tinyFaaS-Async": "true"}
+            )
+            self.assertEqual(status, 202)
+            self.assertLess(time.monotonic() - start, 0.2)
+
+        # one runs, one waits, and the one that waited before it was dropped
+        status, _, body = request("GET", "/metrics")
+        self.assertEqual(status, 200)
+
+        stats = json.loads(body)["async"]
+        self.assertEqual(stats["running"], 1)
+        self.assertEqual(stats["queue_depth"], 1)
+        self.assertEqual(stats["accepted"], 3)
+        self.assertEqual(stats["dropped"], 1)
+
+        time.sleep(0.8)
+
+        stats = json.loads(request("GET", "/metrics")[2])["async"]
+        self.assertEqual(stats["running"], 0)
+        self.assertEqual(stats["queue_depth"], 0)
+
+        return
+
+
+class TestAsyncPython3(AsyncTest):
+    runtime = "python3"
+    env = {**AsyncTest.env, "HANDLER_SERVER": "stdlib"}
+
+
+class TestAsyncPython3Asyncio(AsyncTest):
+    runtime = "python3"
+    env = {**AsyncTest.env, "HANDLER_SERVER": "asyncio"}
+
+
+class TestAsyncPython3KV(AsyncTest):
+    runtime = "python3-kv"
+
+
+class BatchTest(TinyFaaSHandlerTest):
+    fn_name = "echo-batch"
+    env = {"HANDLER_BATCH_SIZE": "4", "HANDLER_BATCH_WAIT": "50"}
+
+    def test_batch(self) -> None:
+        """concurrent invocations are collected into batches"""
+
+        def invoke(payload: str) -> str:
+            status, _, body = request("POST", "/fn", payload.encode())
+            self.assertEqual(status, 200)
+            return body.decode()
+
+        payloads = [f"Hello World {i}!" for i in range(16)]
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(invoke, payloads))
+
+        # every response is the output for its own input
+        sizes = []
+        for payload, result in zip(payloads, results):
+            size, _, output = result.partition(":")
+            self.assertEqual(output, payload)
+            sizes.append(int(size))
+
+        self.assertTrue(all(1 <= s <= 4 for s in sizes))
+        self.assertGreater(max(sizes), 1)
+
+        stats = json.loads(request("GET", "/metrics")[2])["batch"]
+        self.assertEqual(stats["items"], len(payloads))
+        self.assertLess(stats["batches"], len(payloads))
+
+        return
+
+
+class TestBatchPython3(BatchTest):
+    runtime = "python3"
+    env = {**BatchTest.env, "HANDLER_SERVER": "stdlib"}
+
+
+class TestBatchPython3Asyncio(BatchTest):
+    runtime = "python3"
+    env = {**BatchTest.env, "HANDLER_SERVER": "asyncio"}
+
+
+class TestBatchPython3KV(BatchTest):
+    runtime = "python3-kv"
+
+
+class AdmissionTest(TinyFaaSHandlerTest):
+    fn_name = "sleep"
+    env = {
+        "HANDLER_SERVER": "stdlib",
+        "HANDLER_MAX_IN_FLIGHT": "1",
+        "HANDLER_MAX_QUEUE": "1",
+        "HANDLER_RETRY_AFTER": "3",
+    }
+
+    def test_reject(self) -> None:
+        """one invocation runs, one waits, the third is rejected right away"""
+
+        def invoke(payload: str) -> typing.Tuple[int, typing.Dict[str, str], float]:
+            start = time.monotonic()
+            status, headers, _ = request("POST", "/fn", payload.encode())
+            return status, headers, time.monotonic() - start
+
+        with concurrent.futures.ThreadPoolExecutor(3) as executor:
+            first = executor.submit(invoke, "0.5")
+            time.sleep(0.1)
+            second = executor.submit(invoke, "0")
+            time.sleep(0.1)
+            third = executor.submit(invoke, "0")
+
+            results = [first.result(), second.result(), third.result()]
+
+        self.assertEqual([s for s, _, _ in results], [200, 200, 503])
+
+        # the rejected one did not wait for the others
+        _, headers, duration = results[2]
+        self.assertEqual(headers.get("Retry-After"), "3")
+        self.assertLess(duration, 0.3)
+
+        status, _, body = request("GET", "/metrics")
+        self.assertEqual(status, 200)
+
+        stats = json.loads(body)["handler"]
+        self.assertEqual(stats["admitted"], 2)
+        self.assertEqual(stats["rejected"], 1)
+
+        return
+
+    def test_async(self) -> None:
+        """async invocations wait for a slot instead of being rejected"""
+
+        status, _, _ = request(
+            "POST", "/fn", b"0.3", {"X-tinyFaaS-Async": "true"}
+        )
+        self.assertEqual(status, 202)
+
+        time.sleep(0.1)
+
+        # the async invocation has the only slot
+        status, headers, _ = request("POST", "/fn", b"0")
+        self.assertEqual(status, 200)
+
+        status, _, body = request("GET", "/metrics")
+        self.assertEqual(json.loads(body)["handler"]["admitted"], 2)
+
+        return
+
+
+class TestAdmissionPython3(AdmissionTest):
+    runtime = "python3"
+
+
+class TestAdmissionPython3KV(AdmissionTest):
+    runtime = "python3-kv"
+
+
+class AsyncOverflowTest(TinyFaaSHandlerTest):
+    fn_name = "sleep"
+    env = {
+        "HANDLER_ASYNC_OVERFLOW": "reject",
+        "HANDLER_ASYNC_QUEUE": "0",
+        "HANDLER_RETRY_AFTER": "3",
+    }
+
+    def test_reject(self) -> None:
+        """async answers tell the reverse proxy whether to wait for them"""
+
+        status, headers, _ = request(
+            "POST", "/fn", b"0", {"X-tinyFaaS-Async": "true"}
+        )
+        self.assertEqual(status, 503)
+        self.assertEqual(headers.get("Retry-After"), "3")
+        self.assertEqual(headers.get("X-tinyFaaS-Async-Overflow"), "reject")
+
+        # synchronous answers don't need it
+        status, headers, _ = request("POST", "/fn", b"0")
+        self.assertEqual(status, 200)
+        self.assertNotIn("X-tinyFaaS-Async-Overflow", headers)
+
+        return
+
+
+class TestAsyncOverflowPython3(AsyncOverflowTest):
+    runtime = "python3"
+    env = {**AsyncOverflowTest.env, "HANDLER_SERVER": "stdlib"}
+
+
+class TestAsyncOverflowPython3Asyncio(AsyncOverflowTest):
+    runtime = "python3"
+    env = {**AsyncOverflowTest.env, "HANDLER_SERVER": "asyncio"}
+
+
+class TestAsyncOverflowPython3KV(AsyncOverflowTest):
+    runtime = "python3-kv"
+
+
+class ChunkedBodyTest(TinyFaaSHandlerTest):
+    fn_name = "echo"
+
+    def test_keepalive(self) -> None:
+        """a chunked request body reaches the function whole"""
+
+        conn = http.client.HTTPConnection(
+            str(connection["host"]), int(connection["http_port"]), timeout=10
+        )
+
+        try:
+            payload = "Hello World! ".encode() * 1000
+
+            # without a length, http.client sends the body in chunks
+            conn.request(
+                "POST",
+                "/fn",
+                body=iter([payload[:1000], payload[1000:5000], payload[5000:]]),
+                encode_chunked=True,
+            )
+            res = conn.getresponse()
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.read(), payload)
+
+            # the connection is still good for the next request
+            conn.request("POST", "/fn", body=b"Hello World!")
+            res = conn.getresponse()
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.read(), b"Hello World!")
+        finally:
+            conn.close()
+
+        return
+
+
+class TestChunkedBodyPython3(ChunkedBodyTest):
+    runtime = "python3"
+    env = {"HANDLER_SERVER": "stdlib"}
+
+
+class TestChunkedBodyPython3Asyncio(ChunkedBodyTest):
+    runtime = "python3"
+    env = {"HANDLER_SERVER": "asyncio"}
+
+
+class TestChunkedBodyPython3KV(ChunkedBodyTest):
+    runtime = "python3-kv"
+
+
+class TestPrefork(TinyFaaSHandlerTest):
+    runtime = "python3-kv"
+    fn_name = "sleep"
+    env = {"HANDLER_PROCESSES": "2", "HANDLER_MAX_REQUESTS": "20"}
+
+    def test_recycle(self) -> None:
+        """workers are replaced under load without losing a connection"""
+
+        self.handler.wait_healthy()
+
+        def invoke(i: int) -> typing.Tuple[int, bytes]:
+            payload = f"0.00{i % 10}".encode()
+            status, _, body = request("POST", "/fn", payload)
+            return status, body == payload
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(invoke, range(400)))
+
+        # no connection was refused or reset, and every request was answered
+        self.assertEqual(results, [(200, True)] * len(results))
+
+        self.handler.wait_healthy()
+        self.assertEqual(self.handler.stop(), 0)
+
+        # with at most 40 requests each, plenty of workers have come and gone
+        log = self.handler.log()
+        self.assertGreaterEqual(log.count("recycling"), 5, log)
+        self.assertNotIn("exited with status", log)
+
+        return
+
+    def test_stop(self) -> None:
+        """invocations in flight finish when the handler is stopped"""
+
+        self.handler.wait_healthy()
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            f = executor.submit(request, "POST", "/fn", b"0.5")
+            time.sleep(0.2)
+
+            self.handler.process.send_signal(signal.SIGTERM)
+            status, _, body = f.result()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"0.5")
+        self.assertEqual(self.handler.stop(), 0)
+
+        return
+
+
+class TinyFaaSKVTest(TinyFaaSHandlerTest):
+    runtime = "python3-kv"
+    fn_name = "kv-ops"
+    nodes: typing.Sequence[str] = ("nodeA", "nodeB")
+    lag = 0.0
+    # the middleware is unreachable when the handler starts
+    down = False
+
+    def setUp(self) -> None:
+        self.fred = FakeFReD(self.nodes, self.lag)
+        self.fred.down = self.down
+        self.addCleanup(self.fred.stop)
+
+        self.handler = Handler(
+            self.runtime,
+            self.fn_name,
+            {**self.fred.env(), **self.env},
+            self.fn_dir,
+            self.files,
+        )
+
+        if not self.down:
+            self.handler.wait_healthy()
+
+    def kv_stats(self) -> typing.Dict[str, typing.Any]:
+        return json.loads(request("GET", "/metrics")[2])["kv"]
+
+
+class TestKVCache(TinyFaaSKVTest):
+    env = {"KV_CACHE_SIZE": "2", "KV_CACHE_TTL": "300"}
+
+    def test_cache(self) -> None:
+        """repeated reads are served locally until a write or the ttl"""
+
+        self.assertEqual(self.invoke("set a=1"), "ok")
+
+        self.assertEqual(self.invoke("get a"), "1")
+        self.assertEqual(self.invoke("get a"), "1")
+        self.assertEqual(self.fred.calls["Read"], 1)
+
+        # a write drops the key from the cache
+        self.assertEqual(self.invoke("set a=2"), "ok")
+        self.assertEqual(self.invoke("get a"), "2")
+        self.assertEqual(self.fred.calls["Read"], 2)
+
+        # after the ttl, a replica that lags behind does not take us back to
+        # an older version
+        with self.fred.lock:
+            self.fred.stores["nodeB"]["a"] = ("1", {"nodeA": 1})
+        self.fred.chosen = "nodeB"
+
+        time.sleep(0.4)
+        self.assertEqual(self.invoke("get a"), "2")
+        self.assertEqual(self.fred.calls["Read"], 3)
+        self.fred.chosen = "nodeA"
+
+        # no more than KV_CACHE_SIZE entries
+        self.assertEqual(self.invoke("set b=1,c=1"), "ok")
+        self.assertEqual(self.invoke("get b,c"), "1\n1")
+        self.assertEqual(self.invoke("get a"), "2")
+        self.assertEqual(self.fred.calls["Read"], 6)
+
+        cache = self.kv_stats()["cache"]
+        self.assertEqual(cache["size"], 2)
+        self.assertEqual((cache["hits"], cache["misses"]), (1, 6))
+
+        return
+
+
+class TestKVRouting(TinyFaaSKVTest):
+    env = {"KV_ROUTING": "latency", "KV_PROBE_INTERVAL": "60000"}
+
+    def test_failover(self) -> None:
+        """a request that the replica fails is retried on the next best one"""
+
+        self.assertEqual(self.invoke("set a=1"), "ok")
+
+        # the replicas have been measured once, and not again for a minute
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while self.fred.calls["GetKeygroupInfo"] == 0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        time.sleep(0.2)
+
+        node = self.fred.chosen
+        other = [n for n in self.nodes if n != node][0]
+        self.fred.kill(node)
+
+        self.assertEqual(self.invoke("get a"), "1")
+        self.assertEqual(self.fred.chosen, other)
+        self.assertEqual(self.kv_stats()["retries"]["failover"], 1)
+
+        # later requests go to the new replica right away
+        self.assertEqual(self.invoke("set a=2"), "ok")
+        self.assertEqual(self.invoke("get a"), "2")
+        self.assertEqual(self.kv_stats()["retries"]["failover"], 1)
+
+        return
+
+
+class TestKVMetrics(TinyFaaSKVTest):
+    def test_metrics(self) -> None:
+        """/metrics has latency histograms and counters of the kv calls"""
+
+        self.fred.delay = 0.01
+
+        self.assertEqual(self.invoke("set a=1"), "ok")
+        self.assertEqual(self.invoke("get a"), "1")
+        self.assertEqual(request("POST", "/fn", b"get nokey")[0], 500)
+
+        stats = self.kv_stats()
+
+        latency = stats["latency"]["kg"]
+        self.assertEqual(latency["Update"]["count"], 1)
+        self.assertEqual(latency["Read"]["count"], 2)
+
+        read = latency["Read"]
+        self.assertGreaterEqual(read["p50"], 10)
+        self.assertLessEqual(read["p50"], read["p99"])
+        self.assertLessEqual(read["p99"], read["max"] * 1.1)
+
+        self.assertGreater(stats["bytes_sent"], 0)
+        self.assertGreater(stats["bytes_received"], 0)
+        self.assertEqual(stats["errors"], {"NOT_FOUND": 1})
+
+        return
+
+
+class TestKVWarmup(TinyFaaSKVTest):
+    env = {"KV_CONNECT_RETRIES": "2", "KV_CONNECT_BACKOFF": "10"}
+    down = True
+
+    def test_warmup(self) -> None:
+        """warmup backs off while the middleware is down, and connects after"""
+
+        time.sleep(1)
+        self.assertEqual(request("GET", "/health")[0], 503)
+
+        # rounds of three attempts, with pauses of 5-10ms, 10-20ms, ... between
+        # them, rather than attempts back to back
+        calls = self.fred.calls["ChooseReplica"]
+        self.assertGreaterEqual(calls, 3)
+        self.assertLessEqual(calls, 30)
+
+        # one line per round rather than per attempt
+        log = self.handler.log()
+        self.assertNotIn("(attempt", log)
+        self.assertLessEqual(log.count("rounds of retries"), calls // 3)
+
+        self.fred.down = False
+        self.handler.wait_healthy()
+
+        self.assertGreater(self.kv_stats()["retries"]["warmup"], 0)
+
+        return
+
+
+class TestKVScan(TinyFaaSKVTest):
+    def test_scan_iter(self) -> None:
+        """scan_iter fetches page after page, and no more than it needs"""
+
+        values = [f"value {i}" for i in range(5)]
+        keys = [self.invoke(f"append {v}") for v in values]
+
+        # pages of 2 overlap by one key after the first: 1-2, 2-4, 4-5
+        self.assertEqual(self.invoke(f"log {keys[0]}"), "\n".join(values))
+        self.assertEqual(self.fred.calls["Scan"], 3)
+
+        self.assertEqual(self.invoke(f"head {keys[1]} 3"), "\n".join(values[1:4]))
+        self.assertEqual(self.fred.calls["Scan"], 5)
+
+        self.assertEqual(self.invoke(f"head {keys[1]} 0"), "")
+        self.assertEqual(self.fred.calls["Scan"], 5)
+
+        return
+
+
+class TestKVBatch(TinyFaaSKVTest):
+    env = {"KV_BATCH_IN_FLIGHT": "4"}
+
+    def test_update_many_read_many(self) -> None:
+        """batches are pipelined, with at most KV_BATCH_IN_FLIGHT requests"""
+
+        self.fred.delay = 0.05
+        items = {f"key{i}": f"value {i}" for i in range(12)}
+
+        start = time.monotonic()
+        self.assertEqual(
+            self.invoke("set " + ",".join(f"{k}={v}" for k, v in items.items())),
+            "ok",
+        )
+
+        keys = sorted(items, reverse=True)
+        self.assertEqual(
+            self.invoke("get " + ",".join(keys)), "\n".join(items[k] for k in keys)
+        )
+        duration = time.monotonic() - start
+
+        self.assertEqual(self.fred.calls["Update"], len(items))
+        self.assertEqual(self.fred.calls["Read"], len(items))
+
+        # one round trip per KV_BATCH_IN_FLIGHT keys rather than one per key
+        self.assertEqual(self.fred.max_in_flight, 4)
+        self.assertLess(duration, 2 * len(items) * self.fred.delay)
+
+        # a key that fails does not fail the others, but fn gives up on it
+        status, _, body = request("POST", "/fn", b"get key0,nokey,key1")
+        self.assertEqual(status, 500)
+        self.assertIn(b"nokey", body)
+
+        return
+
+
+class TestKVWriteBehind(TinyFaaSKVTest):
+    env = {
+        "KV_WRITE_BEHIND": "async",
+        "KV_FLUSH_INTERVAL": "50",
+        "KV_WRITE_BUFFER_SIZE": "4",
+    }
+
+    def test_outage(self) -> None:
+        """writes stay buffered through an outage, up to the buffer size"""
+
+        self.fred.down = True
+
+        # the write that fills the buffer cannot flush it, but is kept
+        for i in range(4):
+            self.assertEqual(self.invoke(f"set key{i}=value {i}"), "ok")
+
+        # a new key does not fit, a buffered one can still be written
+        status, _, body = request("POST", "/fn", b"set key4=value 4")
+        self.assertEqual(status, 500)
+        self.assertIn(b"key4", body)
+
+        self.assertEqual(self.invoke("set key0=value 0b"), "ok")
+        self.assertEqual(self.invoke("get key0,key3"), "value 0b\nvalue 3")
+
+        # once FReD is back, the next flush sends everything
+        self.fred.down = False
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while len(self.fred.stores["nodeA"]) < 4:
+            self.assertLess(time.monotonic(), deadline, self.handler.log())
+            time.sleep(0.05)
+
+        self.assertEqual(self.fred.stores["nodeA"]["key0"][0], "value 0b")
+        self.assertNotIn("key4", self.fred.stores["nodeA"])
+
+        self.assertEqual(self.invoke("set key4=value 4"), "ok")
+
+        return
+
+
+class TestKVSession(TinyFaaSKVTest):
+    env = {
+        "KV_SESSION": "true",
+        "KV_SESSION_RETRIES": "100",
+        "KV_BATCH_IN_FLIGHT": "4",
+    }
+    lag = 0.3
+
+    def test_read_backs(self) -> None:
+        """the versions of blind writes are read back in one pipeline"""
+
+        self.fred.delay = 0.1
+        items = {f"key{i}": f"value {i}" for i in range(8)}
+
+        start = time.monotonic()
+        self.assertEqual(
+            self.invoke("set " + ",".join(f"{k}={v}" for k, v in items.items())),
+            "ok",
+        )
+        duration = time.monotonic() - start
+
+        self.assertEqual(self.fred.calls["Read"], len(items))
+
+        # two rounds of writes and two of reads, rather than a read per key
+        self.assertLess(duration, 7 * self.fred.delay)
+
+        return
+
+    def test_blind_write(self) -> None:
+        """a replica that has not seen the last write yet is not read from"""
+
+        self.assertEqual(self.invoke("set key=v1"), "ok")
+        time.sleep(2 * self.lag)
+
+        # the version of key is known now, so this write needs no read back
+        self.assertEqual(self.invoke("set key=v2"), "ok")
+        self.assertEqual(self.fred.calls["Read"], 1)
+
+        # the middleware serves from a replica that still has v1
+        self.fred.chosen = "nodeB"
+        self.assertEqual(self.invoke("get key"), "v2")
+
+        self.assertGreater(self.fred.calls["Read"], 2)
+        self.assertGreater(self.kv_stats()["retries"]["session"], 0)
+
+        return
+
+
+class TestKVAsync(TinyFaaSKVTest):
+    env = {"KV_SESSION": "true"}
+
+    def test_gather(self) -> None:
+        """kv_async runs calls concurrently on kv's connection and session"""
+
+        self.fred.delay = 0.1
+        items = {f"key{i}": f"value {i}" for i in range(4)}
+
+        start = time.monotonic()
+        self.assertEqual(
+            self.invoke("gather " + ",".join(f"{k}={v}" for k, v in items.items())),
+            "\n".join(items.values()),
+        )
+        duration = time.monotonic() - start
+
+        # writes, the reads of their versions and reads, each all at once
+        self.assertLess(duration, 6 * self.fred.delay)
+        self.assertEqual(self.fred.calls["Update"], len(items))
+        self.assertEqual(self.fred.calls["Read"], 2 * len(items))
+
+        # no connection of its own, and its calls show up in kv's stats
+        self.assertEqual(self.fred.calls["ChooseReplica"], 1)
+        self.assertEqual(self.kv_stats()["latency"]["kg"]["Update"]["count"], 4)
+
+        return
+
+
+class TestKVMerge(TinyFaaSKVTest):
+    def test_read_one(self) -> None:
+        """read_one drops superseded versions and picks one concurrent version"""
+
+        self.assertEqual(self.invoke("set key=current"), "ok")
+        self.assertEqual(self.invoke("one key"), "current")
+
+        # a version that the stored one includes is ignored
+        self.fred.siblings["key"] = [("old", {})]
+        self.assertEqual(self.invoke("one key"), "current")
+
+        # between concurrent versions, every instance picks the same one,
+        # whatever order the replica returns them in
+        self.fred.siblings["key"] = [("b", {"nodeB": 1}), ("c", {"nodeC": 1})]
+        self.assertEqual(self.invoke("one key"), "c")
+
+        self.fred.siblings["key"] = [("c", {"nodeC": 1}), ("b", {"nodeB": 1})]
+        self.assertEqual(self.invoke("one key"), "c")
+
+        return
+
+
+class TestKVLog(TinyFaaSKVTest):
+    def test_append(self) -> None:
+        """appends get increasing keys and are never retried"""
+
+        values = [f"value {i}" for i in range(5)]
+        keys = [self.invoke(f"append {v}") for v in values]
+
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertEqual(self.invoke(f"log {keys[0]}"), "\n".join(values))
+        self.assertEqual(self.invoke(f"log {keys[2]}"), "\n".join(values[2:]))
+
+        # an append that may have been written is not sent again
+        self.fred.down = True
+        status, _, _ = request("POST", "/fn", b"append lost")
+        self.assertEqual(status, 500)
+        self.assertEqual(self.fred.calls["Append"], len(values) + 1)
+
+        return
+
+
+class TestBefaas(TinyFaaSKVTest):
+    fn_name = "objectrecognition"
+    fn_dir = befaas_path
+    files = (path.join(befaas_path, "befaas.py"),)
+    env = {"FUNCTION_NAME": "objectrecognition", "BEFAAS_CACHE_REPORT": "0.1"}
+
+    calls = ("trafficstatistics", "emergencydetection", "movementplan")
+
+    def setUp(self) -> None:
+        self.functions = FakeFunctions()
+        self.addCleanup(self.functions.stop)
+
+        self.otlp = path.join(tempfile.mkdtemp(prefix="tinyfaas-otlp-"), "spans")
+        self.addCleanup(shutil.rmtree, path.dirname(self.otlp), True)
+
+        self.env = {
+            **self.env,
+            **self.functions.env(self.calls),
+            "BEFAAS_OTLP_OUTPUT": self.otlp,
+        }
+
+        super().setUp()
+
+    def invoke_ctx(self, xcontext: str) -> typing.Dict[str, typing.Any]:
+        # an image whose first pixel objectrecognition looks at
+        ctx = {
+            "xpair": f"{xcontext}-pair",
+            "xcontext": xcontext,
+            "data": {"image": base64.b64encode(bytes(64)).decode()},
+        }
+
+        return json.loads(self.invoke(json.dumps(ctx)))  # type: ignore
+
+    def test_pool(self) -> None:
+        """calls reuse the connections of earlier calls to the same function"""
+
+        for i in range(3):
+            self.invoke_ctx(f"context{i}")
+
+        self.assertEqual(len(self.functions.requests), 3 * len(self.calls))
+
+        # one connection for each of the calls that run at the same time
+        self.assertLessEqual(self.functions.connections, len(self.calls))
+
+        return
+
+    def test_call_many(self) -> None:
+        """the calls of a fan-out are made at the same time"""
+
+        self.functions.delay = 0.3
+
+        start = time.monotonic()
+        self.invoke_ctx("context")
+        duration = time.monotonic() - start
+
+        self.assertEqual(
+            sorted(p for p, _, _ in self.functions.requests),
+            sorted(f"/{f}" for f in self.calls),
+        )
+        self.assertLess(duration, 2 * self.functions.delay)
+
+        return
+
+    def test_spans(self) -> None:
+        """calls carry a traceparent, and spans are exported as OTLP/JSON"""
+
+        self.invoke_ctx("context")
+        self.assertEqual(self.handler.stop(), 0)
+
+        trace_id = hashlib.md5(b"context").hexdigest()
+
+        # the called functions get the client spans of the calls as parents
+        parents = set()
+        for _, headers, _ in self.functions.requests:
+            version, trace, parent, flags = headers["traceparent"].split("-")
+            self.assertEqual((version, trace, flags), ("00", trace_id, "01"))
+            parents.add(parent)
+
+        with open(self.otlp) as f:
+            spans = [
+                span
+                for line in f
+                for rs in json.loads(line)["resourceSpans"]
+                for ss in rs["scopeSpans"]
+                for span in ss["spans"]
+            ]
+
+        self.assertEqual({s["traceId"] for s in spans}, {trace_id})
+
+        server = [s for s in spans if s["name"] == "objectrecognition"]
+        self.assertEqual(len(server), 1)
+        self.assertEqual(server[0]["kind"], 2)
+
+        calls = [s for s in spans if s["name"].startswith("call-")]
+        self.assertEqual(
+            sorted(s["name"] for s in calls), sorted(f"call-{f}" for f in self.calls)
+        )
+        self.assertEqual({s["spanId"] for s in calls}, parents)
+
+        for s in calls:
+            self.assertEqual(s["kind"], 3)
+            self.assertEqual(s["parentSpanId"], server[0]["spanId"])
+            self.assertLessEqual(
+                int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+            )
+
+        return
+
+    def test_cache(self) -> None:
+        """parsed contexts are shared within a request and freed when it ends"""
+
+        for i in range(3):
+            self.invoke_ctx(f"context{i}")
+
+        # wait for a CACHE line that comes after the last request
+        time.sleep(0.5)
+        self.assertEqual(self.handler.stop(), 0)
+
+        reports = [
+            line.split(";", 3)[3]
+            for line in self.handler.log().splitlines()
+            if line.startswith("CACHE;")
+        ]
+        self.assertGreater(len(reports), 0)
+        stats = json.loads(reports[-1])
+
+        # start parses the context, the calls and end find it in the cache
+        self.assertEqual(stats["misses"], 3)
+        self.assertEqual(stats["hits"], 3 * (len(self.calls) + 1))
+        self.assertEqual(stats["released"], 3)
+        self.assertEqual(stats["evictions"], 0)
+        self.assertEqual((stats["entries"], stats["bytes"]), (0, 0))
+
+        return
+
+
+class TestBefaasShutdown(TinyFaaSKVTest):
+    fn_name = "trafficsensorfilter"
+    fn_dir = befaas_path
+    files = (path.join(befaas_path, "befaas.py"),)
+    env = {"PROCESSES": "2", "BEFAAS_TRACE_FLUSH": "60"}
+
+    def setUp(self) -> None:
+        self.otlp = path.join(tempfile.mkdtemp(prefix="tinyfaas-otlp-"), "spans")
+        self.addCleanup(shutil.rmtree, path.dirname(self.otlp), True)
+        self.env = {**self.env, "BEFAAS_OTLP_OUTPUT": self.otlp}
+
+        super().setUp()
+
+    def test_shutdown(self) -> None:
+        """trace records and spans still buffered are written out on SIGTERM"""
+
+        ctx = {
+            "xpair": "pair",
+            "xcontext": "context",
+            "data": {"carDirection": {"plate": "", "direction": 7, "speed": 0}},
+        }
+        for _ in range(4):
+            self.invoke(json.dumps(ctx))
+
+        # long before the writer would flush them on its own
+        self.assertEqual(self.handler.stop(), 0)
+
+        log = self.handler.log()
+        self.assertEqual(log.count(";pair;pair;context;start"), 4, log)
+        self.assertEqual(log.count(";pair;pair;context;end"), 4, log)
+
+        with open(self.otlp) as f:
+            self.assertIn("resourceSpans", f.read())
+
+        return
+
+
+if __name__ == "__main__":
+    unittest.main()  # run all tests